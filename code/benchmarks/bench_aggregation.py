@@ -0,0 +1,136 @@
+# --------------------------------------------------------
+# Benchmark: per-round FedAvg aggregation time
+# legacy per-parameter average_model vs. FlatAggregator
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from util.aggregation import FlatAggregator
+from util.FedAvg_utils import average_model
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('FedAvg aggregation benchmark', add_help=False)
+    parser.add_argument('--embed_dim', default=1024, type=int, help='1024 / 24 matches ViT-Large')
+    parser.add_argument('--depth', default=24, type=int)
+    parser.add_argument('--n_clients', default=12, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--skip_legacy', action='store_true')
+    return parser.parse_args(argv)
+
+
+class ViTLikeBlocks(nn.Module):
+    """ Parameter layout of a ViT encoder (same tensor count and shapes), without the forward. """
+    def __init__(self, embed_dim, depth, mlp_ratio=4):
+        super().__init__()
+        hidden = embed_dim * mlp_ratio
+        self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
+        self.pos_embed = nn.Parameter(torch.zeros(1, 197, embed_dim))
+        self.patch_embed = nn.Conv2d(3, embed_dim, kernel_size=16, stride=16)
+        self.blocks = nn.ModuleList([nn.ModuleDict({
+            'norm1': nn.LayerNorm(embed_dim),
+            'qkv': nn.Linear(embed_dim, embed_dim * 3),
+            'proj': nn.Linear(embed_dim, embed_dim),
+            'norm2': nn.LayerNorm(embed_dim),
+            'fc1': nn.Linear(embed_dim, hidden),
+            'fc2': nn.Linear(hidden, embed_dim),
+        }) for _ in range(depth)])
+        self.norm = nn.LayerNorm(embed_dim)
+        self.head = nn.Linear(embed_dim, 2)
+
+
+def legacy_average_model(args, model_avg, model_all):
+    """ average_model before the flat-buffer engine, kept here as the reference. """
+    model_avg.cpu()
+    params = dict(model_avg.named_parameters())
+
+    for name, param in params.items():
+        for client in range(len(args.proxy_clients)):
+            single_client = args.proxy_clients[client]
+            single_client_weight = args.clients_weightes[single_client]
+            single_client_weight = torch.from_numpy(np.array(single_client_weight)).float()
+            if client == 0:
+                tmp_param_data = dict(model_all[single_client].named_parameters())[
+                                     name].data * single_client_weight
+            else:
+                tmp_param_data = tmp_param_data + \
+                                 dict(model_all[single_client].named_parameters())[
+                                     name].data * single_client_weight
+        params[name].data.copy_(tmp_param_data)
+
+    for single_client in args.proxy_clients:
+        tmp_params = dict(model_all[single_client].named_parameters())
+        for name, param in params.items():
+            tmp_params[name].data.copy_(param.data)
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.mean(times))
+
+
+def run(opts):
+    torch.manual_seed(0)
+    model = ViTLikeBlocks(opts.embed_dim, opts.depth)
+    n_parameters = sum(p.numel() for p in model.parameters())
+
+    args = argparse.Namespace()
+    args.distributed = False
+    args.proxy_clients = ['client_%d' % i for i in range(opts.n_clients)]
+    lens = np.random.RandomState(0).randint(100, 1000, size=opts.n_clients)
+    args.clients_weightes = {c: l / lens.sum() for c, l in zip(args.proxy_clients, lens)}
+    model_all = {}
+    for c in args.proxy_clients:
+        model_all[c] = deepcopy(model)
+        for p in model_all[c].parameters():
+            p.data.normal_()
+
+    # correctness check against the legacy implementation
+    reference_avg = deepcopy(model)
+    reference_all = deepcopy(model_all)
+    legacy_average_model(args, reference_avg, reference_all)
+    model_avg = deepcopy(model)
+    aggregator = FlatAggregator(model_avg)
+    average_model(args, model_avg, deepcopy(model_all), aggregator=aggregator)
+    max_abs_diff = max((p - q).abs().max().item() for p, q in
+                       zip(reference_avg.parameters(), model_avg.parameters()))
+    del reference_avg, reference_all
+
+    results = {
+        'benchmark': 'aggregation',
+        'n_parameters': n_parameters,
+        'n_tensors': len(aggregator.names),
+        'n_clients': opts.n_clients,
+        'max_abs_diff': max_abs_diff,
+    }
+
+    results['flat_min_s'], results['flat_mean_s'] = timeit(
+        lambda: average_model(args, model_avg, model_all, aggregator=aggregator), opts.repeat)
+    if not opts.skip_legacy:
+        results['legacy_min_s'], results['legacy_mean_s'] = timeit(
+            lambda: legacy_average_model(args, model_avg, model_all), opts.repeat)
+        results['speedup'] = results['legacy_min_s'] / results['flat_min_s']
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
@@ -0,0 +1,135 @@
+# --------------------------------------------------------
+# Benchmark: MAE pre-training augmentation of a batch,
+# per-image PIL transforms vs. --batch_aug (uint8 load + batched tensor ops),
+# with the statistics of both outputs
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from synthetic_data import synthetic_image
+from util.batch_transforms import BatchRandomResizedCrop
+from util.datasets import BatchAugmentationForMAE, DataAugmentationForPretrain
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Batched MAE augmentation benchmark', add_help=False)
+    parser.add_argument('--data_set', default='Retina', type=str, choices=['Retina', 'COVIDfl', 'Derm'])
+    parser.add_argument('--image_size', default=256, type=int,
+                        help='side of the synthetic images (above the crop max_source_size they are downsized on load)')
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--stat_samples', default=2048, type=int,
+                        help='augmented samples per pipeline for the output statistics')
+    parser.add_argument('--device', default='cpu', type=str)
+    return parser.parse_args(argv)
+
+
+def augmentation_args(opts, batch_aug):
+    return argparse.Namespace(data_set=opts.data_set, model_name='mae', input_size=opts.input_size,
+                              batch_aug=batch_aug)
+
+
+def output_stats(batches):
+    """ Mean and spread of the per-image channel means and standard deviations. """
+    x = torch.cat(batches)
+    means = x.mean(dim=(2, 3))
+    stds = x.std(dim=(2, 3))
+    return {
+        'channel_mean': means.mean(0).tolist(),
+        'channel_mean_std': means.std(0).tolist(),
+        'channel_std': stds.mean(0).tolist(),
+        'channel_std_std': stds.std(0).tolist(),
+    }
+
+
+def run(opts):
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    device = torch.device(opts.device)
+    images = [Image.fromarray(np.uint8(synthetic_image(rng, i % 2, 2, opts.image_size)))
+              for i in range(opts.batch_size)]
+
+    per_image = DataAugmentationForPretrain(augmentation_args(opts, False))
+    loader = DataAugmentationForPretrain(augmentation_args(opts, True))
+    batch_aug = BatchAugmentationForMAE(augmentation_args(opts, True))
+
+    def pil_batch():
+        return default_collate([per_image(img) for img in images]).to(device)
+
+    def load_batch():
+        # the DataLoader worker side
+        return BatchAugmentationForMAE.collate([(loader(img), 0) for img in images])[0]
+
+    def augment_batch(loaded):
+        images_, sizes, loaded_sizes = loaded
+        return batch_aug(images_.to(device), sizes, loaded_sizes)
+
+    def timed(fn, *fn_args):
+        fn(*fn_args)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(opts.steps):
+            fn(*fn_args)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / opts.steps
+
+    loaded = load_batch()
+    results = {
+        'benchmark': 'batch_aug',
+        'data_set': opts.data_set,
+        'batch_size': opts.batch_size,
+        'image_size': opts.image_size,
+        'max_source_size': batch_aug.crop.max_source_size,
+        'loaded_size': list(loaded[0].shape[2:]),
+        'device': opts.device,
+        'pil_batch_ms': timed(pil_batch) * 1e3,
+        'batch_aug_load_ms': timed(load_batch) * 1e3,
+        'batch_aug_transform_ms': timed(augment_batch, loaded) * 1e3,
+    }
+    results['batch_aug_batch_ms'] = results['batch_aug_load_ms'] + results['batch_aug_transform_ms']
+    for name in ('pil', 'batch_aug'):
+        results['%s_images_per_s' % name] = opts.batch_size / results['%s_batch_ms' % name] * 1e3
+    # > 1 is a gain; the load part runs in the DataLoader workers, the transform part on the device
+    results['speedup'] = results['pil_batch_ms'] / results['batch_aug_batch_ms']
+
+    num_batches = max(1, opts.stat_samples // opts.batch_size)
+    results['pil_stats'] = output_stats([pil_batch().cpu() for _ in range(num_batches)])
+    results['batch_aug_stats'] = output_stats([augment_batch(loaded).cpu() for _ in range(num_batches)])
+    results['channel_mean_max_diff'] = max(abs(a - b) for a, b in zip(results['pil_stats']['channel_mean'],
+                                                                      results['batch_aug_stats']['channel_mean']))
+
+    # crop boxes drawn per image by torchvision vs. in one batch, relative to the image side
+    crop = batch_aug.crop
+    sizes = torch.tensor([[opts.image_size, opts.image_size]] * opts.stat_samples)
+    boxes = {'pil': torch.tensor([transforms.RandomResizedCrop.get_params(images[0], crop.scale, crop.ratio)
+                                  for _ in range(opts.stat_samples)], dtype=torch.float),
+             'batch_aug': torch.stack(BatchRandomResizedCrop.get_params(crop, sizes), dim=1)}
+    for name, box in boxes.items():
+        box = box / opts.image_size
+        results['%s_crop_ijhw_mean' % name] = box.mean(0).tolist()
+        results['%s_crop_ijhw_std' % name] = box.std(0).tolist()
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
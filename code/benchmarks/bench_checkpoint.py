@@ -0,0 +1,77 @@
+# --------------------------------------------------------
+# Benchmark: checkpoint save / load time
+# misc.save_model / misc.load_model of a ViT with its AdamW state
+# --------------------------------------------------------
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import torch
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from util import misc
+from benchmarks.bench_aggregation import ViTLikeBlocks
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Checkpoint benchmark', add_help=False)
+    parser.add_argument('--embed_dim', default=384, type=int, help='384 / 12 matches ViT-Small')
+    parser.add_argument('--depth', default=12, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--output_dir', default=None, type=str,
+                        help='directory of the checkpoints (default: a temporary one)')
+    return parser.parse_args(argv)
+
+
+def run(opts):
+    torch.manual_seed(0)
+    model = ViTLikeBlocks(opts.embed_dim, opts.depth)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    # one step so the optimizer state (exp_avg, exp_avg_sq) is part of the checkpoint
+    sum(p.sum() for p in model.parameters()).backward()
+    optimizer.step()
+    loss_scaler = misc.NativeScalerWithGradNormCount()
+
+    temporary = opts.output_dir is None
+    output_dir = tempfile.mkdtemp(prefix='checkpoint_') if temporary else opts.output_dir
+    args = argparse.Namespace(output_dir=output_dir, resume=os.path.join(output_dir, 'checkpoint-0.pth'),
+                              start_epoch=0, model_ema=False)
+
+    save_times, load_times = [], []
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(opts.repeat):
+                start = time.perf_counter()
+                misc.save_model(args, 0, model, model, optimizer, loss_scaler)
+                save_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                misc.load_model(args, model, optimizer, loss_scaler)
+                load_times.append(time.perf_counter() - start)
+        finally:
+            sys.stdout = stdout
+
+    results = {
+        'benchmark': 'checkpoint',
+        'n_parameters': sum(p.numel() for p in model.parameters()),
+        'checkpoint_bytes': os.path.getsize(args.resume),
+        'save_min_s': min(save_times),
+        'load_min_s': min(load_times),
+    }
+    if temporary:
+        shutil.rmtree(output_dir)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
@@ -0,0 +1,97 @@
+# --------------------------------------------------------
+# Benchmark: Dirichlet non-IID split time vs. dataset size and client count
+# legacy list-based non_iid_split_dirichlet vs. the array-based one
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from data_split import non_iid_split_dirichlet
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Dirichlet split benchmark', add_help=False)
+    parser.add_argument('--sizes', default=[10000, 100000, 1000000], type=int, nargs='+',
+                        help='number of images')
+    parser.add_argument('--n_clients', default=[10, 100, 500], type=int, nargs='+')
+    parser.add_argument('--n_classes', default=10, type=int)
+    parser.add_argument('--beta', default=0.5, type=float)
+    parser.add_argument('--legacy_max_size', default=1000000, type=int,
+                        help='skip the legacy splitter above this many images')
+    return parser.parse_args(argv)
+
+
+def legacy_non_iid_split_dirichlet(y_train, n_clients, n_classes, beta=0.4):
+    """ non_iid_split_dirichlet before the array-based version, kept here as the reference. """
+    min_size = 0
+    min_require_size = 10
+
+    N = y_train.shape[0]
+    np.random.seed(2022)
+    net_dataidx_map = {}
+
+    while min_size < min_require_size:
+        idx_batch = [[] for _ in range(n_clients)]
+        for k in range(n_classes):
+            idx_k = np.where(y_train == k)[0]
+            np.random.shuffle(idx_k)
+            proportions = np.random.dirichlet(np.repeat(beta, n_clients))
+            proportions = np.array([p * (len(idx_j) < N / n_clients) for p, idx_j in zip(proportions, idx_batch)])
+            proportions = proportions / proportions.sum()
+            proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
+            idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
+            min_size = min([len(idx_j) for idx_j in idx_batch])
+
+    for j in range(n_clients):
+        np.random.shuffle(idx_batch[j])
+        net_dataidx_map[j] = idx_batch[j]
+
+    return net_dataidx_map
+
+
+def run(opts):
+    rng = np.random.RandomState(0)
+    results = {
+        'benchmark': 'data_split',
+        'n_classes': opts.n_classes,
+        'beta': opts.beta,
+        'runs': [],
+    }
+    for size in opts.sizes:
+        y_train = rng.randint(0, opts.n_classes, size=size).astype(np.float64)
+        for n_clients in opts.n_clients:
+            if size < 10 * n_clients:
+                continue
+            run_results = {'size': size, 'n_clients': n_clients}
+            start = time.perf_counter()
+            try:
+                split = non_iid_split_dirichlet(y_train, n_clients, opts.n_classes, opts.beta)
+            except ValueError as e:
+                # the legacy splitter would retry forever
+                run_results['error'] = str(e)
+                results['runs'].append(run_results)
+                continue
+            run_results['array_s'] = time.perf_counter() - start
+            if size <= opts.legacy_max_size:
+                start = time.perf_counter()
+                reference = legacy_non_iid_split_dirichlet(y_train, n_clients, opts.n_classes, opts.beta)
+                run_results['legacy_s'] = time.perf_counter() - start
+                run_results['speedup'] = run_results['legacy_s'] / run_results['array_s']
+                run_results['identical'] = all(np.array_equal(split[j], reference[j]) for j in range(n_clients))
+            results['runs'].append(run_results)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# Benchmark: DatasetFLPretrain.__getitem__ latency
+# MAE and BEiT pre-training samples from a synthetic data directory
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from synthetic_data import make_synthetic_dataset
+from util.data_utils import DatasetFLPretrain
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Pre-training dataset benchmark', add_help=False)
+    parser.add_argument('--num_images', default=64, type=int)
+    parser.add_argument('--image_size', default=256, type=int, help='side of the synthetic PNG images')
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--second_input_size', default=112, type=int)
+    parser.add_argument('--mask_mode', default='sample', type=str, choices=['sample', 'batch', 'bank'])
+    parser.add_argument('--num_samples', default=256, type=int)
+    parser.add_argument('--warmup', default=8, type=int)
+    parser.add_argument('--data_path', default=None, type=str,
+                        help='existing synthetic data directory (default: a temporary one)')
+    return parser.parse_args(argv)
+
+
+def dataset_args(opts, model_name):
+    return argparse.Namespace(
+        data_path=opts.data_path, data_set='COVIDfl', split_type='central', n_clients=1,
+        single_client='train.csv', model_name=model_name, input_size=opts.input_size,
+        second_input_size=opts.second_input_size, train_interpolation='bicubic',
+        second_interpolation='lanczos', discrete_vae_type='dall-e', mask_ratio=0.4,
+        max_mask_patches_per_block=None, min_mask_patches_per_block=16,
+        window_size=(opts.input_size // 16, opts.input_size // 16),
+        mask_mode=opts.mask_mode, mask_bank_size=4096, image_cache=False, token_cache=False, shards=False,
+        batch_aug=False, num_workers=0)
+
+
+def latencies(dataset, num_samples, warmup):
+    for i in range(warmup):
+        dataset[i]
+    times = np.empty(num_samples)
+    for i in range(num_samples):
+        start = time.perf_counter()
+        dataset[i]
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def run(opts):
+    temporary = opts.data_path is None
+    if temporary:
+        opts.data_path = tempfile.mkdtemp(prefix='fl_data_')
+    if not os.path.exists(os.path.join(opts.data_path, 'labels.csv')):
+        make_synthetic_dataset(opts.data_path, num_train=opts.num_images, num_test=0,
+                               image_size=opts.image_size, image_format='png', n_clients=1, beta_list=[])
+
+    results = {
+        'benchmark': 'dataset',
+        'num_images': opts.num_images,
+        'image_size': opts.image_size,
+        'input_size': opts.input_size,
+        'mask_mode': opts.mask_mode,
+    }
+    for model_name in ('mae', 'beit'):
+        start = time.perf_counter()
+        dataset = DatasetFLPretrain(dataset_args(opts, model_name))
+        results['%s_build_s' % model_name] = time.perf_counter() - start
+        times = latencies(dataset, opts.num_samples, opts.warmup)
+        results['%s_getitem_mean_ms' % model_name] = float(times.mean() * 1e3)
+        results['%s_getitem_p50_ms' % model_name] = float(np.percentile(times, 50) * 1e3)
+        results['%s_getitem_p95_ms' % model_name] = float(np.percentile(times, 95) * 1e3)
+        results['%s_samples_per_s' % model_name] = float(len(times) / times.sum())
+
+    if temporary:
+        shutil.rmtree(opts.data_path)
+        opts.data_path = None
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
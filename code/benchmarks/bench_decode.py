@@ -0,0 +1,91 @@
+# --------------------------------------------------------
+# Benchmark: DatasetFLFinetune.__getitem__ latency for RGB images
+# uint8 decode (PIL draft mode, one resize) vs. the float skimage resize
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from skimage.transform import resize
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from synthetic_data import make_synthetic_dataset
+from util.data_utils import DatasetFLFinetune
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Fine-tuning decode benchmark', add_help=False)
+    parser.add_argument('--num_images', default=32, type=int)
+    parser.add_argument('--image_size', default=1024, type=int, help='side of the synthetic images')
+    parser.add_argument('--image_formats', default=['jpg', 'png'], nargs='+', choices=['jpg', 'png'])
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--num_samples', default=64, type=int)
+    parser.add_argument('--warmup', default=4, type=int)
+    return parser.parse_args(argv)
+
+
+class LegacyDatasetFLFinetune(DatasetFLFinetune):
+    """ DatasetFLFinetune with the decode path before the uint8 one, kept here as the reference. """
+    def load_image(self, name):
+        path = os.path.join(self.args.data_path, self.phase, name)
+        img = np.array(Image.open(path).convert("RGB"))
+        img = resize(img, (224, 224))
+        return Image.fromarray(np.uint8(img))
+
+
+def dataset_args(data_path, opts):
+    return argparse.Namespace(
+        data_path=data_path, data_set='COVIDfl', split_type='central', n_clients=1,
+        single_client='train.csv', input_size=opts.input_size, image_cache=False, shards=False,
+        num_workers=0)
+
+
+def latencies(dataset, num_samples, warmup):
+    for i in range(warmup):
+        dataset[i]
+    times = np.empty(num_samples)
+    for i in range(num_samples):
+        start = time.perf_counter()
+        dataset[i]
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def run(opts):
+    results = {
+        'benchmark': 'decode',
+        'num_images': opts.num_images,
+        'image_size': opts.image_size,
+        'input_size': opts.input_size,
+    }
+    for image_format in opts.image_formats:
+        data_path = tempfile.mkdtemp(prefix='fl_data_')
+        make_synthetic_dataset(data_path, num_train=opts.num_images, num_test=opts.num_images,
+                               image_size=opts.image_size, image_format=image_format, n_clients=1, beta_list=[])
+        for phase in ('train', 'test'):
+            for name, dataset_class in (('uint8', DatasetFLFinetune), ('legacy', LegacyDatasetFLFinetune)):
+                times = latencies(dataset_class(dataset_args(data_path, opts), phase), opts.num_samples, opts.warmup)
+                key = '%s_%s_%s' % (image_format, phase, name)
+                results[key + '_mean_ms'] = float(times.mean() * 1e3)
+                results[key + '_p95_ms'] = float(np.percentile(times, 95) * 1e3)
+            results['%s_%s_speedup' % (image_format, phase)] = \
+                results['%s_%s_legacy_mean_ms' % (image_format, phase)] / results['%s_%s_uint8_mean_ms' % (image_format, phase)]
+        shutil.rmtree(data_path)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
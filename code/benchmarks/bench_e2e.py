@@ -0,0 +1,154 @@
+# --------------------------------------------------------
+# Benchmark: end-to-end FedAvg rounds/sec on CPU
+# tiny Fed-MAE and Fed-BEiT pre-training + fine-tuning on a synthetic dataset
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import torch
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from synthetic_data import make_synthetic_dataset
+from util.dall_e.decoder import Decoder
+from util.dall_e.encoder import Encoder
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('End-to-end FedAvg benchmark', add_help=False)
+    parser.add_argument('--models', default=['mae', 'beit'], nargs='+', choices=['mae', 'beit'])
+    parser.add_argument('--num_train', default=64, type=int)
+    parser.add_argument('--num_test', default=16, type=int)
+    parser.add_argument('--image_size', default=256, type=int)
+    parser.add_argument('--image_format', default='npy', choices=['npy', 'png'], type=str)
+    parser.add_argument('--n_clients', default=2, type=int)
+    parser.add_argument('--beta', default=0.5, type=float, help='Dirichlet skew of the client split')
+    parser.add_argument('--rounds', default=2, type=int)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--data_path', default=None, type=str,
+                        help='existing synthetic data directory (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary data and outputs')
+    parser.add_argument('--extra', default=[], nargs=argparse.REMAINDER,
+                        help='further arguments passed to every runner (e.g. --client_pool)')
+    return parser.parse_args(argv)
+
+
+def write_random_dalle(weight_path, n_hid=64):
+    """ Randomly initialized DALL-E tokenizer pickles, in place of the released weights. """
+    os.makedirs(weight_path, exist_ok=True)
+    torch.save(Encoder(n_hid=n_hid, use_mixed_precision=False), os.path.join(weight_path, 'encoder.pkl'))
+    torch.save(Decoder(n_hid=n_hid, use_mixed_precision=False), os.path.join(weight_path, 'decoder.pkl'))
+
+
+def round_times(trace_path):
+    """ Wall-clock span of every round in a RoundProfiler trace. """
+    with open(trace_path) as f:
+        events = json.load(f)['traceEvents']
+    spans = defaultdict(lambda: [float('inf'), 0.])
+    for event in events:
+        round_ = event.get('args', {}).get('round')
+        if event['ph'] == 'X' and round_ is not None:
+            spans[round_][0] = min(spans[round_][0], event['ts'])
+            spans[round_][1] = max(spans[round_][1], event['ts'] + event['dur'])
+    return [(end - start) / 1e6 for start, end in spans.values()]
+
+
+def run_runner(name, script, argv, output_dir):
+    """ Run one runner to completion; returns its timings. """
+    start = time.perf_counter()
+    with open(os.path.join(output_dir, 'stdout.txt'), 'w') as f:
+        returncode = subprocess.call([sys.executable, os.path.basename(script)] + argv,
+                                     cwd=os.path.dirname(script), stdout=f, stderr=subprocess.STDOUT)
+    results = {'runner': name, 'wall_s': time.perf_counter() - start, 'returncode': returncode}
+    trace_path = os.path.join(output_dir, 'profile_trace.json')
+    if returncode == 0 and os.path.exists(trace_path):
+        times = round_times(trace_path)
+        results['rounds'] = len(times)
+        results['round_mean_s'] = sum(times) / len(times)
+        results['rounds_per_s'] = len(times) / sum(times)
+    return results
+
+
+def run(opts):
+    temporary = opts.data_path is None
+    work_dir = tempfile.mkdtemp(prefix='fl_e2e_')
+    data_path = os.path.join(work_dir, 'data') if temporary else opts.data_path
+    data_set = 'Retina' if opts.image_format == 'npy' else 'COVIDfl'
+
+    start = time.perf_counter()
+    if not os.path.exists(os.path.join(data_path, 'labels.csv')):
+        make_synthetic_dataset(data_path, num_train=opts.num_train, num_test=opts.num_test,
+                               image_size=opts.image_size, image_format=opts.image_format,
+                               n_clients=opts.n_clients, beta_list=[opts.beta])
+    data_s = time.perf_counter() - start
+
+    common = ['--data_path', data_path, '--data_set', data_set, '--split_type', 'split_1',
+              '--n_clients', str(opts.n_clients), '--E_epoch', '1', '--num_local_clients', '-1',
+              '--max_communication_rounds', str(opts.rounds), '--save_ckpt_freq', str(opts.rounds),
+              '--batch_size', str(opts.batch_size), '--warmup_epochs', '0', '--num_workers', '0',
+              '--no_pin_mem', '--device', 'cpu', '--seed', '0', '--profile']
+    runners = []
+    if 'mae' in opts.models:
+        runners += [
+            ('mae_pretrain', os.path.join(parent, 'fed_mae', 'run_mae_pretrain_FedAvg.py'),
+             ['--model', 'mae_vit_tiny_patch16', '--mask_ratio', '0.75']),
+            ('mae_finetune', os.path.join(parent, 'fed_mae', 'run_class_finetune_FedAvg.py'),
+             ['--model', 'vit_tiny_patch16', '--nb_classes', '2', '--finetune', 'mae_pretrain']),
+        ]
+    if 'beit' in opts.models:
+        weight_path = os.path.join(work_dir, 'tokenizer_weight')
+        write_random_dalle(weight_path)
+        runners += [
+            ('beit_pretrain', os.path.join(parent, 'fed_beit', 'run_beit_pretrain_FedAvg.py'),
+             ['--model', 'beit_tiny_patch16_224_8k_vocab', '--discrete_vae_weight_path', weight_path,
+              '--no_auto_resume']),
+            ('beit_finetune', os.path.join(parent, 'fed_beit', 'run_class_finetune_FedAvg.py'),
+             ['--model', 'beit_tiny_patch16_224', '--nb_classes', '2', '--finetune', 'beit_pretrain',
+              '--no_auto_resume']),
+        ]
+
+    results = {
+        'benchmark': 'e2e',
+        'data_set': data_set,
+        'num_train': opts.num_train,
+        'n_clients': opts.n_clients,
+        'rounds': opts.rounds,
+        'batch_size': opts.batch_size,
+        'data_s': data_s,
+        'runners': [],
+    }
+    for name, script, argv in runners:
+        output_dir = os.path.join(work_dir, name)
+        os.makedirs(output_dir, exist_ok=True)
+        if '--finetune' in argv:
+            # fine-tune from the last global checkpoint of the matching pre-training run
+            i = argv.index('--finetune') + 1
+            argv = argv[:i] + [os.path.join(work_dir, argv[i], 'checkpoint-%d.pth' % (opts.rounds - 1))] + argv[i + 1:]
+        runner_results = run_runner(name, script, common + argv + ['--output_dir', output_dir] + opts.extra,
+                                    output_dir)
+        if runner_results['returncode'] != 0:
+            runner_results['log'] = os.path.join(output_dir, 'stdout.txt')
+        results['runners'].append(runner_results)
+
+    if opts.keep or any(r['returncode'] != 0 for r in results['runners']):
+        results['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
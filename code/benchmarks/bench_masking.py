@@ -0,0 +1,80 @@
+# --------------------------------------------------------
+# Benchmark: BEiT block-wise masks per second
+# MaskingGenerator (one mask per call) vs. BatchMaskingGenerator vs. MaskBank
+# --------------------------------------------------------
+
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from util.masking_generator import MaskingGenerator, BatchMaskingGenerator, MaskBank
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('BEiT masking benchmark', add_help=False)
+    parser.add_argument('--window_size', default=14, type=int)
+    parser.add_argument('--mask_ratio', default=0.4, type=float)
+    parser.add_argument('--min_mask_patches_per_block', default=16, type=int)
+    parser.add_argument('--max_mask_patches_per_block', default=None, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_masks', default=4096, type=int)
+    parser.add_argument('--bank_size', default=65536, type=int)
+    return parser.parse_args(argv)
+
+
+def masks_per_s(fn, num_masks, batch_size):
+    start = time.perf_counter()
+    for _ in range(num_masks // batch_size):
+        fn()
+    return (num_masks // batch_size) * batch_size / (time.perf_counter() - start)
+
+
+def run(opts):
+    random.seed(0)
+    num_mask_patches = int(round((opts.mask_ratio * opts.window_size ** 2) / 5.0) * 5.0)
+    kwargs = dict(num_masking_patches=num_mask_patches,
+                  min_num_patches=opts.min_mask_patches_per_block,
+                  max_num_patches=opts.max_mask_patches_per_block)
+    generator = MaskingGenerator(opts.window_size, **kwargs)
+    batch_generator = BatchMaskingGenerator(opts.window_size, **kwargs)
+
+    start = time.perf_counter()
+    bank = MaskBank(batch_generator, opts.bank_size)
+    bank_build_s = time.perf_counter() - start
+
+    # the generators should agree in distribution: compare masked patches per mask
+    reference = np.stack([generator() for _ in range(1000)])
+    batched = batch_generator(1000)
+
+    results = {
+        'benchmark': 'masking',
+        'num_mask_patches': num_mask_patches,
+        'batch_size': opts.batch_size,
+        'mean_masked_loop': float(reference.sum((1, 2)).mean()),
+        'mean_masked_batch': float(batched.sum((1, 2)).mean()),
+        'max_abs_patch_freq_diff': float(np.abs(reference.mean(0) - batched.mean(0)).max()),
+        'bank_build_s': bank_build_s,
+        'loop_masks_per_s': masks_per_s(generator, opts.num_masks, 1),
+        'batch_masks_per_s': masks_per_s(lambda: batch_generator(opts.batch_size),
+                                         opts.num_masks, opts.batch_size),
+        'bank_masks_per_s': masks_per_s(lambda: bank(opts.batch_size), opts.num_masks, opts.batch_size),
+        'bank_single_masks_per_s': masks_per_s(bank, opts.num_masks, 1),
+    }
+    results['batch_speedup'] = results['batch_masks_per_s'] / results['loop_masks_per_s']
+    results['bank_speedup'] = results['bank_masks_per_s'] / results['loop_masks_per_s']
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
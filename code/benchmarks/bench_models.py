@@ -0,0 +1,108 @@
+# --------------------------------------------------------
+# Benchmark: forward throughput of the pre-training models
+# MAE MaskedAutoencoderViT vs. BEiT VisionTransformerForMaskedImageModeling
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from fed_beit.modeling_pretrain import VisionTransformerForMaskedImageModeling
+from fed_mae.models_mae import MaskedAutoencoderViT
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Pre-training model forward benchmark', add_help=False)
+    parser.add_argument('--embed_dim', default=192, type=int, help='192 / 12 matches ViT-Tiny')
+    parser.add_argument('--depth', default=12, type=int)
+    parser.add_argument('--decoder_embed_dim', default=128, type=int)
+    parser.add_argument('--decoder_depth', default=2, type=int)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float, help='MAE mask ratio')
+    parser.add_argument('--num_mask_patches', default=75, type=int, help='BEiT masked patches per image')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--train', action='store_true', help='time forward + backward instead of forward only')
+    parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads (default: torch default)')
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args(argv)
+
+
+def images_per_s(fn, steps, warmup, batch_size, train):
+    with torch.set_grad_enabled(train):
+        for _ in range(warmup):
+            fn()
+        start = time.perf_counter()
+        for _ in range(steps):
+            fn()
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def run(opts):
+    torch.manual_seed(0)
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+    device = torch.device(opts.device)
+    num_heads = max(1, opts.embed_dim // 64)
+    norm_layer = partial(nn.LayerNorm, eps=1e-6)
+
+    mae = MaskedAutoencoderViT(
+        img_size=opts.input_size, patch_size=16, embed_dim=opts.embed_dim, depth=opts.depth,
+        num_heads=num_heads, decoder_embed_dim=opts.decoder_embed_dim, decoder_depth=opts.decoder_depth,
+        decoder_num_heads=max(1, opts.decoder_embed_dim // 32), mlp_ratio=4,
+        norm_layer=norm_layer).to(device)
+    beit = VisionTransformerForMaskedImageModeling(
+        img_size=opts.input_size, patch_size=16, embed_dim=opts.embed_dim, depth=opts.depth,
+        num_heads=num_heads, mlp_ratio=4, qkv_bias=True, norm_layer=norm_layer, vocab_size=8192,
+        use_shared_rel_pos_bias=True, use_abs_pos_emb=False, init_values=0.1).to(device)
+    mae.train(opts.train)
+    beit.train(opts.train)
+
+    num_patches = (opts.input_size // 16) ** 2
+    samples = torch.randn(opts.batch_size, 3, opts.input_size, opts.input_size, device=device)
+    bool_masked_pos = torch.zeros(opts.batch_size, num_patches, dtype=torch.bool)
+    for row in bool_masked_pos:
+        row[torch.randperm(num_patches)[:opts.num_mask_patches]] = True
+    bool_masked_pos = bool_masked_pos.to(device)
+
+    def mae_step():
+        loss, _, _ = mae(samples, mask_ratio=opts.mask_ratio)
+        if opts.train:
+            loss.backward()
+
+    def beit_step():
+        outputs = beit(samples, bool_masked_pos=bool_masked_pos, return_all_tokens=False)
+        if opts.train:
+            outputs.float().mean().backward()
+
+    results = {
+        'benchmark': 'models',
+        'mode': 'train' if opts.train else 'forward',
+        'embed_dim': opts.embed_dim,
+        'depth': opts.depth,
+        'input_size': opts.input_size,
+        'batch_size': opts.batch_size,
+        'threads': torch.get_num_threads(),
+        'mae_n_parameters': sum(p.numel() for p in mae.parameters()),
+        'beit_n_parameters': sum(p.numel() for p in beit.parameters()),
+    }
+    results['mae_images_per_s'] = images_per_s(mae_step, opts.steps, opts.warmup, opts.batch_size, opts.train)
+    results['beit_images_per_s'] = images_per_s(beit_step, opts.steps, opts.warmup, opts.batch_size, opts.train)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
@@ -0,0 +1,82 @@
+# --------------------------------------------------------
+# Benchmark: cosine_scheduler build time
+# schedules of every client for a whole FedAvg run
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from util import misc
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Cosine scheduler benchmark', add_help=False)
+    parser.add_argument('--n_clients', default=5, type=int)
+    parser.add_argument('--niter_per_ep', default=500, type=int, help='mean local steps per epoch of a client')
+    parser.add_argument('--E_epoch', default=1, type=int)
+    parser.add_argument('--max_communication_rounds', default=100, type=int)
+    parser.add_argument('--warmup_epochs', default=5, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    return parser.parse_args(argv)
+
+
+def build_all(opts, steps):
+    """ lr and wd schedules of every client, as the runners build them. """
+    return [(misc.cosine_scheduler(1.5e-4, 1e-6, opts.E_epoch, n, opts.max_communication_rounds,
+                                   warmup_epochs=opts.warmup_epochs),
+             misc.cosine_scheduler(0.05, 0.05, opts.E_epoch, n, opts.max_communication_rounds))
+            for n in steps]
+
+
+def timeit(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(opts):
+    rng = np.random.RandomState(0)
+    steps = rng.randint(opts.niter_per_ep // 2, opts.niter_per_ep * 3 // 2, size=opts.n_clients)
+    schedules = build_all(opts, steps)
+    lr_schedule = schedules[0][0]
+
+    results = {
+        'benchmark': 'scheduler',
+        'n_clients': opts.n_clients,
+        'schedule_len_total': int(sum(len(lr) + len(wd) for lr, wd in schedules)),
+    }
+    # cosine_scheduler prints the warmup of every schedule it builds
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            results['build_s'] = timeit(lambda: build_all(opts, steps), opts.repeat,
+                                        setup=misc._cosine_schedules.clear)
+            results['cached_build_s'] = timeit(lambda: build_all(opts, steps), opts.repeat)
+        finally:
+            sys.stdout = stdout
+    results['materialize_s'] = timeit(lambda: [(np.asarray(lr), np.asarray(wd)) for lr, wd in schedules],
+                                      opts.repeat)
+    its = np.arange(len(lr_schedule))
+    results['lookup_ns'] = timeit(lambda: [lr_schedule[it] for it in its[:10000]], opts.repeat) / \
+        min(10000, len(its)) * 1e9
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
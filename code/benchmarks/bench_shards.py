@@ -0,0 +1,113 @@
+# --------------------------------------------------------
+# Benchmark: image read throughput, one file per image vs. shard store
+# random access (shuffled, as a DataLoader reads) and whole-shard streaming
+# --------------------------------------------------------
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(os.path.join(os.path.dirname(parent), 'data'))
+
+from synthetic_data import make_synthetic_dataset
+from util.shard_store import ShardStore, pack_shards
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('Shard store benchmark', add_help=False)
+    parser.add_argument('--num_images', default=2000, type=int)
+    parser.add_argument('--image_size', default=256, type=int)
+    parser.add_argument('--image_format', default='png', choices=['npy', 'png'], type=str)
+    parser.add_argument('--shard_size_mb', default=64, type=int)
+    parser.add_argument('--decode', action='store_true',
+                        help='also decode every image (np.load / PIL), as the datasets do')
+    parser.add_argument('--data_path', default=None, type=str,
+                        help='existing synthetic data directory (default: a temporary one); '
+                             'point it at a network filesystem to measure the small-file cost')
+    return parser.parse_args(argv)
+
+
+def decode(f, image_format):
+    if image_format == 'npy':
+        return np.load(f)
+    return np.array(Image.open(f).convert('RGB'))
+
+
+def throughput(read, names, image_format, do_decode):
+    start = time.perf_counter()
+    num_bytes = 0
+    for name in names:
+        data = read(name)
+        num_bytes += len(data)
+        if do_decode:
+            decode(io.BytesIO(data), image_format)
+    elapsed = time.perf_counter() - start
+    return {'images_per_s': len(names) / elapsed, 'mb_per_s': num_bytes / elapsed / 2 ** 20}
+
+
+def run(opts):
+    temporary = opts.data_path is None
+    if temporary:
+        opts.data_path = tempfile.mkdtemp(prefix='fl_data_')
+    if not os.path.exists(os.path.join(opts.data_path, 'labels.csv')):
+        make_synthetic_dataset(opts.data_path, num_train=opts.num_images, num_test=0, image_size=opts.image_size,
+                               image_format=opts.image_format, n_clients=1, beta_list=[])
+    shard_dir = tempfile.mkdtemp(prefix='fl_shards_')
+
+    train_path = os.path.join(opts.data_path, 'train')
+    names = sorted(os.listdir(train_path))
+    image_format = os.path.splitext(names[0])[1][1:]
+    shuffled = list(np.random.RandomState(0).permutation(names))
+
+    start = time.perf_counter()
+    pack_shards(opts.data_path, 'train', shard_dir, shard_size=opts.shard_size_mb << 20)
+    pack_s = time.perf_counter() - start
+    store = ShardStore(shard_dir, 'train')
+
+    def read_file(name):
+        with open(os.path.join(train_path, name), 'rb') as f:
+            return f.read()
+
+    results = {
+        'benchmark': 'shards',
+        'num_images': len(names),
+        'image_format': image_format,
+        'num_shards': store.num_shards,
+        'decode': opts.decode,
+        'pack_s': pack_s,
+        'files_random': throughput(read_file, shuffled, image_format, opts.decode),
+        'shards_random': throughput(store.read, shuffled, image_format, opts.decode),
+    }
+    start = time.perf_counter()
+    num_bytes = 0
+    for k in range(store.num_shards):
+        for _, data in store.read_shard(k):
+            num_bytes += len(data)
+            if opts.decode:
+                decode(io.BytesIO(data), image_format)
+    elapsed = time.perf_counter() - start
+    results['shards_stream'] = {'images_per_s': len(names) / elapsed, 'mb_per_s': num_bytes / elapsed / 2 ** 20}
+    results['random_speedup'] = results['shards_random']['images_per_s'] / results['files_random']['images_per_s']
+
+    shutil.rmtree(shard_dir)
+    if temporary:
+        shutil.rmtree(opts.data_path)
+        opts.data_path = None
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
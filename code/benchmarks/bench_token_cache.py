@@ -0,0 +1,137 @@
+# --------------------------------------------------------
+# Benchmark: Fed-BEiT pre-training steps/sec
+# dVAE tokenizer in the training step vs. TokenCache lookup
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from fed_beit.modeling_pretrain import VisionTransformerForMaskedImageModeling
+from util.dall_e.encoder import Encoder
+from util.modeling_discrete_vae import Dalle_VAE
+from util.token_cache import TokenCache
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser('BEiT token cache benchmark', add_help=False)
+    parser.add_argument('--embed_dim', default=768, type=int, help='768 / 12 matches BEiT-Base')
+    parser.add_argument('--depth', default=12, type=int)
+    parser.add_argument('--n_hid', default=256, type=int, help='width of the DALL-E encoder (256 as released)')
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--second_input_size', default=112, type=int)
+    parser.add_argument('--num_mask_patches', default=75, type=int)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_images', default=32, type=int)
+    parser.add_argument('--num_views', default=4, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args(argv)
+
+
+def build_cache(d_vae, images, num_views, batch_size, cache_dir):
+    """ Tokenize every (image, view) into a TokenCache file, as util.token_cache does offline. """
+    num_images = len(images)
+    meta = {'num_images': num_images, 'num_views': num_views, 'seed': 0}
+    path = os.path.join(cache_dir, 'tokens.u16')
+    tokens = None
+    with torch.no_grad():
+        for view in range(num_views):
+            for start in range(0, num_images, batch_size):
+                input_ids = d_vae.get_codebook_indices(images[start: start + batch_size]).flatten(1)
+                if tokens is None:
+                    meta['num_tokens'] = input_ids.shape[1]
+                    tokens = np.memmap(path, dtype=np.uint16, mode='w+',
+                                       shape=(num_images, num_views, meta['num_tokens']))
+                tokens[start: start + batch_size, view] = input_ids.cpu().numpy().astype(np.uint16)
+    tokens.flush()
+    del tokens
+    return TokenCache(path, meta)
+
+
+def run(opts):
+    torch.manual_seed(0)
+    device = torch.device(opts.device)
+
+    model = VisionTransformerForMaskedImageModeling(
+        img_size=opts.input_size, patch_size=16, embed_dim=opts.embed_dim, depth=opts.depth,
+        num_heads=max(1, opts.embed_dim // 64), mlp_ratio=4, qkv_bias=True,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6), vocab_size=8192,
+        use_shared_rel_pos_bias=True, use_abs_pos_emb=False, init_values=0.1).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+
+    d_vae = Dalle_VAE(opts.second_input_size)
+    d_vae.encoder = Encoder(n_hid=opts.n_hid, device=device).eval()
+
+    num_patches = (opts.input_size // 16) ** 2
+    samples = torch.randn(opts.num_images, 3, opts.input_size, opts.input_size)
+    images = torch.rand(opts.num_images, 3, opts.second_input_size, opts.second_input_size)
+
+    cache_dir = tempfile.mkdtemp(prefix='token_cache_')
+    start = time.perf_counter()
+    token_cache = build_cache(d_vae, images.to(device), opts.num_views, opts.batch_size, cache_dir)
+    build_s = time.perf_counter() - start
+
+    rng = np.random.RandomState(0)
+
+    def step(use_cache):
+        ids = rng.choice(opts.num_images, opts.batch_size, replace=False)
+        batch = samples[ids].to(device)
+        bool_masked_pos = torch.zeros(opts.batch_size, num_patches, dtype=torch.bool)
+        for row in bool_masked_pos:
+            row[torch.randperm(num_patches)[:opts.num_mask_patches]] = True
+        bool_masked_pos = bool_masked_pos.to(device)
+
+        with torch.no_grad():
+            if use_cache:
+                views = rng.randint(opts.num_views, size=opts.batch_size)
+                input_ids = torch.from_numpy(token_cache[ids, views].astype(np.int64)).to(device)
+            else:
+                input_ids = d_vae.get_codebook_indices(images[ids].to(device)).flatten(1)
+            labels = input_ids[bool_masked_pos]
+
+        outputs = model(batch, bool_masked_pos=bool_masked_pos, return_all_tokens=False)
+        loss = criterion(input=outputs.float(), target=labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    results = {
+        'benchmark': 'token_cache',
+        'embed_dim': opts.embed_dim,
+        'depth': opts.depth,
+        'batch_size': opts.batch_size,
+        'cache_build_s': build_s,
+        'cache_bytes': int(np.prod(token_cache.shape)) * 2,
+    }
+    for name, use_cache in (('tokenizer', False), ('cache', True)):
+        for _ in range(opts.warmup):
+            step(use_cache)
+        start = time.perf_counter()
+        for _ in range(opts.steps):
+            step(use_cache)
+        results['%s_steps_per_s' % name] = opts.steps / (time.perf_counter() - start)
+    results['speedup'] = results['cache_steps_per_s'] / results['tokenizer_steps_per_s']
+    shutil.rmtree(cache_dir)
+
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    run(get_args())
@@ -0,0 +1,107 @@
+# --------------------------------------------------------
+# CPU micro-benchmark suite of the SSL-FL hot paths
+# Runs every benchmark with small configs and writes one JSON report
+# --------------------------------------------------------
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import json
+import platform
+import subprocess
+import time
+import traceback
+
+import numpy as np
+import torch
+
+import os
+import sys
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(current)
+
+# (benchmark module, argv) with configs small enough for a CPU-only box;
+# average_model is timed for a growing number of clients, bench_e2e runs the
+# four runners with tiny models on a synthetic dataset
+SUITE = [
+    ('bench_models', ['--embed_dim', '192', '--depth', '4', '--batch_size', '8', '--steps', '3']),
+    ('bench_masking', ['--num_masks', '2048', '--bank_size', '8192']),
+    ('bench_dataset', ['--num_images', '32', '--num_samples', '64']),
+    ('bench_scheduler', []),
+    ('bench_checkpoint', ['--embed_dim', '192', '--depth', '12']),
+    ('bench_data_split', ['--sizes', '10000', '100000', '--n_clients', '10', '100']),
+    ('bench_shards', ['--num_images', '500', '--decode']),
+    ('bench_decode', ['--num_images', '16', '--num_samples', '32']),
+    ('bench_batch_aug', ['--batch_size', '32', '--steps', '2', '--stat_samples', '256']),
+    ('bench_batch_aug', ['--batch_size', '32', '--steps', '2', '--stat_samples', '256', '--image_size', '1024']),
+] + [
+    ('bench_aggregation', ['--embed_dim', '192', '--depth', '12', '--n_clients', str(n), '--skip_legacy'])
+    for n in (2, 4, 8, 16, 32)
+] + [
+    ('bench_e2e', ['--rounds', '2']),
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser('SSL-FL benchmark suite', add_help=False)
+    parser.add_argument('--only', default=None, nargs='+', type=str,
+                        help='benchmark modules to run (default: all)')
+    parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads')
+    parser.add_argument('--output', default=None, type=str, help='also write the report to this json file')
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(name, argv):
+    """ Results dict of one benchmark; its own output goes to stderr. """
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(name)
+        with contextlib.redirect_stdout(sys.stderr):
+            results = module.run(module.get_args(argv))
+    except Exception as e:
+        traceback.print_exc()
+        results = {'benchmark': name, 'error': '%s: %s' % (type(e).__name__, e)}
+    results['argv'] = argv
+    results['wall_s'] = time.perf_counter() - start
+    return results
+
+
+def main(opts):
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'results': [],
+    }
+    for name, argv in SUITE:
+        if opts.only is None or name in opts.only:
+            print("Running %s %s" % (name, ' '.join(argv)), file=sys.stderr)
+            report['results'].append(run_benchmark(name, argv))
+
+    if opts.output is not None:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report))
+    return report
+
+
+if __name__ == '__main__':
+    main(get_args())
@@ -18,6 +18,7 @@ current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 import util.misc as misc
+from util.profiler import get_profiler
 
 
 def train_one_epoch(args, model: torch.nn.Module, d_vae: torch.nn.Module,
@@ -35,6 +36,7 @@ def train_one_epoch(args, model: torch.nn.Module, d_vae: torch.nn.Module,
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    profiler = get_profiler()
     
     metric_logger.log_every(data_loader, print_freq, header)
     
@@ -53,36 +55,35 @@ def train_one_epoch(args, model: torch.nn.Module, d_vae: torch.nn.Module,
         samples = samples.to(device, non_blocking=True)
         bool_masked_pos = bool_masked_pos.to(device, non_blocking=True)
 
-        with torch.no_grad():
-            input_ids = d_vae.get_codebook_indices(images).flatten(1)
+        with torch.no_grad(), profiler.phase('tokenizer'):
+            if args.token_cache:
+                # visual tokens read from the token cache by the dataset
+                input_ids = images.flatten(1)
+            else:
+                input_ids = d_vae.get_codebook_indices(images).flatten(1)
             bool_masked_pos = bool_masked_pos.flatten(1).to(torch.bool)
             labels = input_ids[bool_masked_pos]
 
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(), profiler.phase('forward'):
             outputs = model(samples, bool_masked_pos=bool_masked_pos, return_all_tokens=False)
             loss = criterion(input=outputs, target=labels)
 
-        loss_value = loss.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
-
         optimizer.zero_grad()
         
         # this attribute is added by timm on one optimizer (adahessian)
         is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                parameters=model.parameters(),
-                                create_graph=is_second_order)
-        loss_scale_value = loss_scaler.state_dict()["scale"]
-
-        torch.cuda.synchronize()
+        with profiler.phase('backward_step'):
+            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                    parameters=model.parameters(),
+                                    create_graph=is_second_order, skip_nonfinite=True)
+        # 1.0 when the scaler is disabled (CPU clients)
+        loss_scale_value = loss_scaler.get_scale()
         
-        mlm_acc = (outputs.max(-1)[1] == labels).float().mean().item()
+        mlm_acc = (outputs.max(-1)[1] == labels).float().mean()
         
+        # the metrics stay on the device, they are read back at the print interval only
         metric_logger.update(mlm_acc=mlm_acc)
-        metric_logger.update(loss=loss_value)
+        metric_logger.update(loss=loss.detach())
         metric_logger.update(loss_scale=loss_scale_value)
         min_lr = 10.
         max_lr = 0.
@@ -98,6 +99,13 @@ def train_one_epoch(args, model: torch.nn.Module, d_vae: torch.nn.Module,
                 weight_decay_value = group["weight_decay"]
         metric_logger.update(weight_decay=weight_decay_value)
         metric_logger.update(grad_norm=grad_norm)
+
+        if step % print_freq == 0 or step == len(data_loader) - 1:
+            metric_logger.flush()
+            # the updates of non-finite losses were already skipped by loss_scaler
+            if not math.isfinite(metric_logger.loss.total):
+                print("Loss is {}, stopping training".format(metric_logger.loss.value))
+                sys.exit(1)
         
         if lr_scheduler is not None:
             lr_scheduler.step_update(start_steps + step)
@@ -116,7 +124,9 @@ def train_one_epoch(args, model: torch.nn.Module, d_vae: torch.nn.Module,
             log_writer.set_step()
     
     args.current_mlm_acc[cur_single_client] = metric_logger.get_mlm_acc()
-    if args.best_mlm_acc[cur_single_client] < args.current_mlm_acc[cur_single_client]:
+    # no mlm_acc when the --local_time_budget of the round ran out before the epoch
+    if args.current_mlm_acc[cur_single_client] is not None and \
+            args.best_mlm_acc[cur_single_client] < args.current_mlm_acc[cur_single_client]:
         args.best_mlm_acc[cur_single_client] = args.current_mlm_acc[cur_single_client]
     
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
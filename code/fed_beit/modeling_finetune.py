@@ -355,6 +355,15 @@ class VisionTransformer(nn.Module):
         return x
 
 
+@register_model
+def beit_tiny_patch16_224(pretrained=False, **kwargs):
+    model = VisionTransformer(
+        patch_size=16, embed_dim=192, depth=12, num_heads=3, mlp_ratio=4, qkv_bias=True,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6), **kwargs)
+    model.default_cfg = _cfg()
+    return model
+
+
 @register_model
 def beit_base_patch16_224(pretrained=False, **kwargs):
     model = VisionTransformer(
@@ -136,6 +136,16 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
                 return self.lm_head(x[bool_masked_pos])
 
 
+@register_model
+def beit_tiny_patch16_224_8k_vocab(pretrained=False, **kwargs):
+    _ = kwargs.pop("num_classes")
+    model = VisionTransformerForMaskedImageModeling(
+        patch_size=16, embed_dim=192, depth=12, num_heads=3, mlp_ratio=4, qkv_bias=True,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6), vocab_size=8192, **kwargs)
+    model.default_cfg = _cfg()
+    return model
+
+
 @register_model
 def beit_base_patch16_224_8k_vocab(pretrained=False, **kwargs):
     _ = kwargs.pop("num_classes")
@@ -27,6 +27,12 @@ import fed_beit.modeling_finetune
 from fed_beit.engine_for_finetuning import train_one_epoch
 import util.misc as misc
 from util.FedAvg_utils import Partial_Client_Selection, valid, average_model
+from util.aggregation import FlatAggregator
+from util.compression import build_codec
+from util.server_optim import build_server_optimizer
+from util.client_pool import create_client_pool
+from util.client_data import ClientDataRegistry, steps_per_inner_epoch
+from util.profiler import init_profiler
 from util.data_utils import DatasetFLFinetune, create_dataset_and_evalmetrix
 from util.start_config import print_options
 
@@ -148,6 +154,16 @@ def get_args():
                         help='ImageNet dataset path') # choices=['Retina', 'Derm', 'COVIDfl']
     parser.add_argument('--data_path', default='/home/yan/data/SSL-FL/Retina', type=str, 
                         help='dataset path')
+    parser.add_argument('--image_cache', action='store_true',
+                        help='Read Retina images from a preprocessed uint8 memory-mapped cache (built on first use)')
+    parser.add_argument('--image_cache_dir', default=None, type=str,
+                        help='Directory of the image cache (default: data_path/cache)')
+    parser.add_argument('--shards', action='store_true',
+                        help='Read images from large shard files packed per client (packed on first use)')
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='Directory of the shard files (default: data_path/shards)')
+    parser.add_argument('--shard_size_mb', default=256, type=int,
+                        help='Approximate size of a shard file when packing')
     parser.add_argument('--eval_data_path', default=None, type=str,
                         help='dataset path for evaluation')
     parser.add_argument('--nb_classes', default=2, type=int,
@@ -198,6 +214,46 @@ def get_args():
     parser.add_argument("--num_local_clients", default=10, choices=[10, -1], type=int, 
                         help="Num of local clients joined in each FL train. -1 indicates all clients")
     parser.add_argument("--split_type", type=str, default="central", help="Which data partitions to use")
+    parser.add_argument("--client_pool", action='store_true',
+                        help="Share one working model among all clients and keep only per-client optimizer/scaler state")
+    parser.add_argument("--client_state_offload", default='none', choices=['none', 'cpu', 'disk', 'mmap'], type=str,
+                        help="Where the client pool keeps per-client state between client turns")
+    parser.add_argument("--client_state_dir", default=None, type=str,
+                        help="Directory for --client_state_offload disk/mmap (default: output_dir/client_states)")
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='Keep the DataLoader workers of every client alive across rounds.')
+    parser.add_argument('--no_persistent_workers', action='store_false', dest='persistent_workers')
+    parser.set_defaults(persistent_workers=True)
+    parser.add_argument("--max_client_loaders", default=8, type=int,
+                        help="Maximum number of client DataLoaders (and their workers) kept alive; the least "
+                             "recently used one is shut down first (0: keep all)")
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the duration of every phase of each client and round and write "
+                             "profile_trace.json (Chrome trace) and profile_summary.csv to output_dir")
+    parser.add_argument("--local_steps", default=0, type=int,
+                        help="Local steps of every client per round, split over the E_epoch local epochs "
+                             "(0: one pass over the client data per local epoch)")
+    parser.add_argument("--local_time_budget", default=0., type=float,
+                        help="Stop the local training of a client after this many seconds per round (0: no limit)")
+    parser.add_argument("--update_codec", default='none', choices=['none', 'fp16', 'int8', 'topk'], type=str,
+                        help="Codec of the simulated client uplink: the update against the global model "
+                             "is encoded and decoded before averaging (none: full-precision weights)")
+    parser.add_argument("--topk_ratio", default=0.01, type=float,
+                        help="Fraction of the update entries sent by --update_codec topk")
+    parser.add_argument("--server_opt", default='none', choices=['none', 'momentum', 'adam'], type=str,
+                        help="Server optimizer applied to the pseudo-gradient (global - client mean): "
+                             "momentum (FedAvgM), adam (FedAdam) or none (FedAvg)")
+    parser.add_argument("--server_lr", default=None, type=float,
+                        help="Server learning rate (default: 1.0 for momentum, 1e-2 for adam)")
+    parser.add_argument("--server_momentum", default=0.9, type=float,
+                        help="Momentum of --server_opt momentum")
+    parser.add_argument("--server_betas", default=[0.9, 0.99], type=float, nargs=2,
+                        help="Betas of --server_opt adam")
+    parser.add_argument("--server_tau", default=1e-3, type=float,
+                        help="Adaptivity constant of --server_opt adam")
+    parser.add_argument("--aggregate_exclude", default=['relative_position_index'], type=str, nargs='*',
+                        help="Parameters and floating-point buffers whose name contains one of these "
+                             "strings are not averaged")
 
     return parser.parse_args()
 
@@ -290,6 +346,11 @@ def main(args, model):
     # configuration for FedAVG, prepare model, optimizer, scheduler 
     model_all, optimizer_all, criterion_all, lr_scheduler_all, wd_scheduler_all, loss_scaler_all, mixupfn_all = Partial_Client_Selection(args, model, mode='finetune')
     model_avg = deepcopy(model).cpu()
+    aggregator = FlatAggregator(model_avg, codec=build_codec(args),
+                                server_optimizer=build_server_optimizer(args),
+                                exclude=args.aggregate_exclude)
+    print("Aggregator = %s" % str(aggregator))
+    client_pool = create_client_pool(args, model_all, optimizer_all, loss_scaler_all, aggregator)
     
     if args.log_dir is not None:
         os.makedirs(args.log_dir, exist_ok=True)
@@ -298,6 +359,14 @@ def main(args, model):
         log_writer = None
     
     
+    # ---------- per-phase timings of every client and round (--profile)
+    profiler = init_profiler(args)
+    
+    # ---------- datasets and loaders are built once per client and reused across rounds
+    client_data = ClientDataRegistry(args, lambda args: DatasetFLFinetune(args=args, phase='train'),
+                                     persistent_workers=args.persistent_workers,
+                                     max_loaders=args.max_client_loaders or None)
+    
     # ---------- Train! (use different clients)    
     print("=============== Running fine-tuning ===============")
     tot_clients = args.dis_cvs_files
@@ -328,33 +397,20 @@ def main(args, model):
             print('proxy_single_client: ', proxy_single_client)
             
             args.single_client = cur_single_client
+            profiler.set_context(round=epoch, client=cur_single_client)
             args.clients_weightes[proxy_single_client] = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
             
             # ---- get dataset for each client for pretraining finetuning 
-            dataset_train = DatasetFLFinetune(args=args, phase='train')
-            
-            num_tasks = misc.get_world_size()
-            global_rank = misc.get_rank()
+            dataset_train = client_data.dataset(cur_single_client)
             
             print(f'=========client: {proxy_single_client} ==============')
-            if args.distributed:
-                sampler_train = torch.utils.data.DistributedSampler(
-                    dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
-                )
-            else:    
-                sampler_train = torch.utils.data.RandomSampler(dataset_train)
-                    
-            print("Sampler_train = %s" % str(sampler_train))
-            
-            data_loader_train = torch.utils.data.DataLoader(
-                dataset_train, sampler=sampler_train,
-                batch_size=args.batch_size,
-                num_workers=args.num_workers,
-                pin_memory=args.pin_mem,
-                drop_last=True,
-            )
+            data_loader_train = client_data.loader(cur_single_client, epoch)
+            client_start, client_start_step = time.perf_counter(), args.global_step_per_client[proxy_single_client]
+            print("Sampler_train = %s" % str(data_loader_train.sampler))
             
             # ---- prepare model for a client
+            if client_pool is not None:
+                client_pool.checkout(proxy_single_client)
             model = model_all[proxy_single_client]
             optimizer = optimizer_all[proxy_single_client]
             criterion = criterion_all[proxy_single_client]
@@ -371,22 +427,21 @@ def main(args, model):
             n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
 
             total_batch_size = args.batch_size * args.update_freq * misc.get_world_size()
-            num_training_steps_per_inner_epoch = len(dataset_train) // total_batch_size
+            num_training_steps_per_inner_epoch = steps_per_inner_epoch(args, len(dataset_train), total_batch_size)
             print("LR = %.8f" % args.lr)
             print("Batch size = %d" % total_batch_size)
             print("Update frequent = %d" % args.update_freq)
             print("Number of training examples = %d" % len(dataset_train))
             print("Number of training training per epoch = %d" % num_training_steps_per_inner_epoch)
             
-            if args.distributed:
-                data_loader_train.sampler.set_epoch(epoch)
             if log_writer is not None:
                 log_writer.set_step(epoch)
                 
             if args.eval:
                 misc.auto_load_model(
                     args=args, model=model, model_without_ddp=model_without_ddp,
-                    optimizer=optimizer, loss_scaler=loss_scaler, model_ema=None)
+                    optimizer=optimizer, loss_scaler=loss_scaler, model_ema=None,
+                    server_optimizer=aggregator.server_optimizer)
                 
                 test_stats = valid(args, model, data_loader_test)
                 print(f"Accuracy of the network on the {len(dataset_test)} test images: {test_stats['acc1']:.1f}%")
@@ -395,6 +450,9 @@ def main(args, model):
                 exit(0)
             
             for inner_epoch in range(args.E_epoch):
+                # --local_time_budget spent: skip the remaining local epochs
+                if inner_epoch > 0 and data_loader_train.expired():
+                    break
                 
                 # ============ training one epoch of BEiT  ============
                 train_stats = train_one_epoch(args, model, criterion, data_loader_train, optimizer,
@@ -425,30 +483,62 @@ def main(args, model):
                         log_writer.flush()
                     with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
                         f.write(json.dumps(log_stats) + "\n")
+            
+            # ============ local work of the client in this round ============
+            client_stats = {'client': cur_single_client,
+                            'proxy_client': proxy_single_client,
+                            'epoch': epoch,
+                            'local_steps': args.global_step_per_client[proxy_single_client] - client_start_step,
+                            'local_time_s': time.perf_counter() - client_start}
+            print("Local work = %s" % json.dumps(client_stats))
+            profiler.record('local_training', client_start, time.perf_counter())
+            if args.output_dir and misc.is_main_process():
+                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(client_stats) + "\n")
+            
+            if client_pool is not None:
+                client_pool.checkin(proxy_single_client, args.clients_weightes[proxy_single_client])
         
         # =========== model average and eval ============ 
         # average model
-        average_model(args, model_avg, model_all)
+        profiler.set_context(client=None)
+        with profiler.phase('aggregation'):
+            if client_pool is not None:
+                client_pool.average_model(model_avg)
+            else:
+                average_model(args, model_avg, model_all, aggregator=aggregator)
+        # bytes sent by the clients of this round (see --update_codec)
+        update_bytes = aggregator.pop_num_bytes()
+        # logged every round, with the test stats when there is a validation set
+        log_stats = {'epoch': epoch,
+                     'n_parameters': n_parameters,
+                     'update_codec': args.update_codec,
+                     'update_bytes': update_bytes}
         
         # save the global model
         if args.output_dir and args.save_ckpt:
             if (epoch + 1) % args.save_ckpt_freq == 0 or epoch + 1 == args.max_communication_rounds:
-                misc.save_model(
-                    args=args, model=model_avg, model_without_ddp=model_avg,
-                    optimizer=optimizer, loss_scaler=loss_scaler, epoch=epoch)
+                with profiler.phase('checkpoint'):
+                    misc.save_model(
+                        args=args, model=model_avg, model_without_ddp=model_avg,
+                        optimizer=optimizer, loss_scaler=loss_scaler, epoch=epoch,
+                        server_optimizer=aggregator.server_optimizer)
         
         if data_loader_val is not None:
             model_avg.to(args.device)
-            test_stats = valid(args, model_avg, data_loader_val)
+            with profiler.phase('evaluation'):
+                test_stats = valid(args, model_avg, data_loader_val)
             print(f"Accuracy of the network on the {len(dataset_val)} validation images: {test_stats['acc1']:.1f}%")
             
             if max_accuracy < test_stats["acc1"]:
                 max_accuracy = test_stats["acc1"]
                 if args.output_dir and args.save_ckpt:
-                    misc.save_model(
-                        args=args, model=model_avg, 
-                        model_without_ddp=model_without_ddp, optimizer=optimizer,
-                        loss_scaler=loss_scaler, epoch="best", model_ema=None)
+                    with profiler.phase('checkpoint'):
+                        misc.save_model(
+                            args=args, model=model_avg, 
+                            model_without_ddp=model_without_ddp, optimizer=optimizer,
+                            loss_scaler=loss_scaler, epoch="best", model_ema=None,
+                            server_optimizer=aggregator.server_optimizer)
             
             print(f'Max accuracy: {max_accuracy:.2f}%')
             if log_writer is not None:
@@ -456,9 +546,7 @@ def main(args, model):
                 log_writer.update(test_acc5=test_stats['acc5'], head="perf", step=epoch)
                 log_writer.update(test_loss=test_stats['loss'], head="perf", step=epoch)
             
-            log_stats = {**{f'test_{k}': v for k, v in test_stats.items()},
-                         'epoch': epoch,
-                         'n_parameters': n_parameters}
+            log_stats = {**{f'test_{k}': v for k, v in test_stats.items()}, **log_stats}
             
         if args.output_dir and misc.is_main_process():
                 if log_writer is not None:
@@ -471,10 +559,21 @@ def main(args, model):
         print('global_step_per_client: ', args.global_step_per_client[proxy_single_client])
         print('t_total: ', args.t_total[proxy_single_client])
         
-        if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client]:
+        # a time budget may leave t_total out of reach, stop after max_communication_rounds
+        if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client] or \
+                (args.local_time_budget > 0 and epoch + 1 >= args.max_communication_rounds):
             total_time = time.time() - start_time
             total_time_str = str(datetime.timedelta(seconds=int(total_time)))
             print('Training time {}'.format(total_time_str))
+            
+            if args.output_dir and misc.is_main_process():
+                profiler.save(args.output_dir)
+            
+            data_report = client_data.report()
+            print("Client data loading = %s" % json.dumps(data_report))
+            if args.output_dir and misc.is_main_process():
+                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(data_report) + "\n")
             break
 
 if __name__ == '__main__':
@@ -13,6 +13,7 @@ import os
 import sys
 sys.path.append(os.path.abspath('..'))
 import util.misc as misc
+from util.profiler import get_profiler
 import util.lr_sched as lr_sched
 
 
@@ -23,13 +24,15 @@ def train_one_epoch(model: torch.nn.Module,
                     max_norm: float = 0,
                     proxy_single_client=None,
                     log_writer=None,
-                    args=None):
+                    args=None,
+                    batch_transform=None):
     
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 20
+    profiler = get_profiler()
     
     accum_iter = args.accum_iter
 
@@ -46,26 +49,34 @@ def train_one_epoch(model: torch.nn.Module,
         if data_iter_step % accum_iter == 0:
             lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
 
-        samples = samples.to(device, non_blocking=True)
+        if batch_transform is not None:
+            # --batch_aug: uint8 images padded to a common size, augmented here as one batch
+            images, sizes, loaded_sizes = samples
+            with profiler.phase('batch_aug'):
+                samples = batch_transform(images.to(device, non_blocking=True), sizes, loaded_sizes)
+        else:
+            samples = samples.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(), profiler.phase('forward'):
             loss, _, _ = model(samples, mask_ratio=args.mask_ratio)
 
-        loss_value = loss.item()
-        
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+        # read back at the print interval only (cloned, the loss is divided in place below)
+        metric_logger.update(loss=loss.detach().clone())
         
         loss /= accum_iter
-        loss_scaler(loss, optimizer, parameters=model.parameters(),
-                    update_grad=(data_iter_step + 1) % accum_iter == 0)
+        with profiler.phase('backward_step'):
+            loss_scaler(loss, optimizer, parameters=model.parameters(),
+                        update_grad=(data_iter_step + 1) % accum_iter == 0, skip_nonfinite=True)
         if (data_iter_step + 1) % accum_iter == 0:
             optimizer.zero_grad()
 
-        torch.cuda.synchronize()
+        if data_iter_step % print_freq == 0 or data_iter_step == len(data_loader) - 1:
+            metric_logger.flush()
+            # the updates of non-finite losses were already skipped by loss_scaler
+            if not math.isfinite(metric_logger.loss.total):
+                print("Loss is {}, stopping training".format(metric_logger.loss.value))
+                sys.exit(1)
 
-        metric_logger.update(loss=loss_value)
         min_lr = 10.
         max_lr = 0.
         for group in optimizer.param_groups:
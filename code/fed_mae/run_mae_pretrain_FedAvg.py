@@ -30,7 +30,15 @@ import fed_mae.models_mae as models_mae
 from fed_mae.engine_for_pretraining import train_one_epoch
 import util.misc as misc
 from util.FedAvg_utils import Partial_Client_Selection, average_model
+from util.aggregation import FlatAggregator
+from util.compression import build_codec
+from util.server_optim import build_server_optimizer
+from util.client_pool import create_client_pool
+from util.client_executor import ClientExecutor
+from util.client_data import ClientDataRegistry, steps_per_inner_epoch
+from util.profiler import init_profiler
 from util.data_utils import DatasetFLPretrain, create_dataset_and_evalmetrix
+from util.datasets import BatchAugmentationForMAE
 from util.start_config import print_options
 
 
@@ -73,6 +81,19 @@ def get_args():
     # Dataset parameters
     parser.add_argument('--data_set', default='Retina', type=str, help='dataset for pretraining')
     parser.add_argument('--data_path', default='../../data/Retina', type=str, help='dataset path')
+    parser.add_argument('--image_cache', action='store_true',
+                        help='Read Retina images from a preprocessed uint8 memory-mapped cache (built on first use)')
+    parser.add_argument('--image_cache_dir', default=None, type=str,
+                        help='Directory of the image cache (default: data_path/cache)')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='Only load uint8 images in the DataLoader workers and apply the crop, color jitter '
+                             'and flip to every collated batch on the training device (slower on CPU)')
+    parser.add_argument('--shards', action='store_true',
+                        help='Read images from large shard files packed per client (packed on first use)')
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='Directory of the shard files (default: data_path/shards)')
+    parser.add_argument('--shard_size_mb', default=256, type=int,
+                        help='Approximate size of a shard file when packing')
     parser.add_argument('--output_dir', default='',
                         help='path where to save, empty for no saving')
     parser.add_argument('--log_dir', default=None,
@@ -108,6 +129,53 @@ def get_args():
     parser.add_argument("--num_local_clients", default=-1, choices=[10, -1], type=int, 
                         help="Num of local clients joined in each FL train. -1 indicates all clients")
     parser.add_argument("--split_type", type=str, default="central", help="Which data partitions to use")
+    parser.add_argument("--client_pool", action='store_true',
+                        help="Share one working model among all clients and keep only per-client optimizer/scaler state")
+    parser.add_argument("--client_state_offload", default='none', choices=['none', 'cpu', 'disk', 'mmap'], type=str,
+                        help="Where the client pool keeps per-client state between client turns")
+    parser.add_argument("--client_state_dir", default=None, type=str,
+                        help="Directory for --client_state_offload disk/mmap (default: output_dir/client_states)")
+    parser.add_argument("--num_client_workers", default=0, type=int,
+                        help="Number of clients trained concurrently in worker processes (CPU only, 0: sequential)")
+    parser.add_argument("--async_buffer_size", default=0, type=int,
+                        help="Asynchronous FedAvg (FedBuff, needs --num_client_workers): the server applies every "
+                             "async_buffer_size client updates as they arrive (0: synchronous rounds)")
+    parser.add_argument("--staleness_exponent", default=0.5, type=float,
+                        help="Updates that are s server versions old are weighted by (1 + s) ** -staleness_exponent")
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='Keep the DataLoader workers of every client alive across rounds.')
+    parser.add_argument('--no_persistent_workers', action='store_false', dest='persistent_workers')
+    parser.set_defaults(persistent_workers=True)
+    parser.add_argument("--max_client_loaders", default=8, type=int,
+                        help="Maximum number of client DataLoaders (and their workers) kept alive; the least "
+                             "recently used one is shut down first (0: keep all)")
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the duration of every phase of each client and round and write "
+                             "profile_trace.json (Chrome trace) and profile_summary.csv to output_dir")
+    parser.add_argument("--local_steps", default=0, type=int,
+                        help="Local steps of every client per round, split over the E_epoch local epochs "
+                             "(0: one pass over the client data per local epoch)")
+    parser.add_argument("--local_time_budget", default=0., type=float,
+                        help="Stop the local training of a client after this many seconds per round (0: no limit)")
+    parser.add_argument("--update_codec", default='none', choices=['none', 'fp16', 'int8', 'topk'], type=str,
+                        help="Codec of the simulated client uplink: the update against the global model "
+                             "is encoded and decoded before averaging (none: full-precision weights)")
+    parser.add_argument("--topk_ratio", default=0.01, type=float,
+                        help="Fraction of the update entries sent by --update_codec topk")
+    parser.add_argument("--server_opt", default='none', choices=['none', 'momentum', 'adam'], type=str,
+                        help="Server optimizer applied to the pseudo-gradient (global - client mean): "
+                             "momentum (FedAvgM), adam (FedAdam) or none (FedAvg)")
+    parser.add_argument("--server_lr", default=None, type=float,
+                        help="Server learning rate (default: 1.0 for momentum, 1e-2 for adam)")
+    parser.add_argument("--server_momentum", default=0.9, type=float,
+                        help="Momentum of --server_opt momentum")
+    parser.add_argument("--server_betas", default=[0.9, 0.99], type=float, nargs=2,
+                        help="Betas of --server_opt adam")
+    parser.add_argument("--server_tau", default=1e-3, type=float,
+                        help="Adaptivity constant of --server_opt adam")
+    parser.add_argument("--aggregate_exclude", default=['relative_position_index'], type=str, nargs='*',
+                        help="Parameters and floating-point buffers whose name contains one of these "
+                             "strings are not averaged")
     
     return parser.parse_args()
 
@@ -134,6 +202,11 @@ def main(args, model):
     # configuration for FedAVG, prepare model, optimizer, scheduler 
     model_all, optimizer_all, loss_scaler_all = Partial_Client_Selection(args, model)
     model_avg = deepcopy(model).cpu()
+    aggregator = FlatAggregator(model_avg, codec=build_codec(args),
+                                server_optimizer=build_server_optimizer(args),
+                                exclude=args.aggregate_exclude)
+    print("Aggregator = %s" % str(aggregator))
+    client_pool = create_client_pool(args, model_all, optimizer_all, loss_scaler_all, aggregator)
     
     global_rank = misc.get_rank()
     
@@ -143,6 +216,105 @@ def main(args, model):
     else:
         log_writer = None
     
+    # ---------- per-phase timings of every client and round (--profile)
+    profiler = init_profiler(args)
+    
+    # ---------- datasets and loaders are built once per client and reused across rounds
+    batch_transform = BatchAugmentationForMAE(args) if args.batch_aug else None
+    if batch_transform is not None:
+        print("Batch augmentation = %s" % str(batch_transform))
+    
+    client_data = ClientDataRegistry(args, DatasetFLPretrain,
+                                     persistent_workers=args.persistent_workers,
+                                     max_loaders=args.max_client_loaders or None,
+                                     collate_fn=BatchAugmentationForMAE.collate if args.batch_aug else None)
+    
+    def train_client(cur_single_client, proxy_single_client, epoch):
+        """ Local pre-training of one client for args.E_epoch epochs. """
+        args.single_client = cur_single_client
+        profiler.set_context(round=epoch, client=cur_single_client)
+        
+        # ---- get dataset for each client for pretraining
+        dataset_train = client_data.dataset(cur_single_client)
+        
+        num_tasks = misc.get_world_size()
+        num_training_steps_per_inner_epoch = steps_per_inner_epoch(args, len(dataset_train), args.batch_size * num_tasks)
+        
+        print(f'=========client: {proxy_single_client} ==============')
+        data_loader_train = client_data.loader(cur_single_client, epoch)
+        client_start, client_start_step = time.perf_counter(), args.global_step_per_client[proxy_single_client]
+        
+        # ---- prepare model for a client
+        model = model_all[proxy_single_client]
+        optimizer = optimizer_all[proxy_single_client]
+        loss_scaler = loss_scaler_all[proxy_single_client]
+        
+        if log_writer is not None:
+            log_writer.set_step(epoch)
+
+        n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)  
+        total_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
+        
+        if args.lr is None:  # only base_lr is specified
+            args.lr = args.blr * total_batch_size / 256
+
+        print("base lr: %.2e" % (args.lr * 256 / total_batch_size))
+        print("actual lr: %.2e" % args.lr)
+        print("accumulate grad iterations: %d" % args.accum_iter)
+        print("effective batch size: %d" % total_batch_size)
+        print("Number of training steps = %d" % num_training_steps_per_inner_epoch)
+        print("Number of training examples per epoch = %d" % (total_batch_size * num_training_steps_per_inner_epoch))
+        
+        for inner_epoch in range(args.E_epoch):
+            # --local_time_budget spent: skip the remaining local epochs
+            if inner_epoch > 0 and data_loader_train.expired():
+                break
+            # ============ training one epoch of MAE  ============
+            train_stats = train_one_epoch(
+                model, data_loader_train,
+                optimizer, device, epoch, loss_scaler,
+                cur_single_client,
+                max_norm=args.clip_grad,
+                proxy_single_client=proxy_single_client,
+                log_writer=log_writer,
+                args=args,
+                batch_transform=batch_transform
+            )
+            
+            log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                         'client': args.single_client,
+                         'epoch': epoch,
+                         'inner_epoch': inner_epoch,
+                         'n_parameters': n_parameters}
+            
+            if args.output_dir and misc.is_main_process():
+                if log_writer is not None:
+                    log_writer.flush()
+                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(log_stats) + "\n")
+
+        # ============ local work of the client in this round ============
+        client_stats = {'client': cur_single_client,
+                        'proxy_client': proxy_single_client,
+                        'epoch': epoch,
+                        'local_steps': args.global_step_per_client[proxy_single_client] - client_start_step,
+                        'local_time_s': time.perf_counter() - client_start}
+        print("Local work = %s" % json.dumps(client_stats))
+        profiler.record('local_training', client_start, time.perf_counter())
+        if args.output_dir and misc.is_main_process():
+            with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(client_stats) + "\n")
+    
+    if args.num_client_workers > 0:
+        assert client_pool is None, "--client_pool and --num_client_workers cannot be combined"
+        # the tensorboard writer cannot be shared with the worker processes
+        log_writer = None
+        client_executor = ClientExecutor(args, train_client, model_all, aggregator, args.num_client_workers,
+                                         async_buffer=args.async_buffer_size)
+    else:
+        client_executor = None
+        assert args.async_buffer_size == 0, "--async_buffer_size needs --num_client_workers"
+    
     # ---------- Train! (use different clients)
     print("=============== Running pre-training ===============")
     tot_clients = args.dis_cvs_files
@@ -152,112 +324,120 @@ def main(args, model):
     print(f"Start training for {args.max_communication_rounds} epochs, distributed={args.distributed}")
     start_time = time.time()
     
-    while True:
-        print('epoch: ', epoch)
-        epoch += 1
+    if args.async_buffer_size > 0:
+        def select_client(in_flight):
+            # any client that is not being trained by another proxy client
+            idle = [client for client in tot_clients if client not in in_flight]
+            return idle[np.random.randint(len(idle))]
         
-        # randomly select partial clients
-        if args.num_local_clients == len(args.dis_cvs_files):
-            # just use all the local clients
-            cur_selected_clients = args.proxy_clients
-        else:
-            cur_selected_clients = np.random.choice(tot_clients, args.num_local_clients, replace=False).tolist()
+        def on_update(version, update_stats):
+            profiler.set_context(round=version, client=None)
+            aggregator.scatter(model_avg)
+            update_stats.update({'epoch': version,
+                                 'update_codec': args.update_codec,
+                                 'update_bytes': aggregator.pop_num_bytes()})
+            if args.output_dir and misc.is_main_process():
+                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(update_stats) + "\n")
+            
+            if args.output_dir and (version + 1) % args.save_ckpt_freq == 0:
+                with profiler.phase('checkpoint'):
+                    misc.save_model(
+                        args=args, model=model_avg, model_without_ddp=model_avg,
+                        optimizer=optimizer_all[args.proxy_clients[-1]],
+                        loss_scaler=loss_scaler_all[args.proxy_clients[-1]], epoch=version,
+                        server_optimizer=aggregator.server_optimizer,
+                        # the client optimizers and scalers are trained in the worker processes
+                        save_client_state=False)
         
-        # get the quantity of clients joined in the FL train for updating the clients weights
-        cur_tot_client_Lens = 0
-        for client in cur_selected_clients:
-            cur_tot_client_Lens += args.clients_with_len[client]
+        # one server version per buffer of client updates, max_communication_rounds versions
+        client_executor.run_async(args.max_communication_rounds, args.async_buffer_size,
+                                  select_client, on_update, staleness_exponent=args.staleness_exponent)
+    else:
+        while True:
+            print('epoch: ', epoch)
+            epoch += 1
         
-        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
-            print('cur_single_client: ', cur_single_client)
-            print('proxy_single_client: ', proxy_single_client)
-            
-            args.single_client = cur_single_client
-            args.clients_weightes[proxy_single_client] = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
-            
-            # ---- get dataset for each client for pretraining
-            dataset_train = DatasetFLPretrain(args)
-            
-            num_tasks = misc.get_world_size()
-            global_rank = misc.get_rank()
-            sampler_rank = global_rank
-            num_training_steps_per_inner_epoch = len(dataset_train) // args.batch_size // num_tasks
-            
-            print(f'=========client: {proxy_single_client} ==============')
-            if args.distributed:
-                sampler_train = torch.utils.data.DistributedSampler(
-                     dataset_train, num_replicas=num_tasks, rank=sampler_rank, shuffle=True)
-            else:    
-                sampler_train = torch.utils.data.RandomSampler(dataset_train)
-            
-            data_loader_train = torch.utils.data.DataLoader(
-                dataset_train, sampler=sampler_train,
-                batch_size=args.batch_size,
-                num_workers=args.num_workers,
-                pin_memory=args.pin_mem,
-                drop_last=True,
-            )
-            
-            # ---- prepare model for a client
-            model = model_all[proxy_single_client]
-            optimizer = optimizer_all[proxy_single_client]
-            loss_scaler = loss_scaler_all[proxy_single_client]
-            
-            if args.distributed:
-                data_loader_train.sampler.set_epoch(epoch)
-            if log_writer is not None:
-                log_writer.set_step(epoch)
-
-            n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)  
-            total_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
-            
-            if args.lr is None:  # only base_lr is specified
-                args.lr = args.blr * total_batch_size / 256
-
-            print("base lr: %.2e" % (args.lr * 256 / total_batch_size))
-            print("actual lr: %.2e" % args.lr)
-            print("accumulate grad iterations: %d" % args.accum_iter)
-            print("effective batch size: %d" % total_batch_size)
-            print("Number of training steps = %d" % num_training_steps_per_inner_epoch)
-            print("Number of training examples per epoch = %d" % (total_batch_size * num_training_steps_per_inner_epoch))
-            
-            for inner_epoch in range(args.E_epoch):
-                # ============ training one epoch of MAE  ============
-                train_stats = train_one_epoch(
-                    model, data_loader_train,
-                    optimizer, device, epoch, loss_scaler,
-                    cur_single_client,
-                    max_norm=args.clip_grad,
-                    proxy_single_client=proxy_single_client,
-                    log_writer=log_writer,
-                    args=args
-                )
+            # randomly select partial clients
+            if args.num_local_clients == len(args.dis_cvs_files):
+                # just use all the local clients
+                cur_selected_clients = args.proxy_clients
+            else:
+                cur_selected_clients = np.random.choice(tot_clients, args.num_local_clients, replace=False).tolist()
+        
+            # get the quantity of clients joined in the FL train for updating the clients weights
+            cur_tot_client_Lens = 0
+            for client in cur_selected_clients:
+                cur_tot_client_Lens += args.clients_with_len[client]
+        
+            for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+                args.clients_weightes[proxy_single_client] = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
+        
+            if client_executor is not None:
+                client_executor.run_round(epoch, cur_selected_clients, args.proxy_clients, args.clients_weightes)
+            else:
+                for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+                    print('cur_single_client: ', cur_single_client)
+                    print('proxy_single_client: ', proxy_single_client)
                 
-                log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                             'client': args.single_client,
-                             'epoch': epoch,
-                             'inner_epoch': inner_epoch,
-                             'n_parameters': n_parameters}
+                    if client_pool is not None:
+                        client_pool.checkout(proxy_single_client)
                 
-                if args.output_dir and misc.is_main_process():
-                    if log_writer is not None:
-                        log_writer.flush()
-                    with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
-                        f.write(json.dumps(log_stats) + "\n")
-            
-        # average model
-        average_model(args, model_avg, model_all)
+                    train_client(cur_single_client, proxy_single_client, epoch)
+                
+                    if client_pool is not None:
+                        client_pool.checkin(proxy_single_client, args.clients_weightes[proxy_single_client])
         
-        # save the global model
-        if args.output_dir:
-            if (epoch + 1) % args.save_ckpt_freq == 0:
-                misc.save_model(
-                    args=args, model=model_avg, model_without_ddp=model_avg,
-                    optimizer=optimizer, loss_scaler=loss_scaler, epoch=epoch)
-        # end criterion
-        if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client]:
-            break
-
+            # average model
+            profiler.set_context(client=None)
+            with profiler.phase('aggregation'):
+                if client_executor is not None:
+                    client_executor.average_model(model_avg)
+                elif client_pool is not None:
+                    client_pool.average_model(model_avg)
+                else:
+                    average_model(args, model_avg, model_all, aggregator=aggregator)
+        
+            # bytes sent by the clients of this round (see --update_codec)
+            update_stats = {'epoch': epoch,
+                            'update_codec': args.update_codec,
+                            'update_bytes': aggregator.pop_num_bytes()}
+            if args.output_dir and misc.is_main_process():
+                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(update_stats) + "\n")
+        
+            # save the global model
+            if args.output_dir:
+                if (epoch + 1) % args.save_ckpt_freq == 0:
+                    with profiler.phase('checkpoint'):
+                        misc.save_model(
+                            args=args, model=model_avg, model_without_ddp=model_avg,
+                            optimizer=optimizer_all[proxy_single_client],
+                            loss_scaler=loss_scaler_all[proxy_single_client], epoch=epoch,
+                            server_optimizer=aggregator.server_optimizer,
+                            # with --num_client_workers they are trained in the worker processes
+                            save_client_state=client_executor is None)
+            # end criterion
+            # a time budget may leave t_total out of reach, stop after max_communication_rounds
+            if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client] or \
+                    (args.local_time_budget > 0 and epoch + 1 >= args.max_communication_rounds):
+                break
+    
+    if client_executor is not None:
+        client_executor.close()
+    
+    # phases of the worker processes are not visible here either
+    if args.output_dir and misc.is_main_process():
+        profiler.save(args.output_dir)
+    
+    # loaders of the worker processes are not visible here
+    if client_executor is None:
+        data_report = client_data.report()
+        print("Client data loading = %s" % json.dumps(data_report))
+        if args.output_dir and misc.is_main_process():
+            with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(data_report) + "\n")
+    
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     
@@ -7,12 +7,13 @@
 
 from __future__ import absolute_import, division, print_function
 import os
-import numpy as np
 from copy import deepcopy
 import torch
 import torch.nn as nn
 
 from .lars import LARS
+from .aggregation import FlatAggregator
+from .client_data import steps_per_inner_epoch
 from . import misc as misc
 from .lr_decay import param_groups_lrd
 from .misc import NativeScalerWithGradNormCount as NativeScaler
@@ -146,19 +147,27 @@ def Partial_Client_Selection(args, model, mode='pretrain'):
             if args.lr is None:  # only base_lr is specified
                 args.lr = args.blr * total_batch_size / 256
         
-        num_training_steps_per_inner_epoch = args.clients_with_len[proxy_single_client] // total_batch_size
+        num_training_steps_per_inner_epoch = steps_per_inner_epoch(args, args.clients_with_len[proxy_single_client],
+                                                                   total_batch_size)
             
         print("Batch size = %d" % total_batch_size)
         print("Number of training steps = %d" % num_training_steps_per_inner_epoch)
         print("Number of training examples per epoch = %d" % (total_batch_size * num_training_steps_per_inner_epoch))
         
+        # with a client pool, all proxy clients share the working model, optimizer
+        # and loss scaler of the first one (see util/client_pool.py)
+        shared_client = args.client_pool and proxy_single_client != args.proxy_clients[0]
+        
         # model_all
-        model_all[proxy_single_client] = deepcopy(model)
-        model_all[proxy_single_client] = model_all[proxy_single_client].to(device)
+        if shared_client:
+            model_all[proxy_single_client] = model_all[args.proxy_clients[0]]
+        else:
+            model_all[proxy_single_client] = deepcopy(model)
+            model_all[proxy_single_client] = model_all[proxy_single_client].to(device)
 
-        if args.distributed:
-            model_all[proxy_single_client] = torch.nn.parallel.DistributedDataParallel(model_all[proxy_single_client], 
-                                                                                       sdevice_ids=[args.gpu], find_unused_parameters=True)
+            if args.distributed:
+                model_all[proxy_single_client] = torch.nn.parallel.DistributedDataParallel(model_all[proxy_single_client], 
+                                                                                           sdevice_ids=[args.gpu], find_unused_parameters=True)
         
         if args.distributed:
             model_without_ddp = model_all[proxy_single_client].module
@@ -166,7 +175,10 @@ def Partial_Client_Selection(args, model, mode='pretrain'):
             model_without_ddp = model_all[proxy_single_client]
         
         # optimizer_all
-        if mode == 'pretrain':
+        if shared_client:
+            optimizer_all[proxy_single_client] = optimizer_all[args.proxy_clients[0]]
+        
+        elif mode == 'pretrain':
             if args.model_name == 'beit':
                 optimizer_all[proxy_single_client] = create_optimizer(args, model_without_ddp)
             elif args.model_name == 'mae':
@@ -254,7 +266,10 @@ def Partial_Client_Selection(args, model, mode='pretrain'):
                                                                        max_communication_rounds=args.max_communication_rounds)
 
         # loss_scaler_all
-        loss_scaler_all[proxy_single_client] = NativeScaler()
+        if shared_client:
+            loss_scaler_all[proxy_single_client] = loss_scaler_all[args.proxy_clients[0]]
+        else:
+            loss_scaler_all[proxy_single_client] = NativeScaler()
 
         # resume model if specified
         # misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
@@ -279,48 +294,22 @@ def Partial_Client_Selection(args, model, mode='pretrain'):
             return model_all, optimizer_all, criterion_all, loss_scaler_all, mixup_fn_all
 
 
-def average_model(args, model_avg, model_all):
+def average_model(args, model_avg, model_all, aggregator=None):
     model_avg.cpu()
+    if aggregator is None:
+        aggregator = FlatAggregator(model_avg)
+    
     print('Calculate the model avg----')
-    params = dict(model_avg.named_parameters())
-        
-    for name, param in params.items():
-        for client in range(len(args.proxy_clients)):
-            single_client = args.proxy_clients[client]
-            
-            single_client_weight = args.clients_weightes[single_client]
-            single_client_weight = torch.from_numpy(np.array(single_client_weight)).float()
-            
-            if client == 0:
-                if args.distributed:
-                    tmp_param_data = dict(model_all[single_client].module.named_parameters())[
-                                         name].data * single_client_weight
-                else:
-                    tmp_param_data = dict(model_all[single_client].named_parameters())[
-                                         name].data * single_client_weight
-            else:
-                if args.distributed:
-                    tmp_param_data = tmp_param_data + \
-                                     dict(model_all[single_client].module.named_parameters())[
-                                         name].data * single_client_weight
-                else:
-                    tmp_param_data = tmp_param_data + \
-                                     dict(model_all[single_client].named_parameters())[
-                                         name].data * single_client_weight
-        
-        params[name].data.copy_(tmp_param_data)
-        
+    models = [model_all[single_client] for single_client in args.proxy_clients]
+    weights = [args.clients_weightes[single_client] for single_client in args.proxy_clients]
+    
+    aggregator.reduce(models, weights)
+    aggregator.scatter(model_avg)
+    
     print('Update each client model parameters----')
-        
+    
     for single_client in args.proxy_clients:
-        
-        if args.distributed:
-            tmp_params = dict(model_all[single_client].module.named_parameters())
-        else:
-            tmp_params = dict(model_all[single_client].named_parameters())
-
-        for name, param in params.items():
-            tmp_params[name].data.copy_(param.data)
+        aggregator.broadcast(model_all[single_client])
 
 
 class AverageMeter(object):
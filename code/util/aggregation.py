@@ -0,0 +1,158 @@
+# --------------------------------------------------------
+# Flat-buffer aggregation engine for FedAvg
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import torch
+
+from .compression import payload_bytes
+
+
+def unwrap_model(model):
+    return model.module if hasattr(model, 'module') else model
+
+
+class FlatAggregator(object):
+    """ Weighted averaging of client models through contiguous flat buffers.
+
+    The aggregated tensors of the global model are registered once (order, shapes
+    and offsets): all parameters and floating-point buffers (e.g. BatchNorm running
+    statistics) whose name contains none of the exclude strings. Integer buffers
+    such as relative_position_index or num_batches_tracked are never averaged.
+
+    Each round a client is flattened into a reusable staging buffer with a single
+    torch.cat and accumulated in-place into the preallocated global buffer; the
+    global model then holds views into that buffer.
+
+    With a codec (util.compression) every client update goes through the simulated
+    uplink: the delta against the global model is encoded, counted in num_bytes
+    and decoded again before it is accumulated.
+
+    With a server optimizer (util.server_optim) the weighted client mean is not
+    copied into the global buffer but turned into the pseudo-gradient
+    (global - mean) and applied by the optimizer, in place on the flat buffer.
+    """
+    def __init__(self, model_avg, codec=None, server_optimizer=None, exclude=('relative_position_index',)):
+        model_avg = unwrap_model(model_avg)
+
+        self.exclude = tuple(exclude)
+        named_tensors = self.named_tensors(model_avg)
+        self.names = [name for name, _ in named_tensors]
+        tensors = [t for _, t in named_tensors]
+        self.shapes = [t.shape for t in tensors]
+        self.numels = [t.numel() for t in tensors]
+        self.numel = sum(self.numels)
+
+        self.flat = torch.zeros(self.numel, dtype=torch.float32)
+        self.staging = torch.empty_like(self.flat)
+        self.views = [v.view(shape) for v, shape in zip(self.flat.split(self.numels), self.shapes)]
+        self.flatten(model_avg, out=self.flat)
+
+        # device copies of the global buffer used for broadcasting
+        self._device_flat = {}
+
+        self.codec = codec
+        self.server_optimizer = server_optimizer
+        self.num_bytes = 0
+        self.reduced = None
+
+    def __repr__(self):
+        return "FlatAggregator(tensors=%d, numel=%d, codec=%s, server_optimizer=%s)" % (
+            len(self.names), self.numel, self.codec.name if self.codec is not None else 'none',
+            self.server_optimizer)
+
+    def named_tensors(self, model):
+        """ Parameters and floating-point buffers of model, minus the excluded names. """
+        model = unwrap_model(model)
+        named_tensors = list(model.named_parameters()) + \
+            [(name, buf) for name, buf in model.named_buffers() if buf.is_floating_point()]
+        return [(name, t) for name, t in named_tensors if not any(e in name for e in self.exclude)]
+
+    def get_tensors(self, model):
+        return [t for _, t in self.named_tensors(model)]
+
+    def flatten(self, model, out=None):
+        """ Copy the registered tensors of model into one flat buffer. """
+        if out is None:
+            out = self.staging
+        tensors = [t.detach().reshape(-1).to(out.dtype) for t in self.get_tensors(model)]
+        assert len(tensors) == len(self.numels), "model does not match the registered tensors"
+
+        if tensors[0].device == out.device:
+            torch.cat(tensors, out=out)
+        else:
+            out.copy_(torch.cat(tensors))
+        return out
+
+    def send(self, delta):
+        """ Pass a client delta through the uplink: count its bytes, encode and decode it in place. """
+        if self.codec is None:
+            self.num_bytes += delta.numel() * delta.element_size()
+            return delta
+        payload = self.codec.encode(delta, self.numels)
+        self.num_bytes += payload_bytes(payload)
+        return self.codec.decode(payload, delta, self.numels)
+
+    def transmit(self, flat):
+        """ Encode a flattened client model as its delta to the global model and decode it back. """
+        self.send(flat.sub_(self.flat))
+        return flat.add_(self.flat)
+
+    def accumulate(self, out, model, weight, first=False):
+        """ out += weight * model, or out = weight * model when first is set. """
+        if self.codec is None:
+            self.num_bytes += self.numel * self.flat.element_size()
+            if first:
+                return self.flatten(model, out=out).mul_(float(weight))
+            return out.add_(self.flatten(model), alpha=float(weight))
+
+        flat = self.transmit(self.flatten(model))
+        if first:
+            return out.copy_(flat).mul_(float(weight))
+        return out.add_(flat, alpha=float(weight))
+
+    def pop_num_bytes(self):
+        """ Bytes of the client updates accumulated since the last call. """
+        num_bytes, self.num_bytes = self.num_bytes, 0
+        return num_bytes
+
+    def reduce(self, models, weights):
+        """ Weighted mean of the client models, applied to self.flat. """
+        # the codecs and the server optimizer need the global model until the last client
+        if self.codec is None and self.server_optimizer is None:
+            out = self.flat
+        else:
+            if self.reduced is None:
+                self.reduced = torch.empty_like(self.flat)
+            out = self.reduced
+        for i, (model, weight) in enumerate(zip(models, weights)):
+            self.accumulate(out, model, weight, first=(i == 0))
+        return self.update(out)
+
+    def update(self, flat):
+        """ Apply an externally accumulated client mean to the global buffer. """
+        if self.server_optimizer is not None:
+            self.server_optimizer.step(self.flat, flat)
+        elif flat is not self.flat:
+            self.flat.copy_(flat)
+        self._device_flat = {}
+        return self.flat
+
+    def scatter(self, model_avg):
+        """ Bind the parameters of the global model to views of self.flat. """
+        for t, view in zip(self.get_tensors(model_avg), self.views):
+            t.data = view
+
+    def broadcast(self, model):
+        """ Copy the global buffer into the registered tensors of a client model. """
+        tensors = self.get_tensors(model)
+        device = tensors[0].device
+        if device == self.flat.device:
+            src = self.flat
+        else:
+            if device not in self._device_flat:
+                self._device_flat[device] = self.flat.to(device)
+            src = self._device_flat[device]
+
+        for t, view in zip(tensors, src.split(self.numels)):
+            t.data.copy_(view.view_as(t))
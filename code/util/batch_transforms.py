@@ -0,0 +1,206 @@
+# --------------------------------------------------------
+# Batched tensor versions of the torchvision augmentations of
+# MAE pre-training: one random draw per image, one kernel per batch
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def rgb_to_grayscale(x):
+    """ (B, 1, H, W) luma of (B, 3, H, W) RGB images, with the weights of PIL's convert('L'). """
+    r, g, b = x.unbind(1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def rgb_to_hsv(x):
+    r, g, b = x.unbind(1)
+    maxc, argmax = x.max(1)
+    cr = maxc - x.min(1)[0]
+    ones = torch.ones_like(cr)
+    s = cr / torch.where(maxc > 0, maxc, ones)
+    cr = torch.where(cr > 0, cr, ones)
+    # ties between channels give the same hue in either branch
+    h = torch.where(argmax == 0, (g - b) / cr, torch.where(argmax == 1, 2.0 + (b - r) / cr, 4.0 + (r - g) / cr))
+    h = torch.fmod(h / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def hsv_to_rgb(x):
+    h, s, v = x.unbind(1)
+    # channel n of (r, g, b) = v - v * s * clamp(min(k, 4 - k), 0, 1), k = (n + 6 h) mod 6, n = 5, 3, 1
+    n = torch.tensor([5.0, 3.0, 1.0], device=x.device, dtype=x.dtype).view(1, 3, 1, 1)
+    k = torch.fmod(h.unsqueeze(1) * 6.0 + n, 6.0)
+    return v.unsqueeze(1) - (v * s).unsqueeze(1) * torch.clamp(torch.min(k, 4.0 - k), 0.0, 1.0)
+
+
+def uniform(n, low, high, device):
+    return torch.rand(n, device=device) * (high - low) + low
+
+
+class BatchRandomResizedCrop(object):
+    """ transforms.RandomResizedCrop of every image of a batch, as one grid_sample.
+
+    The crop boxes are drawn as torchvision does (10 tries of scale and log-uniform
+    aspect ratio, then a central crop) in the pixel space of each source image,
+    given as (B, 2) (width, height). The input images may have been downsized
+    (to loaded_sizes, default: the whole batch tensor) and padded to a common
+    size: the boxes are mapped onto them in normalized coordinates.
+
+    A crop shrunk by 2^k or more is sampled from the images average-pooled by 2^k,
+    a cheap stand-in for the antialiasing of PIL's resize.
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), interpolation='bicubic', attempts=10):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.interpolation = interpolation
+        self.attempts = attempts
+
+    @property
+    def max_source_size(self):
+        """ Side from which the smallest crop box still covers size pixels; larger
+        source images can be downsized to it without losing crop resolution.
+        """
+        return int(math.ceil(max(self.size) * math.sqrt(max(self.ratio) / self.scale[0])))
+
+    def get_params(self, sizes):
+        """ (i, j, h, w) float tensors of a crop box per image. """
+        width, height = sizes[:, 0].float(), sizes[:, 1].float()
+        n, device = len(sizes), sizes.device
+        area = (width * height).unsqueeze(1)
+        target_area = area * uniform((n, self.attempts), self.scale[0], self.scale[1], device)
+        aspect_ratio = torch.exp(uniform((n, self.attempts), math.log(self.ratio[0]), math.log(self.ratio[1]), device))
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        ok = (w > 0) & (w <= width.unsqueeze(1)) & (h > 0) & (h <= height.unsqueeze(1))
+        # the first successful try of every image
+        first = (ok.float() * torch.arange(self.attempts, 0, -1, device=device)).argmax(1, keepdim=True)
+        w, h, found = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1), ok.any(1)
+
+        # fallback to central crop
+        in_ratio = width / height
+        fallback_w = torch.where(in_ratio > max(self.ratio), torch.round(height * max(self.ratio)), width)
+        fallback_h = torch.where(in_ratio < min(self.ratio), torch.round(width / min(self.ratio)), height)
+        w = torch.where(found, w, fallback_w)
+        h = torch.where(found, h, fallback_h)
+        i = torch.where(found, torch.floor(torch.rand(n, device=device) * (height - h + 1)),
+                        torch.floor((height - h) / 2))
+        j = torch.where(found, torch.floor(torch.rand(n, device=device) * (width - w + 1)),
+                        torch.floor((width - w) / 2))
+        return i, j, h, w
+
+    def __call__(self, x, sizes, loaded_sizes=None):
+        i, j, h, w = self.get_params(sizes.to(x.device))
+        width, height = sizes[:, 0].to(x), sizes[:, 1].to(x)
+        # source pixels -> pixels of x
+        if loaded_sizes is None:
+            scale_x, scale_y = x.shape[3] / width, x.shape[2] / height
+        else:
+            scale_x, scale_y = loaded_sizes[:, 0].to(x) / width, loaded_sizes[:, 1].to(x) / height
+        theta = torch.zeros(len(x), 2, 3, device=x.device, dtype=x.dtype)
+        theta[:, 0, 0] = w * scale_x / x.shape[3]
+        theta[:, 0, 2] = (2 * j + w) * scale_x / x.shape[3] - 1
+        theta[:, 1, 1] = h * scale_y / x.shape[2]
+        theta[:, 1, 2] = (2 * i + h) * scale_y / x.shape[2] - 1
+        grid = F.affine_grid(theta, (len(x), x.shape[1]) + self.size, align_corners=False)
+
+        shrink = torch.max(w * scale_x / self.size[1], h * scale_y / self.size[0])
+        levels = torch.log2(shrink).floor_().clamp_(min=0).long()
+        out = x.new_empty((len(x), x.shape[1]) + self.size)
+        for level in levels.unique().tolist():
+            selected = (levels == level).nonzero().squeeze(1)
+            source = x[selected]
+            if level > 0:
+                # the normalized coordinates are the same on the pooled images
+                source = F.adaptive_avg_pool2d(source, (max(1, x.shape[2] >> level), max(1, x.shape[3] >> level)))
+            out[selected] = F.grid_sample(source, grid[selected], mode=self.interpolation,
+                                          padding_mode='border', align_corners=False)
+        return out.clamp_(0, 1)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0}, scale={1}, ratio={2}, interpolation={3})'.format(
+            self.size, self.scale, tuple(round(r, 4) for r in self.ratio), self.interpolation)
+
+
+class BatchRandomGrayscale(object):
+    def __init__(self, p=0.1):
+        self.p = p
+
+    def __call__(self, x):
+        gray = torch.rand(len(x), device=x.device) < self.p
+        return torch.where(gray.view(-1, 1, 1, 1), rgb_to_grayscale(x).expand_as(x), x)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={0})'.format(self.p)
+
+
+class BatchColorJitter(object):
+    """ transforms.ColorJitter with its own factors and order of the four adjustments per image. """
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0):
+        self.ranges = []
+        for name, value in (('brightness', brightness), ('contrast', contrast), ('saturation', saturation)):
+            if value:
+                self.ranges.append((name, max(0., 1 - value), 1 + value))
+        if hue:
+            self.ranges.append(('hue', -hue, hue))
+
+    @staticmethod
+    def adjust(name, x, factor):
+        factor = factor.view(-1, 1, 1, 1)
+        if name == 'brightness':
+            return (x * factor).clamp_(0, 1)
+        if name == 'contrast':
+            mean = rgb_to_grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+            return (factor * x + (1 - factor) * mean).clamp_(0, 1)
+        if name == 'saturation':
+            return (factor * x + (1 - factor) * rgb_to_grayscale(x)).clamp_(0, 1)
+        hsv = rgb_to_hsv(x)
+        hsv[:, 0] = torch.fmod(hsv[:, 0] + factor.view(-1, 1, 1) + 1.0, 1.0)
+        return hsv_to_rgb(hsv)
+
+    def __call__(self, x):
+        if not self.ranges:
+            return x
+        n, device = len(x), x.device
+        factors = [uniform(n, low, high, device) for _, low, high in self.ranges]
+        order = torch.rand(n, len(self.ranges), device=device).argsort(1)
+        x = x.clone()
+        for step in range(len(self.ranges)):
+            for k, (name, _, _) in enumerate(self.ranges):
+                selected = (order[:, step] == k).nonzero().squeeze(1)
+                if len(selected):
+                    x[selected] = self.adjust(name, x[selected], factors[k][selected])
+        return x
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(%s)' % ', '.join(
+            '%s=(%s, %s)' % (name, low, high) for name, low, high in self.ranges)
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = torch.rand(len(x), device=x.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={0})'.format(self.p)
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x):
+        return (x - self.mean.to(x)) / self.std.to(x)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean.flatten().tolist(),
+                                                                       self.std.flatten().tolist())
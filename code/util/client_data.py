@@ -0,0 +1,213 @@
+# --------------------------------------------------------
+# Persistent per-client datasets and DataLoaders
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .misc import get_rank, get_world_size
+from .profiler import get_profiler
+
+
+def steps_per_inner_epoch(args, dataset_len, total_batch_size):
+    """ Local steps of a client per inner epoch: one pass over its data, or the
+    --local_steps budget of a round split over the E_epoch local epochs.
+    """
+    if args.local_steps > 0:
+        return max(1, args.local_steps // args.E_epoch)
+    return dataset_len // total_batch_size
+
+
+class StepSampler(torch.utils.data.Sampler):
+    """ num_samples indices drawn as consecutive random permutations of the dataset,
+    so every client yields the same number of batches whatever its size.
+
+    With num_replicas > 1 every rank draws the same permutations (same generator
+    seed) and keeps every num_replicas-th of num_samples * num_replicas indices.
+    """
+    def __init__(self, dataset_len, num_samples, generator=None, num_replicas=1, rank=0):
+        self.dataset_len = dataset_len
+        self.num_samples = num_samples
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        total_samples = self.num_samples * self.num_replicas
+        num_perms = -(-total_samples // self.dataset_len)
+        indices = torch.cat([torch.randperm(self.dataset_len, generator=self.generator)
+                             for _ in range(num_perms)])
+        return iter(indices[self.rank:total_samples:self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class TimedLoader(object):
+    """ DataLoader wrapper that records the latency to the first batch of each epoch.
+
+    With a deadline (time.time() value), no batch is fetched once it has passed.
+    """
+    def __init__(self, data_loader, on_first_batch, deadline=None):
+        self.data_loader = data_loader
+        self.on_first_batch = on_first_batch
+        self.deadline = deadline
+
+    @property
+    def dataset(self):
+        return self.data_loader.dataset
+
+    @property
+    def sampler(self):
+        return self.data_loader.sampler
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def __iter__(self):
+        profiler = get_profiler()
+        start = time.time()
+        wait_start = time.perf_counter()
+        iterator = iter(self.data_loader)
+        for i in range(len(self.data_loader)):
+            if self.expired():
+                break
+            batch = next(iterator)
+            # the first batch of a fresh loader includes the worker startup
+            profiler.record('first_batch' if i == 0 else 'data_wait', wait_start, time.perf_counter())
+            if i == 0:
+                self.on_first_batch(time.time() - start)
+            yield batch
+            wait_start = time.perf_counter()
+
+
+class ClientDataRegistry(object):
+    """ Build the dataset and the DataLoader of every client once and reuse them across rounds.
+
+    build_dataset(args) is called with args.single_client set to the client, as the
+    runners did every round before. The loaders keep their worker processes alive
+    between rounds (persistent_workers) and the sampler is reseeded from
+    (seed, epoch, client) at every epoch. At most max_loaders loaders (each with
+    num_workers processes) are kept; the least recently used one is shut down
+    first (None: keep all). collate_fn is
+    passed on to the DataLoaders.
+
+    With --local_steps every epoch of a client draws the same number of batches
+    (StepSampler) and with --local_time_budget the loader of a round stops once
+    the budget (in seconds) is spent.
+
+    Startup time is the dataset construction plus the first-batch latency of a new
+    loader (worker spawn included); steady-state time is the first-batch latency of
+    a reused loader.
+    """
+    def __init__(self, args, build_dataset, persistent_workers=True, max_loaders=8, collate_fn=None):
+        self.args = args
+        self.build_dataset = build_dataset
+        self.collate_fn = collate_fn
+        self.persistent_workers = persistent_workers and args.num_workers > 0
+        self.max_loaders = max_loaders
+
+        self.datasets = {}
+        self.loaders = OrderedDict()
+        self.generators = {}
+        self.build_time = {}
+        self.startup_times = []
+        self.steady_times = []
+        self.num_builds = 0
+
+    def __repr__(self):
+        return "ClientDataRegistry(clients=%d, loaders=%d, persistent_workers=%s)" % (
+            len(self.datasets), len(self.loaders), self.persistent_workers)
+
+    def dataset(self, client):
+        if client not in self.datasets:
+            start = time.time()
+            single_client = self.args.single_client
+            self.args.single_client = client
+            with get_profiler().phase('dataset_build'):
+                self.datasets[client] = self.build_dataset(self.args)
+            self.args.single_client = single_client
+            self.build_time[client] = time.time() - start
+        return self.datasets[client]
+
+    def _build_loader(self, client):
+        dataset = self.dataset(client)
+        if self.args.local_steps > 0:
+            # also with --distributed, so the step count matches the schedules
+            self.generators[client] = torch.Generator()
+            num_steps = steps_per_inner_epoch(self.args, len(dataset), self.args.batch_size * get_world_size())
+            sampler = StepSampler(len(dataset), num_steps * self.args.batch_size,
+                                  generator=self.generators[client],
+                                  num_replicas=get_world_size(), rank=get_rank())
+        elif self.args.distributed:
+            sampler = torch.utils.data.DistributedSampler(
+                dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=True)
+        else:
+            self.generators[client] = torch.Generator()
+            sampler = torch.utils.data.RandomSampler(dataset, generator=self.generators[client])
+
+        data_loader = torch.utils.data.DataLoader(
+            dataset, sampler=sampler,
+            batch_size=self.args.batch_size,
+            num_workers=self.args.num_workers,
+            pin_memory=self.args.pin_mem,
+            drop_last=True,
+            persistent_workers=self.persistent_workers,
+            collate_fn=self.collate_fn,
+        )
+        self.num_builds += 1
+        return data_loader
+
+    def _record(self, client, fresh, latency):
+        if fresh:
+            self.startup_times.append(self.build_time.pop(client, 0.) + latency)
+        else:
+            self.steady_times.append(latency)
+
+    def loader(self, client, epoch):
+        """ DataLoader of a client, with its sampler set up for epoch. """
+        fresh = client not in self.loaders
+        if fresh:
+            if self.max_loaders is not None and len(self.loaders) >= self.max_loaders:
+                # dropping the last reference shuts the persistent workers down
+                self.loaders.popitem(last=False)
+            self.loaders[client] = self._build_loader(client)
+        self.loaders.move_to_end(client)
+        data_loader = self.loaders[client]
+
+        if client not in self.generators:
+            data_loader.sampler.set_epoch(epoch)
+        else:
+            client_index = sorted(self.args.dis_cvs_files).index(client) \
+                if client in self.args.dis_cvs_files else 0
+            self.generators[client].manual_seed(
+                int(self.args.seed) * 1000003 + epoch * 1009 + client_index)
+
+        # a fresh loader only counts as startup on its first epoch
+        state = {'fresh': fresh}
+
+        def on_first_batch(latency):
+            self._record(client, state['fresh'], latency)
+            state['fresh'] = False
+
+        # the time budget covers all the local epochs of the round
+        deadline = time.time() + self.args.local_time_budget if self.args.local_time_budget > 0 else None
+        return TimedLoader(data_loader, on_first_batch, deadline=deadline)
+
+    def report(self):
+        """ Startup vs steady-state time to the first batch of a client epoch. """
+        return {
+            'data_clients': len(self.datasets),
+            'data_loader_builds': self.num_builds,
+            'data_startup_count': len(self.startup_times),
+            'data_startup_mean_s': float(np.mean(self.startup_times)) if self.startup_times else 0.,
+            'data_steady_count': len(self.steady_times),
+            'data_steady_mean_s': float(np.mean(self.steady_times)) if self.steady_times else 0.,
+        }
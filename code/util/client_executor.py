@@ -0,0 +1,222 @@
+# --------------------------------------------------------
+# Parallel local training of FL clients in worker processes
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import os
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from .profiler import disable_profiler
+
+
+def _worker_loop(rank, args, train_client, model_all, aggregator, accum, deltas, lock,
+                 task_queue, result_queue, sync_args, num_threads):
+    torch.set_num_threads(num_threads)
+    # forked workers inherit the RNG state of the server, give each its own stream
+    torch.manual_seed(args.seed + rank + 1)
+    np.random.seed(args.seed + rank + 1)
+    # the profile covers the server process only
+    disable_profiler()
+    snapshot = None
+
+    def synced_args(cur_single_client, proxy_single_client):
+        synced = {}
+        for attr in sync_args:
+            values = getattr(args, attr)
+            synced[attr] = {k: values[k] for k in (cur_single_client, proxy_single_client) if k in values}
+        return synced
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        mode, epoch, clients = task
+
+        for cur_single_client, proxy_single_client, weight in clients:
+            model = model_all[proxy_single_client]
+            if mode == 'async':
+                # the server may update the global model at any time, copy the version trained from
+                with lock:
+                    aggregator.broadcast(model)
+                    if snapshot is None:
+                        snapshot = torch.empty_like(aggregator.flat)
+                    snapshot.copy_(aggregator.flat)
+            else:
+                aggregator.broadcast(model)
+
+            train_client(cur_single_client, proxy_single_client, epoch)
+
+            if mode == 'async':
+                delta = aggregator.flatten(model, out=deltas[args.proxy_clients.index(proxy_single_client)])
+                aggregator.send(delta.sub_(snapshot))
+            else:
+                aggregator.accumulate(accum[rank], model, weight)
+            result_queue.put((rank, proxy_single_client, synced_args(cur_single_client, proxy_single_client),
+                              aggregator.pop_num_bytes()))
+
+        if mode != 'async':
+            result_queue.put((rank, None, None, 0))
+
+
+class ClientExecutor(object):
+    """ Run the local training of the selected clients in parallel worker processes.
+
+    Workers are forked once, after the clients have been set up, so they inherit
+    model_all, the optimizers and the datasets without pickling. The global model
+    lives in the shared-memory buffer of the FlatAggregator; every worker loads it
+    into a client model before training and adds the weighted client weights into
+    its own shared accumulation slot. Clients are assigned to workers by their
+    position in args.proxy_clients, so each client's optimizer state stays in the
+    same process across rounds.
+
+    train_client(cur_single_client, proxy_single_client, epoch) runs the E_epoch
+    local epochs of one client. Entries of the per-client dicts named in sync_args
+    (e.g. args.global_step_per_client) are sent back to the server after each client.
+
+    With async_buffer set, run_async() replaces the synchronous rounds (FedBuff):
+    every proxy client trains from the latest global model, its delta is written to
+    a shared slot of its own and the server applies the staleness-weighted mean of
+    every async_buffer deltas as soon as they have arrived.
+    """
+    def __init__(self, args, train_client, model_all, aggregator, num_workers,
+                 sync_args=('global_step_per_client',), async_buffer=0):
+        assert torch.device(args.device).type == 'cpu', "the client executor runs CPU clients only"
+        assert num_workers > 0
+
+        self.args = args
+        self.num_workers = num_workers
+        self.aggregator = aggregator
+        self.sync_args = sync_args
+
+        aggregator.flat.share_memory_()
+        self.accum = torch.zeros(num_workers, aggregator.numel).share_memory_()
+        # one delta slot per proxy client, a proxy client has at most one update in flight
+        num_slots = len(args.proxy_clients) if async_buffer > 0 else 0
+        self.deltas = torch.zeros(num_slots, aggregator.numel).share_memory_()
+
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        ctx = mp.get_context('fork')
+        self.lock = ctx.Lock()
+        self.result_queue = ctx.Queue()
+        self.task_queues = []
+        self.workers = []
+        for rank in range(num_workers):
+            task_queue = ctx.Queue()
+            # not daemonic: workers start DataLoader processes of their own
+            worker = ctx.Process(
+                target=_worker_loop,
+                args=(rank, args, train_client, model_all, aggregator, self.accum, self.deltas, self.lock,
+                      task_queue, self.result_queue, sync_args, num_threads))
+            worker.start()
+            self.task_queues.append(task_queue)
+            self.workers.append(worker)
+
+        print("Client executor: %d workers x %d threads" % (num_workers, num_threads))
+
+    def worker_of(self, proxy_single_client):
+        return self.args.proxy_clients.index(proxy_single_client) % self.num_workers
+
+    def run_round(self, epoch, cur_selected_clients, proxy_clients, weights):
+        """ Train one communication round; returns once every worker is done. """
+        self.accum.zero_()
+        tasks = [[] for _ in range(self.num_workers)]
+        for cur_single_client, proxy_single_client in zip(cur_selected_clients, proxy_clients):
+            tasks[self.worker_of(proxy_single_client)].append(
+                (cur_single_client, proxy_single_client, weights[proxy_single_client]))
+
+        for task_queue, clients in zip(self.task_queues, tasks):
+            task_queue.put(('sync', epoch, clients))
+
+        num_done = 0
+        while num_done < self.num_workers:
+            _, proxy_single_client, _ = self.get_result(epoch)
+            if proxy_single_client is None:
+                num_done += 1
+
+    def get_result(self, epoch):
+        """ Wait for the next client result of a worker and merge its synced args and bytes. """
+        while True:
+            try:
+                rank, proxy_single_client, synced, num_bytes = self.result_queue.get(timeout=60)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("a client worker exited during round %d" % epoch)
+                continue
+            if proxy_single_client is not None:
+                for attr, values in synced.items():
+                    getattr(self.args, attr).update(values)
+                self.aggregator.num_bytes += num_bytes
+            return rank, proxy_single_client, num_bytes
+
+    def run_async(self, num_updates, buffer_size, select_client, on_update, staleness_exponent=0.5):
+        """ Asynchronous FedAvg with a buffer of buffer_size client updates (FedBuff).
+
+        select_client(in_flight) picks the client trained next by a free proxy client
+        (in_flight: clients currently trained). A delta computed from global version v
+        and received at version t is weighted by its client size times
+        (1 + t - v) ** -staleness_exponent; the weighted mean of the buffer is added
+        to the global model (through the server optimizer, if any).
+        on_update(version, stats) is called after every server update; the run stops
+        after num_updates updates, once the updates still in flight are drained.
+        """
+        assert self.deltas.shape[0] > 0, "the executor was not created with async_buffer"
+        args = self.args
+        aggregator = self.aggregator
+        buffer = torch.zeros_like(aggregator.flat)
+        version = 0
+        started = {}
+        buffered = []
+
+        def dispatch(proxy_single_client):
+            in_flight = [client for client, _ in started.values()]
+            cur_single_client = select_client(in_flight)
+            started[proxy_single_client] = (cur_single_client, version)
+            self.task_queues[self.worker_of(proxy_single_client)].put(
+                ('async', version, [(cur_single_client, proxy_single_client, 1.)]))
+
+        for proxy_single_client in args.proxy_clients:
+            dispatch(proxy_single_client)
+
+        while version < num_updates:
+            _, proxy_single_client, _ = self.get_result(version)
+            cur_single_client, start_version = started.pop(proxy_single_client)
+            staleness = version - start_version
+            client_len = args.clients_with_len[cur_single_client]
+            weight = client_len * (1. + staleness) ** -staleness_exponent
+            buffer.add_(self.deltas[args.proxy_clients.index(proxy_single_client)], alpha=weight)
+            buffered.append((client_len, staleness))
+
+            if len(buffered) == buffer_size:
+                total_len = sum(client_len for client_len, _ in buffered)
+                with self.lock:
+                    aggregator.update(buffer.div_(total_len).add_(aggregator.flat))
+                stats = {'version': version,
+                         'num_updates': len(buffered),
+                         'mean_staleness': float(np.mean([s for _, s in buffered])),
+                         'max_staleness': max(s for _, s in buffered)}
+                version += 1
+                buffer.zero_()
+                buffered = []
+                on_update(version - 1, stats)
+
+            if version < num_updates:
+                dispatch(proxy_single_client)
+
+        # let the clients still training finish, their updates are dropped
+        while started:
+            _, proxy_single_client, _ = self.get_result(version)
+            started.pop(proxy_single_client)
+
+    def average_model(self, model_avg):
+        self.aggregator.update(self.accum.sum(dim=0))
+        self.aggregator.scatter(model_avg)
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,156 @@
+# --------------------------------------------------------
+# Shared-weight client pool for FedAvg simulation
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import os
+
+import torch
+
+from .aggregation import unwrap_model
+from .state_store import MmapStateStore
+
+
+def state_to_device(state, device):
+    """ Move every tensor of a (nested) state dict to device. """
+    if isinstance(state, torch.Tensor):
+        return state.to(device)
+    elif isinstance(state, dict):
+        return {k: state_to_device(v, device) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_device(v, device) for v in state)
+    return state
+
+
+class ClientPool(object):
+    """ Simulate all proxy clients with one working model.
+
+    Clients train strictly one after another, so instead of one model (and one
+    optimizer) per client, the working model is loaded with the global weights at
+    the start of every client turn and only the client's persistent state is kept
+    between turns: optimizer state, loss scaler state and the model buffers that
+    the aggregator does not average. The state can stay on the device ('none'), be
+    spilled to host memory ('cpu'), to one file per client ('disk') or be paged to
+    memory-mapped files ('mmap'); with 'mmap' the state of the client following
+    the current one in client_order is prefetched while the current client trains.
+
+    Client updates are accumulated into a flat buffer at the end of each turn, so
+    the global model is available as soon as the round ends.
+    """
+    def __init__(self, model, optimizer, loss_scaler, aggregator, offload='none', state_dir=None,
+                 client_order=None, pin_memory=False):
+        assert offload in ('none', 'cpu', 'disk', 'mmap'), "unknown offload mode: %s" % offload
+        if offload in ('disk', 'mmap'):
+            assert state_dir is not None, "offload='%s' needs a state_dir" % offload
+            os.makedirs(state_dir, exist_ok=True)
+
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_scaler = loss_scaler
+        self.aggregator = aggregator
+        self.aggregated = set(aggregator.names)
+        self.offload = offload
+        self.state_dir = state_dir
+        self.client_order = list(client_order) if client_order is not None else []
+        self.store = MmapStateStore(state_dir, pin_memory=pin_memory) if offload == 'mmap' else None
+
+        # state of a client that has not trained yet
+        self.initial_state = state_to_device(self.get_state(), 'cpu')
+        self.client_states = {}
+
+        self.accum = torch.zeros_like(aggregator.flat)
+        self.num_accumulated = 0
+
+    def __repr__(self):
+        return "ClientPool(offload=%s, clients=%d)" % (self.offload, len(self.client_states))
+
+    def get_state(self):
+        model_without_ddp = unwrap_model(self.model)
+        return {
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.loss_scaler.state_dict(),
+            # averaged buffers come with the global model, keep the others per client
+            'buffers': {name: buf.detach().clone() for name, buf in model_without_ddp.named_buffers()
+                        if name not in self.aggregated},
+        }
+
+    def set_state(self, state):
+        model_without_ddp = unwrap_model(self.model)
+        self.optimizer.load_state_dict(state['optimizer'])
+        if state['scaler']:
+            self.loss_scaler.load_state_dict(state['scaler'])
+        buffers = dict(model_without_ddp.named_buffers())
+        for name, buf in state['buffers'].items():
+            buffers[name].copy_(buf)
+
+    def state_path(self, proxy_single_client):
+        return os.path.join(self.state_dir, '%s_state.pth' % proxy_single_client)
+
+    def save_state(self, proxy_single_client):
+        state = self.get_state()
+        if self.offload == 'none':
+            self.client_states[proxy_single_client] = state
+        elif self.offload == 'cpu':
+            self.client_states[proxy_single_client] = state_to_device(state, 'cpu')
+        elif self.offload == 'mmap':
+            self.store.save(proxy_single_client, state)
+            self.client_states[proxy_single_client] = None
+        else:
+            torch.save(state, self.state_path(proxy_single_client))
+            self.client_states[proxy_single_client] = None
+
+    def load_state(self, proxy_single_client):
+        if proxy_single_client not in self.client_states:
+            return self.initial_state
+        if self.offload == 'disk':
+            return torch.load(self.state_path(proxy_single_client), map_location='cpu')
+        if self.offload == 'mmap':
+            return self.store.load(proxy_single_client)
+        return self.client_states[proxy_single_client]
+
+    def prefetch_next(self, proxy_single_client):
+        if self.store is None or proxy_single_client not in self.client_order:
+            return
+        index = self.client_order.index(proxy_single_client)
+        next_client = self.client_order[(index + 1) % len(self.client_order)]
+        if next_client != proxy_single_client:
+            self.store.prefetch(next_client)
+
+    def checkout(self, proxy_single_client):
+        """ Load the global weights and the state of a client into the working model. """
+        self.aggregator.broadcast(self.model)
+        self.set_state(self.load_state(proxy_single_client))
+        self.prefetch_next(proxy_single_client)
+        return self.model
+
+    def checkin(self, proxy_single_client, weight):
+        """ Accumulate the client update and keep its state for the next round. """
+        self.aggregator.accumulate(self.accum, self.model, weight, first=(self.num_accumulated == 0))
+        self.num_accumulated += 1
+        self.save_state(proxy_single_client)
+
+    def average_model(self, model_avg):
+        """ Finish the round: the accumulated update becomes the global model. """
+        assert self.num_accumulated > 0, "no client update was accumulated in this round"
+        self.aggregator.update(self.accum)
+        self.aggregator.scatter(model_avg)
+        self.num_accumulated = 0
+
+
+def create_client_pool(args, model_all, optimizer_all, loss_scaler_all, aggregator):
+    """ Build the client pool of the runners, or None when --client_pool is not set. """
+    if not args.client_pool:
+        return None
+    
+    first_client = args.proxy_clients[0]
+    state_dir = args.client_state_dir
+    if state_dir is None:
+        state_dir = os.path.join(args.output_dir, 'client_states')
+    
+    client_pool = ClientPool(model_all[first_client], optimizer_all[first_client],
+                             loss_scaler_all[first_client], aggregator,
+                             offload=args.client_state_offload, state_dir=state_dir,
+                             client_order=args.proxy_clients,
+                             pin_memory=args.pin_mem and torch.cuda.is_available())
+    print("Client pool = %s" % str(client_pool))
+    return client_pool
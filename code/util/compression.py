@@ -0,0 +1,75 @@
+# --------------------------------------------------------
+# Client update codecs to simulate the FedAvg uplink
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import torch
+
+
+def payload_bytes(payload):
+    """ Bytes on the wire of an encoded update (the tensors it is made of). """
+    return sum(t.numel() * t.element_size() for t in payload)
+
+
+class FP16Codec(object):
+    """ Update cast to half precision. """
+    name = 'fp16'
+
+    def encode(self, delta, numels):
+        return (delta.half(),)
+
+    def decode(self, payload, out, numels):
+        return out.copy_(payload[0])
+
+
+class Int8Codec(object):
+    """ Symmetric 8-bit quantization with one fp32 scale per tensor. """
+    name = 'int8'
+
+    def encode(self, delta, numels):
+        chunks = delta.split(numels)
+        scales = torch.stack([chunk.abs().max() for chunk in chunks]) / 127.
+        scales[scales == 0] = 1.
+        q = torch.empty(delta.numel(), dtype=torch.int8, device=delta.device)
+        for q_chunk, chunk, scale in zip(q.split(numels), chunks, scales):
+            q_chunk.copy_(torch.round(chunk / scale))
+        return q, scales
+
+    def decode(self, payload, out, numels):
+        q, scales = payload
+        for out_chunk, q_chunk, scale in zip(out.split(numels), q.split(numels), scales):
+            torch.mul(q_chunk.float(), scale, out=out_chunk)
+        return out
+
+
+class TopKCodec(object):
+    """ Top-k sparsification: the largest-magnitude entries as int32 index + fp32 value. """
+    name = 'topk'
+
+    def __init__(self, ratio=0.01):
+        assert 0 < ratio <= 1, "topk ratio must be in (0, 1]"
+        self.ratio = ratio
+
+    def encode(self, delta, numels):
+        k = max(1, int(delta.numel() * self.ratio))
+        _, indices = delta.abs().topk(k, sorted=False)
+        return indices.int(), delta[indices]
+
+    def decode(self, payload, out, numels):
+        indices, values = payload
+        out.zero_()
+        out[indices.long()] = values
+        return out
+
+
+def build_codec(args):
+    """ Update codec of --update_codec, or None to average the client weights directly. """
+    if args.update_codec == 'none':
+        return None
+    if args.update_codec == 'topk':
+        return TopKCodec(args.topk_ratio)
+    if args.update_codec == 'int8':
+        return Int8Codec()
+    if args.update_codec == 'fp16':
+        return FP16Codec()
+    raise ValueError("unknown update codec: %s" % args.update_codec)
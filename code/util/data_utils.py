@@ -10,29 +10,44 @@ import numpy as np
 import pandas as pd
 
 import os
+import random
 from .datasets import DataAugmentationForPretrain, build_transform
+from .image_cache import get_image_cache
+from .label_index import client_files, get_label_index, read_names
+from .shard_store import get_shard_store
+from .token_cache import load_token_cache, view_seed
 
 from PIL import Image
 from skimage.transform import resize
 import cv2
+import torch
 import torch.utils.data as data
 
+def decode_image(path, size):
+    """ RGB uint8 PIL image of size (w, h).
+
+    JPEG files are decoded at the smallest power-of-two reduction that is
+    still at least size (PIL draft mode); the single resize stays in uint8.
+    """
+    img = Image.open(path)
+    img.draft('RGB', size)
+    img = img.convert('RGB')
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR)
+    return img
+
+
 class DatasetFLPretrain(data.Dataset):
     """ data loader for pre-training """
     def __init__(self, args):    
                 
-        if args.split_type == 'central':
-            cur_clint_path = os.path.join(args.data_path, args.split_type, args.single_client)
-        else:
-            cur_clint_path = os.path.join(args.data_path, f'{args.n_clients}_clients', 
-                                            args.split_type, args.single_client)
-
-        self.img_paths = list({line.strip().split(',')[0] for line in open(cur_clint_path)})
-        
-        self.labels = {line.strip().split(',')[0]: float(line.strip().split(',')[1]) for line in
-                        open(os.path.join(args.data_path, 'labels.csv'))}
+        self.label_index = get_label_index(args)
+        self.img_ids = self.label_index.client_ids(args.single_client)
     
         self.transform = DataAugmentationForPretrain(args)
+        self.image_cache = get_image_cache(args, 'train')
+        self.shard_store = get_shard_store(args, 'train')
+        self.token_cache = load_token_cache(args) if args.model_name == 'beit' else None
         self.args = args
     
     def __getitem__(self, index):
@@ -42,15 +57,37 @@ class DatasetFLPretrain(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        index = index % len(self.img_paths)
+        index = index % len(self.img_ids)
+        image_id = self.img_ids[index]
         
-        path = os.path.join(self.args.data_path, 'train', self.img_paths[index])
-        name = self.img_paths[index]
-
-        target = self.labels[name]
+        target = self.label_index.label(image_id)
         target = np.asarray(target).astype('int64')
         
-        if self.args.data_set == 'Retina':
+        img = self.load_image(image_id)
+        
+        if self.token_cache is not None:
+            # replay a cached view: its visual tokens replace the dVAE input image
+            view = random.randrange(self.token_cache.num_views)
+            for_patches, _ = self.transform.view(img, self.token_cache.view_seed(image_id, view))
+            input_ids = torch.from_numpy(self.token_cache[image_id, view].astype(np.int64))
+            sample = (self.transform.patch_transform(for_patches), input_ids)
+            if self.transform.masked_position_generator is not None:
+                sample += (self.transform.masked_position_generator(),)
+        elif self.transform is not None:
+            sample = self.transform(img)
+            
+        return sample, target
+
+    def load_image(self, image_id):
+        """ Training image as an RGB PIL image. """
+        name = self.label_index.name(image_id)
+        path = os.path.join(self.args.data_path, 'train', name)
+        if self.shard_store is not None and self.image_cache is None:
+            path = self.shard_store.open(name)
+        
+        if self.image_cache is not None:
+            img = self.image_cache[name]
+        elif self.args.data_set == 'Retina':
             img = np.load(path)
             img = resize(img, (256, 256))
         else:
@@ -61,14 +98,35 @@ class DatasetFLPretrain(data.Dataset):
         elif img.shape[2] >= 3:
             img = img[:,:,:3]
         
-        if self.transform is not None:
-            img = Image.fromarray(np.uint8(img))
-            sample = self.transform(img)
-            
-        return sample, target
+        return Image.fromarray(np.uint8(img))
 
     def __len__(self):
-        return len(self.img_paths)
+        return len(self.img_ids)
+
+
+class DatasetTokenViews(DatasetFLPretrain):
+    """ (image id, view, dVAE input) of the augmented views tokenized into the BEiT token cache """
+    def __init__(self, args, num_views):
+        self.label_index = get_label_index(args)
+        self.image_ids = np.unique(self.label_index.ids)
+        self.num_images = len(self.label_index.names)
+        self.num_views = num_views
+        
+        self.transform = DataAugmentationForPretrain(args)
+        self.image_cache = get_image_cache(args, 'train')
+        self.shard_store = get_shard_store(args, 'train')
+        self.args = args
+    
+    def __getitem__(self, index):
+        image_id = self.image_ids[index // self.num_views]
+        view = index % self.num_views
+        
+        _, for_visual_tokens = self.transform.view(
+            self.load_image(image_id), view_seed(self.args.token_cache_seed, image_id, self.num_views, view))
+        return int(image_id), view, self.transform.visual_token_transform(for_visual_tokens)
+
+    def __len__(self):
+        return len(self.image_ids) * self.num_views
 
 
 class DatasetFLFinetune(data.Dataset):
@@ -87,12 +145,15 @@ class DatasetFLFinetune(data.Dataset):
             cur_clint_path = os.path.join(args.data_path, f'{args.n_clients}_clients', 
                                             args.split_type, args.single_client)
         
-        self.img_paths = list({line.strip().split(',')[0] for line in open(cur_clint_path)})
-        
-        self.labels = {line.strip().split(',')[0]: float(line.strip().split(',')[1]) for line in
-                        open(os.path.join(args.data_path, 'labels.csv'))}
+        self.label_index = get_label_index(args)
+        if is_train:
+            self.img_ids = self.label_index.client_ids(args.single_client)
+        else:
+            self.img_ids = self.label_index.lookup(read_names(cur_clint_path))
         
         self.transform = build_transform(is_train, mode, args)
+        self.image_cache = get_image_cache(args, self.phase)
+        self.shard_store = get_shard_store(args, self.phase)
         
         self.args = args
     
@@ -103,38 +164,47 @@ class DatasetFLFinetune(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        index = index % len(self.img_paths)
+        index = index % len(self.img_ids)
+        image_id = self.img_ids[index]
         
-        path = os.path.join(self.args.data_path, self.phase, self.img_paths[index])
-        name = self.img_paths[index]
+        name = self.label_index.name(image_id)
         
         try:
-            target = self.labels[name]
+            target = self.label_index.label(image_id)
             target = np.asarray(target).astype('int64')
         except:
             print(name, index)
         
-        if self.args.data_set == 'Retina':
+        img = self.load_image(name)
+        
+        if self.transform is not None:
+            sample = self.transform(img)
+                    
+        return sample, target
+
+    def load_image(self, name):
+        """ Image of this phase as an RGB PIL image. """
+        path = os.path.join(self.args.data_path, self.phase, name)
+        if self.shard_store is not None and self.image_cache is None:
+            path = self.shard_store.open(name)
+        
+        if self.image_cache is not None:
+            img = self.image_cache[name]
+        elif self.args.data_set == 'Retina':
             img = np.load(path)
             img = resize(img, (256, 256))
-
         else:
-            img = np.array(Image.open(path).convert("RGB"))
-            img = resize(img, (224, 224)) # add this line
+            return decode_image(path, (224, 224))
         
         if img.ndim < 3:
             img = np.stack((img,)*3, axis=-1)
         elif img.shape[2] >= 3:
             img = img[:,:,:3]
         
-        if self.transform is not None:
-            img = Image.fromarray(np.uint8(img))
-            sample = self.transform(img)
-                    
-        return sample, target
+        return Image.fromarray(np.uint8(img))
 
     def __len__(self):
-        return len(self.img_paths)
+        return len(self.img_ids)
 
 
 def create_dataset_and_evalmetrix(args, mode='pretrain'):
@@ -143,22 +213,13 @@ def create_dataset_and_evalmetrix(args, mode='pretrain'):
     if args.split_type == 'central':
         args.dis_cvs_files = ['central']
 
-    if args.split_type == 'central':
-        args.dis_cvs_files = os.listdir(os.path.join(args.data_path, args.split_type))
-    else:
-        args.dis_cvs_files = os.listdir(os.path.join(args.data_path, f'{args.n_clients}_clients', args.split_type))
+    args.dis_cvs_files = client_files(args)
     
     args.clients_with_len = {}
     
+    label_index = get_label_index(args)
     for single_client in args.dis_cvs_files:
-        if args.split_type == 'central':
-            img_paths = list({line.strip().split(',')[0] for line in
-                            open(os.path.join(args.data_path, args.split_type, single_client))})
-        else:
-            img_paths = list({line.strip().split(',')[0] for line in
-                                open(os.path.join(args.data_path, f'{args.n_clients}_clients',
-                                                args.split_type, single_client))})
-        args.clients_with_len[single_client] = len(img_paths)
+        args.clients_with_len[single_client] = label_index.client_len(single_client)
     
     
     ## step 2: get the evaluation matrix
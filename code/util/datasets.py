@@ -2,12 +2,18 @@
 # Data Augmentation techniques for Fed-BEiT and Fed-MAE during 
 # pre-training and fine-tuning.
 # --------------------------------------------------------'
+import random
+
+import numpy as np
 import torch
 
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
 from .transforms import RandomResizedCropAndInterpolationWithTwoPic
+from .batch_transforms import BatchRandomResizedCrop, BatchRandomGrayscale, BatchColorJitter, \
+    BatchRandomHorizontalFlip, BatchNormalize
 from .dall_e.utils import map_pixels
-from .masking_generator import MaskingGenerator
+from .masking_generator import MaskingGenerator, BatchMaskingGenerator, MaskBank
 
 from PIL import Image
 Image.LOAD_TRUNCATED_IMAGES = True
@@ -16,6 +22,42 @@ Image.LOAD_TRUNCATED_IMAGES = True
 RETINA_MEAN = (0.5007, 0.5010, 0.5019)
 RETINA_STD = (0.0342, 0.0535, 0.0484)
 
+_mask_banks = {}
+
+
+def build_masking_generator(args):
+    """ BEiT masked position generator for args.mask_mode: 'sample', 'batch' or 'bank' """
+    args.num_mask_patches = int(round((args.mask_ratio * 196.0)/5.0)*5.0) 
+    
+    generator_kwargs = dict(
+        num_masking_patches=args.num_mask_patches,
+        max_num_patches=args.max_mask_patches_per_block,
+        min_num_patches=args.min_mask_patches_per_block,
+    )
+    if args.mask_mode == 'sample':
+        return MaskingGenerator(args.window_size, **generator_kwargs)
+    
+    generator = BatchMaskingGenerator(args.window_size, **generator_kwargs)
+    if args.mask_mode == 'bank':
+        # one bank per process, shared by the datasets of all clients
+        key = (str(generator), args.mask_bank_size)
+        if key not in _mask_banks:
+            _mask_banks[key] = MaskBank(generator, args.mask_bank_size)
+        return _mask_banks[key]
+    return generator
+
+
+class MaskCollator(object):
+    """ default_collate of (patches, visual tokens) samples plus a batch of BEiT masks """
+    def __init__(self, args):
+        self.masked_position_generator = build_masking_generator(args)
+    
+    def __call__(self, batch):
+        samples, targets = default_collate(batch)
+        masks = torch.from_numpy(self.masked_position_generator(len(batch)))
+        return list(samples) + [masks], targets
+
+
 class DataAugmentationForPretrain(object):
     """ data transformations for pre-training"""
     def __init__(self, args):
@@ -78,13 +120,10 @@ class DataAugmentationForPretrain(object):
             else:
                 raise NotImplementedError()
             
-            args.num_mask_patches = int(round((args.mask_ratio * 196.0)/5.0)*5.0) 
-
-            self.masked_position_generator = MaskingGenerator(
-                args.window_size, num_masking_patches=args.num_mask_patches,
-                max_num_patches=args.max_mask_patches_per_block,
-                min_num_patches=args.min_mask_patches_per_block,
-            )
+            self.masked_position_generator = build_masking_generator(args)
+            if args.mask_mode == 'batch':
+                # masks are drawn per batch by MaskCollator
+                self.masked_position_generator = None
         
         elif args.model_name == 'mae':
             if args.data_set == 'Retina':
@@ -106,6 +145,9 @@ class DataAugmentationForPretrain(object):
                     transforms.RandomGrayscale(p=0.2),
                     transforms.ColorJitter(0.1, 0.1, 0.1),
                     transforms.RandomHorizontalFlip(p=0.5)])
+            
+            # --batch_aug: only the uint8 load here, the rest runs on the batch (BatchAugmentationForMAE)
+            self.load_transform = BatchAugmentationForMAE(args).load if args.batch_aug else None
 
         self.patch_transform = transforms.Compose([
             transforms.ToTensor(),
@@ -119,13 +161,31 @@ class DataAugmentationForPretrain(object):
     def __call__(self, image):
         if self.args.model_name == 'beit':
             for_patches, for_visual_tokens = self.common_transform(image)
+            if self.masked_position_generator is None:
+                return self.patch_transform(for_patches), self.visual_token_transform(for_visual_tokens)
             return \
                 self.patch_transform(for_patches), self.visual_token_transform(for_visual_tokens), \
                 self.masked_position_generator()
         elif self.args.model_name == 'mae':
+            if self.load_transform is not None:
+                return self.load_transform(image)
             for_patches = self.common_transform(image)
             return self.patch_transform(for_patches)
 
+    def view(self, image, view_seed):
+        """ (for_patches, for_visual_tokens) of BEiT's common_transform replayed under view_seed.
+        
+        The global python and torch RNG streams are left as they were, so the masks and
+        the other augmentations of the worker stay random.
+        """
+        py_state, torch_state = random.getstate(), torch.get_rng_state()
+        random.seed(view_seed)
+        torch.manual_seed(view_seed)
+        views = self.common_transform(image)
+        random.setstate(py_state)
+        torch.set_rng_state(torch_state)
+        return views
+    
     def __repr__(self):
         if self.args.model_name == 'beit':
             repr = "(DataAugmentationForBEiT,\n"
@@ -143,6 +203,90 @@ class DataAugmentationForPretrain(object):
         return repr
 
 
+class BatchAugmentationForMAE(object):
+    """ MAE pre-training augmentations of DataAugmentationForPretrain, applied to a collated batch
+    
+    load() is the per-image part (DataAugmentationForPretrain with --batch_aug): the
+    uint8 image, downsized only beyond the side its smallest crop can use, and its
+    original (width, height). collate() pads a batch of them to a common size; the
+    instance is then called on the batch on the training device. Every image gets its
+    own random crop, jitter and flip. On a single-thread CPU it is slower than the
+    per-image PIL transforms (benchmarks/bench_batch_aug.py).
+    """
+    def __init__(self, args):
+        
+        if args.data_set == 'Retina':
+            mean, std = RETINA_MEAN, RETINA_STD
+        else:   
+            mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+        
+        if args.data_set == 'Retina':
+            self.crop = BatchRandomResizedCrop(args.input_size, scale=(0.2, 1.0), interpolation='bicubic')
+            self.color_transform = [
+                BatchRandomGrayscale(p=0.2),
+                BatchColorJitter(0.4, 0.4, 0.4),
+                BatchRandomHorizontalFlip(p=0.5)]
+        
+        elif args.data_set == 'COVIDfl':
+            self.crop = BatchRandomResizedCrop(args.input_size, scale=(0.4, 1.0), interpolation='bicubic')
+            self.color_transform = [
+                BatchColorJitter(hue=.05, saturation=.05),
+                BatchRandomHorizontalFlip(p=0.5)]
+        
+        else:
+            self.crop = BatchRandomResizedCrop(args.input_size, scale=(0.2, 1.0), interpolation='bicubic')
+            self.color_transform = [
+                BatchRandomGrayscale(p=0.2),
+                BatchColorJitter(0.1, 0.1, 0.1),
+                BatchRandomHorizontalFlip(p=0.5)]
+        
+        self.normalize = BatchNormalize(mean, std)
+    
+    def load(self, image):
+        """ (3, H, W) uint8 tensor of a PIL image and its original (width, height). """
+        size = torch.tensor(image.size)
+        max_size = self.crop.max_source_size
+        if max(image.size) > max_size:
+            factor = max_size / max(image.size)
+            image = image.resize((max(1, round(image.size[0] * factor)), max(1, round(image.size[1] * factor))),
+                                 Image.BICUBIC)
+        return torch.from_numpy(np.array(image.convert("RGB"), dtype=np.uint8)).permute(2, 0, 1), size
+    
+    @staticmethod
+    def collate(batch):
+        """ ((images, sizes, loaded_sizes), targets) of a list of (load() output, target)
+        dataset samples; the images are padded to a common size by repeating their last
+        row and column.
+        """
+        samples, targets = zip(*batch)
+        height = max(image.shape[1] for image, _ in samples)
+        width = max(image.shape[2] for image, _ in samples)
+        images = torch.empty(len(samples), 3, height, width, dtype=torch.uint8)
+        loaded_sizes = torch.empty(len(samples), 2, dtype=torch.long)
+        for k, (image, _) in enumerate(samples):
+            h, w = image.shape[1:]
+            images[k, :, :h, :w] = image
+            images[k, :, h:, :w] = image[:, h - 1:h]
+            images[k, :, :, w:] = images[k, :, :, w - 1:w]
+            loaded_sizes[k, 0], loaded_sizes[k, 1] = w, h
+        sizes = torch.stack([size for _, size in samples])
+        return (images, sizes, loaded_sizes), default_collate(targets)
+    
+    def __call__(self, images, sizes, loaded_sizes=None):
+        x = self.crop(images.float().div_(255), sizes, loaded_sizes)
+        for t in self.color_transform:
+            x = t(x)
+        return self.normalize(x)
+    
+    def __repr__(self):
+        repr = "(BatchAugmentationForMAE,\n"
+        repr += "  crop = %s,\n" % str(self.crop)
+        repr += "  color_transform = %s,\n" % ', '.join(str(t) for t in self.color_transform)
+        repr += "  normalize = %s,\n" % str(self.normalize)
+        repr += ")"
+        return repr
+
+
 
 def build_transform(is_train, mode, args):
     """ data transformations for fine-tuning"""
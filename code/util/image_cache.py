@@ -0,0 +1,124 @@
+# --------------------------------------------------------
+# Memory-mapped cache of preprocessed Retina images
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import argparse
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from skimage.transform import resize
+
+
+def load_retina_image(path, size=256):
+    """ Decode and resize one Retina .npy image to the uint8 RGB array fed to the transforms. """
+    img = np.load(path)
+    img = resize(img, (size, size))
+
+    if img.ndim < 3:
+        img = np.stack((img,)*3, axis=-1)
+    elif img.shape[2] >= 3:
+        img = img[:,:,:3]
+    return np.uint8(img)
+
+
+def cache_paths(cache_dir, phase, size=256):
+    prefix = os.path.join(cache_dir, '%s_%d' % (phase, size))
+    return prefix + '.u8', prefix + '_index.txt'
+
+
+def build_image_cache(data_path, phase, cache_dir, size=256, num_workers=0):
+    """ Preprocess every image of data_path/phase into one uint8 (N, size, size, 3) array file. """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path_phase = os.path.join(data_path, phase)
+    names = sorted(os.listdir(data_path_phase))
+    paths = [os.path.join(data_path_phase, name) for name in names]
+    array_path, index_path = cache_paths(cache_dir, phase, size)
+
+    # write under temporary names so concurrent builders never expose a partial cache
+    tmp_suffix = '.tmp%d' % os.getpid()
+    images = np.memmap(array_path + tmp_suffix, dtype=np.uint8, mode='w+',
+                       shape=(max(len(names), 1), size, size, 3))
+    if num_workers > 0:
+        with Pool(num_workers) as pool:
+            for i, img in enumerate(pool.imap(partial(load_retina_image, size=size), paths, chunksize=16)):
+                images[i] = img
+    else:
+        for i, path in enumerate(paths):
+            images[i] = load_retina_image(path, size)
+    images.flush()
+    del images
+
+    with open(index_path + tmp_suffix, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    os.replace(array_path + tmp_suffix, array_path)
+    os.replace(index_path + tmp_suffix, index_path)
+    print("Image cache: %d %s images -> %s" % (len(names), phase, array_path))
+
+
+class ImageCache(object):
+    """ Read-only view of a preprocessed image cache, indexed by image name.
+
+    The array file is mapped lazily in every process that reads it, so DataLoader
+    workers slice the page cache directly instead of decoding and resizing.
+    """
+    def __init__(self, cache_dir, phase, size=256):
+        self.array_path, self.index_path = cache_paths(cache_dir, phase, size)
+        with open(self.index_path) as f:
+            names = [line.rstrip('\n') for line in f if line.strip()]
+        self.index = {name: i for i, name in enumerate(names)}
+        self.shape = (max(len(names), 1), size, size, 3)
+        self.images = None
+
+    def __repr__(self):
+        return "ImageCache(path=%s, images=%d)" % (self.array_path, len(self.index))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        if self.images is None:
+            self.images = np.memmap(self.array_path, dtype=np.uint8, mode='r', shape=self.shape)
+        return self.images[self.index[name]]
+
+    def __getstate__(self):
+        # never pickle the mapping itself (spawned workers would receive a copy)
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+
+_image_caches = {}
+
+
+def get_image_cache(args, phase, size=256):
+    """ Image cache of a split, built on first use; None unless --image_cache is set for Retina. """
+    if not args.image_cache or args.data_set != 'Retina':
+        return None
+
+    cache_dir = args.image_cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(args.data_path, 'cache')
+    key = (cache_dir, phase, size)
+    if key not in _image_caches:
+        if not os.path.exists(cache_paths(cache_dir, phase, size)[1]):
+            build_image_cache(args.data_path, phase, cache_dir, size=size, num_workers=args.num_workers)
+        _image_caches[key] = ImageCache(cache_dir, phase, size=size)
+    return _image_caches[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Build the Retina image cache', add_help=False)
+    parser.add_argument('--data_path', required=True, type=str)
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='default: data_path/cache')
+    parser.add_argument('--phases', default=['train', 'test'], nargs='+')
+    parser.add_argument('--size', default=256, type=int)
+    parser.add_argument('--num_workers', default=8, type=int)
+    opts = parser.parse_args()
+
+    cache_dir = opts.cache_dir if opts.cache_dir is not None else os.path.join(opts.data_path, 'cache')
+    for phase in opts.phases:
+        build_image_cache(opts.data_path, phase, cache_dir, size=opts.size, num_workers=opts.num_workers)
@@ -0,0 +1,162 @@
+# --------------------------------------------------------
+# Label and client-split index shared by the FL datasets
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import os
+
+import numpy as np
+
+
+def read_names(csv_path):
+    """ First column of a split csv (image names), as a list of str. """
+    with open(csv_path) as f:
+        return [line.strip().split(',')[0] for line in f if line.strip()]
+
+
+def read_labels(csv_path):
+    """ Image names and float labels of labels.csv. """
+    names, labels = [], []
+    with open(csv_path) as f:
+        for line in f:
+            if line.strip():
+                fields = line.strip().split(',')
+                names.append(fields[0])
+                labels.append(float(fields[1]))
+    return names, np.array(labels, dtype=np.float64)
+
+
+def encode_names(names):
+    return np.array([name.encode('utf-8') for name in names], dtype=bytes)
+
+
+class LabelIndex(object):
+    """ Image names, labels and client membership of one data split as flat NumPy arrays.
+
+    names is the sorted array of every image name (utf-8 bytes) and labels[i] the
+    label of names[i] (NaN when the image is not in labels.csv). The images of
+    clients[c] are ids[offsets[c]:offsets[c + 1]]. Plain arrays instead of dicts of
+    Python strings are shared copy-on-write by forked DataLoader workers without
+    being touched by reference counting.
+    """
+    def __init__(self, names, labels, clients, offsets, ids):
+        self.names = names
+        self.labels = labels
+        self.clients = [str(c) for c in clients]
+        self.offsets = offsets
+        self.ids = ids
+        self.client_pos = {c: i for i, c in enumerate(self.clients)}
+
+    def __repr__(self):
+        return "LabelIndex(images=%d, clients=%d)" % (len(self.names), len(self.clients))
+
+    @classmethod
+    def build(cls, data_path, split_path):
+        label_names, label_values = read_labels(os.path.join(data_path, 'labels.csv'))
+
+        clients = sorted(os.listdir(split_path))
+        client_names = [read_names(os.path.join(split_path, client)) for client in clients]
+
+        names = np.unique(encode_names(label_names + [n for c in client_names for n in c]))
+        labels = np.full(len(names), np.nan)
+        labels[np.searchsorted(names, encode_names(label_names))] = label_values
+
+        client_ids = [np.unique(np.searchsorted(names, encode_names(c))) for c in client_names]
+        offsets = np.zeros(len(clients) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(c) for c in client_ids])
+        ids = np.concatenate(client_ids).astype(np.int64) if client_ids else np.zeros(0, dtype=np.int64)
+        return cls(names, labels, np.array(clients), offsets, ids)
+
+    def save(self, path):
+        tmp_path = '%s.tmp%d.npz' % (path[:-len('.npz')], os.getpid())
+        np.savez(tmp_path, names=self.names, labels=self.labels, clients=np.array(self.clients),
+                 offsets=self.offsets, ids=self.ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['names'], f['labels'], f['clients'], f['offsets'], f['ids'])
+
+    def client_ids(self, client):
+        pos = self.client_pos[client]
+        return self.ids[self.offsets[pos]: self.offsets[pos + 1]]
+
+    def client_len(self, client):
+        pos = self.client_pos[client]
+        return int(self.offsets[pos + 1] - self.offsets[pos])
+
+    def lookup(self, names):
+        """ Ids of the unique image names of a csv that is not a client split (e.g. test.csv). """
+        query = np.unique(encode_names(names))
+        ids = np.searchsorted(self.names, query)
+        found = (ids < len(self.names)) & (self.names[np.minimum(ids, len(self.names) - 1)] == query)
+        if not found.all():
+            raise KeyError(query[~found][0].decode('utf-8'))
+        return ids.astype(np.int64)
+
+    def name(self, image_id):
+        return self.names[image_id].decode('utf-8')
+
+    def label(self, image_id):
+        label = self.labels[image_id]
+        if np.isnan(label):
+            raise KeyError(self.name(image_id))
+        return label
+
+
+def split_path(args):
+    if args.split_type == 'central':
+        return os.path.join(args.data_path, args.split_type)
+    return os.path.join(args.data_path, f'{args.n_clients}_clients', args.split_type)
+
+
+def manifest_path(args):
+    """ Binary manifest written next to the client csv folder by data/data_split.py. """
+    return split_path(args) + '.npz'
+
+
+_label_indexes = {}
+
+
+def get_label_index(args):
+    """ Label index of the current split: loaded once per process, rebuilt when the csv files change.
+
+    The split manifest is used unless the csv files are newer than it; without
+    the csv folder the manifest alone describes the split.
+    """
+    path = split_path(args)
+    if path in _label_indexes:
+        return _label_indexes[path]
+
+    manifest = manifest_path(args)
+    if os.path.isdir(path):
+        sources = [os.path.join(args.data_path, 'labels.csv'), path] + \
+                  [os.path.join(path, client) for client in os.listdir(path)]
+        newest_source = max(os.path.getmtime(s) for s in sources if os.path.exists(s))
+    else:
+        newest_source = None
+
+    tag = 'central' if args.split_type == 'central' else f'{args.n_clients}_clients_{args.split_type}'
+    index_path = os.path.join(args.data_path, 'label_index_%s.npz' % tag)
+    if os.path.exists(manifest) and (newest_source is None or os.path.getmtime(manifest) >= newest_source):
+        label_index = LabelIndex.load(manifest)
+    elif os.path.exists(index_path) and (newest_source is None or os.path.getmtime(index_path) >= newest_source):
+        label_index = LabelIndex.load(index_path)
+    else:
+        label_index = LabelIndex.build(args.data_path, path)
+        try:
+            label_index.save(index_path)
+        except OSError:
+            # read-only data directory: keep the index in memory only
+            pass
+    _label_indexes[path] = label_index
+    return label_index
+
+
+def client_files(args):
+    """ Client csv names of the current split, from the csv folder or else the manifest. """
+    path = split_path(args)
+    if os.path.isdir(path):
+        return os.listdir(path)
+    return list(get_label_index(args).clients)
@@ -59,7 +59,7 @@ class MaskingGenerator:
         return delta
 
     def __call__(self):
-        mask = np.zeros(shape=self.get_shape(), dtype=np.int)
+        mask = np.zeros(shape=self.get_shape(), dtype=int)
         mask_count = 0
         while mask_count < self.num_masking_patches:
             max_mask_patches = self.num_masking_patches - mask_count
@@ -72,3 +72,87 @@ class MaskingGenerator:
                 mask_count += delta
 
         return mask
+
+
+class BatchMaskingGenerator(MaskingGenerator):
+    """ Block-wise masks for a whole batch at once.
+
+    Same block distribution as MaskingGenerator: each mask adds random blocks until
+    num_masking_patches are masked or none of 10 attempts fits. All unfinished masks
+    of the batch draw their 10 candidate blocks at once; the overlap of every
+    candidate is read from a summed-area table of its mask and the first acceptable
+    candidate is added, so there is one iteration per block instead of nested loops
+    over patches. The random stream is seeded from python's random module, which
+    DataLoader seeds differently in every worker.
+    """
+    max_attempts = 10
+
+    def __call__(self, batch_size=None):
+        if batch_size is None:
+            return self(1)[0]
+
+        rng = np.random.default_rng(random.getrandbits(64))
+        masks = np.zeros((batch_size, self.height, self.width), dtype=int)
+        mask_count = np.zeros(batch_size, dtype=int)
+        active = np.ones(batch_size, dtype=bool)
+        rows = np.arange(self.height)[None, :, None]
+        cols = np.arange(self.width)[None, None, :]
+
+        while active.any():
+            idx = np.flatnonzero(active)
+            shape = (len(idx), self.max_attempts)
+            max_mask_patches = np.minimum(self.num_masking_patches - mask_count[idx],
+                                          self.max_num_patches)[:, None]
+
+            # same as random.uniform, which also accepts max_mask_patches < min_num_patches
+            target_area = self.min_num_patches + (max_mask_patches - self.min_num_patches) * rng.random(shape)
+            aspect_ratio = np.exp(rng.uniform(*self.log_aspect_ratio, size=shape))
+            h = np.round(np.sqrt(target_area * aspect_ratio)).astype(int)
+            w = np.round(np.sqrt(target_area / aspect_ratio)).astype(int)
+            fits = (w < self.width) & (h < self.height)
+            h, w = np.where(fits, h, 0), np.where(fits, w, 0)
+            top = (rng.random(shape) * (self.height - h + 1)).astype(int)
+            left = (rng.random(shape) * (self.width - w + 1)).astype(int)
+
+            # masked patches inside each candidate block, from the summed-area table
+            table = np.zeros((len(idx), self.height + 1, self.width + 1), dtype=int)
+            table[:, 1:, 1:] = masks[idx].cumsum(1).cumsum(2)
+            n = np.arange(len(idx))[:, None]
+            num_masked = table[n, top + h, left + w] - table[n, top, left + w] \
+                - table[n, top + h, left] + table[n, top, left]
+            delta = h * w - num_masked
+            accept = fits & (delta > 0) & (delta <= max_mask_patches)
+
+            # the first acceptable attempt of every mask, masks without one are done
+            found = accept.any(axis=1)
+            active[idx[~found]] = False
+            if found.any():
+                a = idx[found]
+                first = accept[found].argmax(axis=1)
+                pick = lambda x: x[found, first][:, None, None]
+                top, left, h, w = pick(top), pick(left), pick(h), pick(w)
+                masks[a] |= (rows >= top) & (rows < top + h) & (cols >= left) & (cols < left + w)
+                mask_count[a] += delta[found, first]
+            active &= mask_count < self.num_masking_patches
+
+        return masks
+
+
+class MaskBank(object):
+    """ Draw masks from num_masks masks pre-generated by a BatchMaskingGenerator. """
+    def __init__(self, generator, num_masks, chunk_size=4096):
+        self.generator = generator
+        self.masks = np.concatenate([generator(min(chunk_size, num_masks - start))
+                                     for start in range(0, num_masks, chunk_size)]).astype(np.uint8)
+
+    def __repr__(self):
+        return "MaskBank(%d masks of %s)" % (len(self.masks), str(self.generator))
+
+    def get_shape(self):
+        return self.generator.get_shape()
+
+    def __call__(self, batch_size=None):
+        if batch_size is None:
+            return self.masks[random.randrange(len(self.masks))].astype(int)
+        rng = np.random.default_rng(random.getrandbits(64))
+        return self.masks[rng.integers(len(self.masks), size=batch_size)].astype(int)
@@ -11,10 +11,9 @@
 # --------------------------------------------------------'
 import io
 import os
-import math
 import time
 import json
-from collections import defaultdict, deque
+from collections import defaultdict
 import datetime
 import numpy as np
 from timm.utils import get_state_dict
@@ -39,28 +38,71 @@ def fix_random_seeds(args):
     np.random.seed(seed)
     
 
+def read_back(tensors):
+    """ Host values of a list of scalar tensors, with one transfer per device. """
+    values = [None] * len(tensors)
+    by_device = defaultdict(list)
+    for i, t in enumerate(tensors):
+        by_device[t.device].append(i)
+    for ids in by_device.values():
+        stacked = torch.stack([tensors[i].reshape(()).to(torch.float64) for i in ids])
+        for i, v in zip(ids, stacked.tolist()):
+            values[i] = v
+    return values
+
+
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
+
+    The window is a preallocated NumPy ring buffer. Tensor values are kept on
+    their device and only read back by flush(), i.e. when a statistic is read
+    (at the print interval), so update() never synchronizes with the device.
     """
+    max_pending = 1024
 
     def __init__(self, window_size=20, fmt=None):
         if fmt is None:
             fmt = "{median:.4f} ({global_avg:.4f})"
-        self.deque = deque(maxlen=window_size)
+        self.window = np.zeros(window_size, dtype=np.float64)
+        self.num_updates = 0
         self.total = 0.0
         self.count = 0
+        self.pending = []
+        self.pending_n = []
         self.fmt = fmt
 
     def update(self, value, n=1):
-        self.deque.append(value)
+        if isinstance(value, torch.Tensor):
+            self.pending.append(value.detach())
+            self.pending_n.append(n)
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+            return
+        self.append(value, n)
+
+    def append(self, value, n=1):
+        self.window[self.num_updates % len(self.window)] = value
+        self.num_updates += 1
         self.count += n
         self.total += value * n
 
+    def flush(self, values=None):
+        """ Move the pending tensor values (read back by the caller if given) into the window. """
+        if not self.pending:
+            return
+        if values is None:
+            values = read_back(self.pending)
+        for value, n in zip(values, self.pending_n):
+            self.append(value, n)
+        self.pending = []
+        self.pending_n = []
+
     def synchronize_between_processes(self):
         """
-        Warning: does not synchronize the deque!
+        Warning: does not synchronize the window!
         """
+        self.flush()
         if not is_dist_avail_and_initialized():
             return
         t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
@@ -70,27 +112,35 @@ class SmoothedValue(object):
         self.count = int(t[0])
         self.total = t[1]
 
+    @property
+    def values(self):
+        """ Values in the window (in ring order). """
+        self.flush()
+        return self.window[:min(self.num_updates, len(self.window))]
+
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        # lower median, as torch.median
+        d = np.sort(self.values)
+        return float(d[(len(d) - 1) // 2])
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return float(self.values.mean())
 
     @property
     def global_avg(self):
+        self.flush()
         return self.total / self.count
 
     @property
     def max(self):
-        return max(self.deque)
+        return float(self.values.max())
 
     @property
     def value(self):
-        return self.deque[-1]
+        self.flush()
+        return float(self.window[(self.num_updates - 1) % len(self.window)])
 
     def __str__(self):
         return self.fmt.format(
@@ -110,11 +160,22 @@ class MetricLogger(object):
         for k, v in kwargs.items():
             if v is None:
                 continue
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            # tensors stay on the device until the next flush()
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
+    def flush(self):
+        """ Read the pending tensor values of all meters back in a single host sync. """
+        meters = [meter for meter in self.meters.values() if meter.pending]
+        if not meters:
+            return
+        values = read_back([t for meter in meters for t in meter.pending])
+        pos = 0
+        for meter in meters:
+            num = len(meter.pending)
+            meter.flush(values[pos: pos + num])
+            pos += num
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -124,6 +185,7 @@ class MetricLogger(object):
             type(self).__name__, attr))
 
     def __str__(self):
+        self.flush()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append(
@@ -146,6 +208,7 @@ class MetricLogger(object):
                 return meter.global_avg
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -366,7 +429,8 @@ class NativeScalerWithGradNormCount:
     def __init__(self):
         self._scaler = torch.cuda.amp.GradScaler()
 
-    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
+    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True,
+                 skip_nonfinite=False):
         self._scaler.scale(loss).backward(create_graph=create_graph)
         if update_grad:
             if clip_grad is not None:
@@ -376,12 +440,26 @@ class NativeScalerWithGradNormCount:
             else:
                 self._scaler.unscale_(optimizer)
                 norm = get_grad_norm_(parameters)
+            # a non-finite loss gives non-finite gradients: the enabled scaler already skips
+            # that step on the device; the disabled one (CPU only, no sync cost) is checked here
+            if skip_nonfinite and not self._scaler.is_enabled() and not torch.isfinite(norm).item():
+                return norm
             self._scaler.step(optimizer)
             self._scaler.update()
         else:
             norm = None
         return norm
 
+    def get_scale(self):
+        """ Current loss scale, as a device tensor while the scaler is enabled (no host sync).
+
+        The tensor may be updated in place by later steps; .item() it when logging.
+        """
+        scale = getattr(self._scaler, '_scale', None)
+        if scale is None or not self._scaler.is_enabled():
+            return self._scaler.get_scale()
+        return scale
+
     def state_dict(self):
         return self._scaler.state_dict()
 
@@ -404,28 +482,90 @@ def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     return total_norm
 
 
+class CosineSchedule(object):
+    """ Linear warmup followed by a cosine decay, evaluated on demand.
+
+    Indexing (int, slice or integer array) gives the same values as the array
+    cosine_scheduler used to materialize, without storing one float per step of
+    every round for every client. np.asarray(schedule) still builds the array.
+    """
+    def __init__(self, base_value, final_value, num_iters, warmup_iters=0, start_warmup_value=0):
+        self.base_value = base_value
+        self.final_value = final_value
+        self.num_iters = num_iters
+        self.warmup_iters = warmup_iters
+        self.start_warmup_value = start_warmup_value
+
+    def __repr__(self):
+        return "CosineSchedule(%s -> %s, iters=%d, warmup=%d)" % (
+            self.base_value, self.final_value, self.num_iters, self.warmup_iters)
+
+    def __len__(self):
+        return self.num_iters
+
+    def values(self, it):
+        """ Schedule values at the integer array of steps it (0 <= it < len). """
+        it = np.asarray(it, dtype=np.float64)
+        if self.warmup_iters > 1:
+            step = (self.base_value - self.start_warmup_value) / (self.warmup_iters - 1)
+        else:
+            step = 0.
+        warmup = it * step + self.start_warmup_value
+        cosine = self.final_value + 0.5 * (self.base_value - self.final_value) * \
+            (1 + np.cos(np.pi * (it - self.warmup_iters) / (self.num_iters - self.warmup_iters)))
+        return np.where(it < self.warmup_iters, warmup, cosine)
+
+    def __getitem__(self, it):
+        if isinstance(it, slice):
+            return self.values(np.arange(*it.indices(self.num_iters)))
+        if isinstance(it, (np.ndarray, list)):
+            it = np.asarray(it)
+            return self.values(np.where(it < 0, it + self.num_iters, it))
+        it = int(it)
+        if it < 0:
+            it += self.num_iters
+        if not 0 <= it < self.num_iters:
+            raise IndexError("schedule index %d out of range (%d steps)" % (it, self.num_iters))
+        return float(self.values(it))
+
+    def __iter__(self):
+        for it in range(self.num_iters):
+            yield self[it]
+
+    def __array__(self, dtype=None, copy=None):
+        schedule = self.values(np.arange(self.num_iters))
+        return schedule if dtype is None else schedule.astype(dtype)
+
+
+_cosine_schedules = {}
+
+
 def cosine_scheduler(base_value, final_value, epochs, niter_per_ep, max_communication_rounds=100,
                      warmup_epochs=0, start_warmup_value=0, warmup_steps=-1):
-    warmup_schedule = np.array([])
     warmup_iters = warmup_epochs * niter_per_ep
     if warmup_steps > 0:
         warmup_iters = warmup_steps
     print("Set warmup steps = %d" % warmup_iters)
-    if warmup_epochs > 0:
-        warmup_schedule = np.linspace(start_warmup_value, base_value, warmup_iters)
-    
-    iters = np.arange(epochs * niter_per_ep * max_communication_rounds - warmup_iters)
-    schedule = np.array(
-        [final_value + 0.5 * (base_value - final_value) * (1 + math.cos(math.pi * i / (len(iters)))) for i in iters])
-    
-    schedule = np.concatenate((warmup_schedule, schedule))
-
-    print('len(schedule)=',len(schedule), 'epochs * niter_per_ep * max_communication_rounds:', epochs * niter_per_ep * max_communication_rounds)
-    assert len(schedule) == epochs * niter_per_ep * max_communication_rounds
-    return schedule
-
 
-def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, model_ema=None):    
+    num_iters = epochs * niter_per_ep * max_communication_rounds
+    # the warmup steps are only scheduled with warmup_epochs > 0
+    assert warmup_epochs > 0 or warmup_iters == 0, \
+        "len(schedule)=%d != %d" % (num_iters - warmup_iters, num_iters)
+
+    # clients with the same number of steps share one schedule
+    key = (base_value, final_value, num_iters, warmup_iters, start_warmup_value)
+    if key not in _cosine_schedules:
+        _cosine_schedules[key] = CosineSchedule(base_value, final_value, num_iters,
+                                                warmup_iters=warmup_iters,
+                                                start_warmup_value=start_warmup_value)
+    return _cosine_schedules[key]
+
+
+def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, model_ema=None, server_optimizer=None,
+               save_client_state=True):
+    """ save_client_state=False leaves the optimizer and loss scaler states out of the checkpoint
+    (e.g. when they are only trained in other processes, see --num_client_workers).
+    """    
     
     output_dir = Path(args.output_dir)
     epoch_name = str(epoch)
@@ -435,14 +575,18 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, mo
         for checkpoint_path in checkpoint_paths:
             to_save = {
                 'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
                 'epoch': epoch,
-                'scaler': loss_scaler.state_dict(),
                 'args': args,
             }
+            if save_client_state:
+                to_save['optimizer'] = optimizer.state_dict()
+                to_save['scaler'] = loss_scaler.state_dict()
             
             if model_ema is not None:
                 to_save['model_ema'] = get_state_dict(model_ema)
+            if server_optimizer is not None:
+                # --server_opt momentum / moment buffers, restored by load_model
+                to_save['server_optimizer'] = server_optimizer.state_dict()
             
             save_on_master(to_save, checkpoint_path)
     else:
@@ -452,7 +596,7 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, mo
         model.save_checkpoint(save_dir=args.output_dir, tag="checkpoint-%s" % epoch_name, client_state=client_state)
 
 
-def load_model(args, model_without_ddp, optimizer, loss_scaler, model_ema=None):
+def load_model(args, model_without_ddp, optimizer, loss_scaler, model_ema=None, server_optimizer=None):
     output_dir = Path(args.output_dir)
     if args.resume:
         if args.resume.startswith('https'):
@@ -471,6 +615,8 @@ def load_model(args, model_without_ddp, optimizer, loss_scaler, model_ema=None):
             if 'scaler' in checkpoint:
                 loss_scaler.load_state_dict(checkpoint['scaler'])
             print("With optim & sched!")
+        if server_optimizer is not None and 'server_optimizer' in checkpoint:
+            server_optimizer.load_state_dict(checkpoint['server_optimizer'])
 
 
 
@@ -487,7 +633,7 @@ def all_reduce_mean(x):
     
     
 # beit
-def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, model_ema=None):
+def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, model_ema=None, server_optimizer=None):
     output_dir = Path(args.output_dir)
     
     if loss_scaler is not None:
@@ -520,6 +666,8 @@ def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, mode
                 if 'scaler' in checkpoint:
                     loss_scaler.load_state_dict(checkpoint['scaler'])
                 print("With optim & sched!")
+            if server_optimizer is not None and 'server_optimizer' in checkpoint:
+                server_optimizer.load_state_dict(checkpoint['server_optimizer'])
     else:
         # deepspeed, only support '--auto_resume'.
         if args.auto_resume:
@@ -0,0 +1,189 @@
+# --------------------------------------------------------
+# Round-level profiler of the FedAvg main loop
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import csv
+import json
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+from .misc import is_main_process
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.sync_cuda and torch.cuda.is_available():
+            # kernels are asynchronous, charge them to the phase that launched them
+            torch.cuda.synchronize()
+        self.profiler.record(self.name, self.start, time.perf_counter(), **self.args)
+        return False
+
+
+class RoundProfiler(object):
+    """ Wall-clock durations of the phases of every client in every round.
+
+    Phases are recorded with `with profiler.phase(name):` (or record() for spans
+    measured elsewhere) and tagged with the current round and client set by
+    set_context(). A disabled profiler returns a shared no-op context, so the
+    instrumentation can stay in the training loop. The events are written as a
+    Chrome trace (chrome://tracing, Perfetto; one row per client) and as a CSV
+    summary per round, client and phase.
+
+    The summary is accumulated as the phases are recorded. The trace events are
+    buffered in memory and drained at every new round (and every max_events
+    events) to a spill file in output_dir, or dropped without one, so a long run
+    keeps a bounded buffer.
+    """
+    def __init__(self, enabled=False, sync_cuda=True, output_dir=None, max_events=100000):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda
+        self.output_dir = output_dir
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.context = {'round': None, 'client': None}
+        self.events = []
+        self.num_events = 0
+        self.durations = OrderedDict()
+        self.threads = OrderedDict()
+        if self.enabled and self.output_dir is not None and os.path.exists(self.spill_path()):
+            # left over by an interrupted run
+            os.remove(self.spill_path())
+
+    def __repr__(self):
+        return "RoundProfiler(enabled=%s, events=%d, buffered=%d)" % (self.enabled, self.num_events, len(self.events))
+
+    def set_context(self, **context):
+        if context.get('round', self.context['round']) != self.context['round']:
+            self.drain()
+        self.context.update(context)
+
+    def phase(self, name, **args):
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name, args)
+
+    def record(self, name, start, end, **args):
+        """ Record a phase from time.perf_counter() start to end. """
+        if not self.enabled:
+            return
+        round_, client = self.context['round'], self.context['client']
+        stats = self.durations.setdefault((round_, client, name), [0, 0., 0.])
+        stats[0] += 1
+        stats[1] += end - start
+        stats[2] = max(stats[2], end - start)
+        self.events.append((name, round_, client, start, end, args))
+        self.num_events += 1
+        if len(self.events) >= self.max_events:
+            self.drain()
+
+    def spill_path(self):
+        return os.path.join(self.output_dir, 'profile_events.tmp')
+
+    def trace_event(self, event):
+        name, round_, client, start, end, args = event
+        tid = self.threads.setdefault(client, len(self.threads))
+        return {'name': name, 'cat': 'fedavg', 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                'args': dict(args, round=round_, client=client)}
+
+    def drain(self):
+        """ Append the buffered trace events to the spill file (one JSON event per line). """
+        if self.events and self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(self.spill_path(), 'a') as f:
+                for event in self.events:
+                    f.write(json.dumps(self.trace_event(event)) + '\n')
+        self.events = []
+
+    def summary(self):
+        """ count, total, mean and max duration (s) per (round, client, phase). """
+        rows = []
+        for (round_, client, name), (count, total, max_s) in self.durations.items():
+            rows.append({'round': round_, 'client': client, 'phase': name, 'count': count,
+                         'total_s': total, 'mean_s': total / count, 'max_s': max_s})
+        return rows
+
+    def save_trace(self, path):
+        """ Chrome trace of the drained events, streamed from the spill file. """
+        self.drain()
+        with open(path, 'w') as f:
+            f.write('{"traceEvents": [')
+            separator = ''
+            if self.output_dir is not None and os.path.exists(self.spill_path()):
+                with open(self.spill_path()) as spill:
+                    for line in spill:
+                        f.write(separator + line.rstrip('\n'))
+                        separator = ', '
+            for client, tid in self.threads.items():
+                f.write(separator + json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                                'args': {'name': client if client is not None else 'server'}}))
+                separator = ', '
+            f.write('], "displayTimeUnit": "ms"}')
+
+    def save_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['round', 'client', 'phase', 'count', 'total_s', 'mean_s', 'max_s'])
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def save(self, output_dir):
+        """ Write profile_trace.json and profile_summary.csv into output_dir. """
+        if not self.enabled:
+            return
+        os.makedirs(output_dir, exist_ok=True)
+        self.save_trace(os.path.join(output_dir, 'profile_trace.json'))
+        self.save_csv(os.path.join(output_dir, 'profile_summary.csv'))
+        if self.output_dir is not None and os.path.exists(self.spill_path()):
+            os.remove(self.spill_path())
+        print("Profile: %d events -> %s" % (self.num_events, output_dir))
+
+
+_profiler = RoundProfiler(enabled=False)
+
+
+def get_profiler():
+    """ Profiler of this process, disabled unless init_profiler() enabled it. """
+    return _profiler
+
+
+def init_profiler(args):
+    global _profiler
+    # the runners save the profile of the main process only
+    output_dir = args.output_dir if args.output_dir and is_main_process() else None
+    _profiler = RoundProfiler(enabled=args.profile, output_dir=output_dir)
+    return _profiler
+
+
+def disable_profiler():
+    """ Disable the profiler of this process in place (the runners hold a reference to it).
+
+    Called in forked client workers: their phases are not collected, and they must
+    not drain into the spill file of the server.
+    """
+    _profiler.enabled = False
+    _profiler.output_dir = None
+    _profiler.events = []
@@ -0,0 +1,99 @@
+# --------------------------------------------------------
+# Server optimizers (FedAvgM / FedAdam) over the flat global buffer
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import torch
+
+
+class ServerMomentum(object):
+    """ FedAvgM: SGD with momentum on the pseudo-gradient (global - weighted client mean).
+
+    lr=1 and momentum=0 give plain FedAvg.
+    """
+    name = 'momentum'
+
+    def __init__(self, lr=1.0, momentum=0.9):
+        self.lr = lr
+        self.momentum = momentum
+        self.grad = None
+        self.momentum_buffer = None
+
+    def __repr__(self):
+        return "ServerMomentum(lr=%s, momentum=%s)" % (self.lr, self.momentum)
+
+    def pseudo_grad(self, flat, mean):
+        if self.grad is None:
+            self.grad = torch.empty_like(flat)
+        return torch.sub(flat, mean, out=self.grad)
+
+    def step(self, flat, mean):
+        """ Update the global buffer flat in place from the weighted client mean. """
+        grad = self.pseudo_grad(flat, mean)
+        if self.momentum > 0:
+            if self.momentum_buffer is None:
+                self.momentum_buffer = grad.clone()
+            else:
+                # a buffer restored from a checkpoint is on the CPU
+                self.momentum_buffer = self.momentum_buffer.to(flat)
+                self.momentum_buffer.mul_(self.momentum).add_(grad)
+            grad = self.momentum_buffer
+        return flat.sub_(grad, alpha=self.lr)
+
+    def state_dict(self):
+        """ Saved in the checkpoints by misc.save_model, restored by misc.load_model. """
+        return {'momentum_buffer': self.momentum_buffer}
+
+    def load_state_dict(self, state_dict):
+        self.momentum_buffer = state_dict['momentum_buffer']
+
+
+class ServerAdam(ServerMomentum):
+    """ FedAdam (Reddi et al., Adaptive Federated Optimization): Adam on the pseudo-gradient,
+    with tau as the adaptivity constant and no bias correction.
+    """
+    name = 'adam'
+
+    def __init__(self, lr=1e-2, betas=(0.9, 0.99), tau=1e-3):
+        super().__init__(lr=lr, momentum=0.)
+        self.betas = betas
+        self.tau = tau
+        self.exp_avg = None
+        self.exp_avg_sq = None
+
+    def __repr__(self):
+        return "ServerAdam(lr=%s, betas=%s, tau=%s)" % (self.lr, tuple(self.betas), self.tau)
+
+    def step(self, flat, mean):
+        grad = self.pseudo_grad(flat, mean)
+        beta1, beta2 = self.betas
+        if self.exp_avg is None:
+            self.exp_avg = torch.zeros_like(flat)
+            self.exp_avg_sq = torch.zeros_like(flat)
+        # moments restored from a checkpoint are on the CPU
+        self.exp_avg, self.exp_avg_sq = self.exp_avg.to(flat), self.exp_avg_sq.to(flat)
+        self.exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        self.exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        # grad is free once the moments are updated, reuse it for the denominator
+        denom = torch.sqrt(self.exp_avg_sq, out=grad).add_(self.tau)
+        return flat.addcdiv_(self.exp_avg, denom, value=-self.lr)
+
+    def state_dict(self):
+        return {'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    def load_state_dict(self, state_dict):
+        self.exp_avg = state_dict['exp_avg']
+        self.exp_avg_sq = state_dict['exp_avg_sq']
+
+
+def build_server_optimizer(args):
+    """ Server optimizer of --server_opt, or None for FedAvg (the global model is the client mean). """
+    if args.server_opt == 'none':
+        return None
+    if args.server_opt == 'momentum':
+        lr = args.server_lr if args.server_lr is not None else 1.0
+        return ServerMomentum(lr=lr, momentum=args.server_momentum)
+    if args.server_opt == 'adam':
+        lr = args.server_lr if args.server_lr is not None else 1e-2
+        return ServerAdam(lr=lr, betas=args.server_betas, tau=args.server_tau)
+    raise ValueError("unknown server optimizer: %s" % args.server_opt)
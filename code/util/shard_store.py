@@ -0,0 +1,175 @@
+# --------------------------------------------------------
+# Image files packed into a few large shard files per phase
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import argparse
+import io
+import os
+import types
+
+import numpy as np
+
+from .label_index import get_label_index
+
+
+def shard_paths(shard_dir, phase):
+    prefix = os.path.join(shard_dir, phase)
+    return prefix + '_%05d.shard', prefix + '_index.npz'
+
+
+def pack_shards(data_path, phase, shard_dir, groups=None, shard_size=256 << 20):
+    """ Copy the image files of data_path/phase into shard files of about shard_size bytes.
+
+    A shard is the plain concatenation of the original file bytes; the index
+    records (shard, offset, length) of every image name. Images are packed in
+    the order of groups (e.g. one group per client, so a client is read from a
+    few shards), then every image left in data_path/phase.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    data_path_phase = os.path.join(data_path, phase)
+    names = sorted(os.listdir(data_path_phase))
+    order, seen = [], set()
+    for group in (groups or []) + [names]:
+        for name in group:
+            if name not in seen:
+                seen.add(name)
+                order.append(name)
+    shard_pattern, index_path = shard_paths(shard_dir, phase)
+
+    # write under temporary names so concurrent packers never expose a partial store
+    tmp_suffix = '.tmp%d' % os.getpid()
+    shard = np.zeros(len(order), dtype=np.int32)
+    offset = np.zeros(len(order), dtype=np.int64)
+    length = np.zeros(len(order), dtype=np.int64)
+    num_shards, f = 0, None
+    for i, name in enumerate(order):
+        if f is None or f.tell() >= shard_size:
+            if f is not None:
+                f.close()
+            f = open(shard_pattern % num_shards + tmp_suffix, 'wb')
+            num_shards += 1
+        with open(os.path.join(data_path_phase, name), 'rb') as src:
+            data = src.read()
+        shard[i], offset[i], length[i] = num_shards - 1, f.tell(), len(data)
+        f.write(data)
+    if f is not None:
+        f.close()
+
+    tmp_index_path = '%s%s.npz' % (index_path[:-len('.npz')], tmp_suffix)
+    np.savez(tmp_index_path, names=np.array([name.encode('utf-8') for name in order], dtype=bytes),
+             shard=shard, offset=offset, length=length, num_shards=num_shards)
+    for k in range(num_shards):
+        os.replace(shard_pattern % k + tmp_suffix, shard_pattern % k)
+    os.replace(tmp_index_path, index_path)
+    print("Shard store: %d %s images in %d shards -> %s" % (len(order), phase, num_shards, shard_dir))
+
+
+class ShardStore(object):
+    """ Random and sequential access to the images of a shard store, by image name.
+
+    Shard files are opened lazily in every process that reads them, so
+    DataLoader workers keep their own file offsets. A sample is one read of
+    its record; read_shard streams a whole shard with one large read.
+    """
+    def __init__(self, shard_dir, phase):
+        self.shard_pattern, self.index_path = shard_paths(shard_dir, phase)
+        with np.load(self.index_path) as f:
+            names = [name.decode('utf-8') for name in f['names']]
+            self.shard, self.offset, self.length = f['shard'], f['offset'], f['length']
+            self.num_shards = int(f['num_shards'])
+        self.index = {name: i for i, name in enumerate(names)}
+        self.names = names
+        self.files = {}
+        self.buffer = bytearray()
+
+    def __repr__(self):
+        return "ShardStore(path=%s, images=%d, shards=%d)" % (self.index_path, len(self.index), self.num_shards)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, name):
+        """ Bytes of the original image file. """
+        i = self.index[name]
+        k = int(self.shard[i])
+        if k not in self.files:
+            self.files[k] = open(self.shard_pattern % k, 'rb')
+        f = self.files[k]
+        f.seek(int(self.offset[i]))
+        return f.read(int(self.length[i]))
+
+    def open(self, name):
+        """ File-like object for np.load / PIL.Image.open. """
+        return io.BytesIO(self.read(name))
+
+    def read_shard(self, k):
+        """ (name, memoryview of the bytes) of every image of shard k, in file order.
+
+        The views point into a buffer reused by the next read_shard call.
+        """
+        path = self.shard_pattern % k
+        size = os.path.getsize(path)
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        data = memoryview(self.buffer)[:size]
+        with open(path, 'rb') as f:
+            f.readinto(data)
+        for i in np.flatnonzero(self.shard == k):
+            start = int(self.offset[i])
+            yield self.names[i], data[start: start + int(self.length[i])]
+
+    def __getstate__(self):
+        # never pickle open files (every worker opens its own)
+        state = self.__dict__.copy()
+        state['files'] = {}
+        state['buffer'] = bytearray()
+        return state
+
+
+_shard_stores = {}
+
+
+def client_groups(args):
+    """ Image names of every client of the current split, to pack each client contiguously. """
+    label_index = get_label_index(args)
+    return [[label_index.name(i) for i in label_index.client_ids(client)] for client in label_index.clients]
+
+
+def get_shard_store(args, phase):
+    """ Shard store of a phase, packed on first use; None unless --shards is set. """
+    if not args.shards:
+        return None
+
+    shard_dir = args.shard_dir
+    if shard_dir is None:
+        shard_dir = os.path.join(args.data_path, 'shards')
+    key = (shard_dir, phase)
+    if key not in _shard_stores:
+        if not os.path.exists(shard_paths(shard_dir, phase)[1]):
+            groups = client_groups(args) if phase == 'train' else None
+            pack_shards(args.data_path, phase, shard_dir, groups=groups, shard_size=args.shard_size_mb << 20)
+        _shard_stores[key] = ShardStore(shard_dir, phase)
+    return _shard_stores[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Pack the image files of a dataset into shards', add_help=False)
+    parser.add_argument('--data_path', required=True, type=str)
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='default: data_path/shards')
+    parser.add_argument('--phases', default=['train', 'test'], nargs='+')
+    parser.add_argument('--shard_size_mb', default=256, type=int)
+    parser.add_argument('--n_clients', default=5, type=int)
+    parser.add_argument('--split_type', default='central', type=str,
+                        help='split whose clients are packed contiguously (train phase)')
+    opts = parser.parse_args()
+
+    shard_dir = opts.shard_dir if opts.shard_dir is not None else os.path.join(opts.data_path, 'shards')
+    split_args = types.SimpleNamespace(data_path=opts.data_path, n_clients=opts.n_clients, split_type=opts.split_type)
+    for phase in opts.phases:
+        groups = client_groups(split_args) if phase == 'train' else None
+        pack_shards(opts.data_path, phase, shard_dir, groups=groups, shard_size=opts.shard_size_mb << 20)
@@ -0,0 +1,131 @@
+# --------------------------------------------------------
+# Memory-mapped store for per-client state (optimizer moments, scaler, buffers)
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+ALIGN = 64
+
+
+class _TensorRef(object):
+    """ Placeholder for the i-th tensor of a packed state. """
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+def pack_state(state, tensors):
+    """ Replace the tensors of a nested state by _TensorRef, collecting them in tensors. """
+    if isinstance(state, torch.Tensor):
+        tensors.append(state)
+        return _TensorRef(len(tensors) - 1)
+    elif isinstance(state, dict):
+        return {k: pack_state(v, tensors) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(pack_state(v, tensors) for v in state)
+    return state
+
+
+def unpack_state(skeleton, tensors):
+    """ Inverse of pack_state. """
+    if isinstance(skeleton, _TensorRef):
+        return tensors[skeleton.index]
+    elif isinstance(skeleton, dict):
+        return {k: unpack_state(v, tensors) for k, v in skeleton.items()}
+    elif isinstance(skeleton, (list, tuple)):
+        return type(skeleton)(unpack_state(v, tensors) for v in skeleton)
+    return skeleton
+
+
+def numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+class MmapStateStore(object):
+    """ Page per-client state out to one memory-mapped file per client.
+
+    save() writes every tensor of the state into the client's file and keeps only
+    the structure (skeleton and byte layout) in memory, so resident host memory is
+    bounded by the page cache rather than by the number of clients. load() returns
+    tensors backed by the mapping, which are paged in lazily when the optimizer
+    copies them. prefetch() reads a client's file in a background thread (into
+    pinned memory if requested) so the next client turn does not wait on disk.
+    """
+    def __init__(self, state_dir, pin_memory=False):
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+        self.pin_memory = pin_memory
+        self.layouts = {}
+        self.prefetched = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __repr__(self):
+        return "MmapStateStore(state_dir=%s, clients=%d)" % (self.state_dir, len(self.layouts))
+
+    def __contains__(self, client):
+        return client in self.layouts
+
+    def path(self, client):
+        return os.path.join(self.state_dir, '%s_state.bin' % client)
+
+    def save(self, client, state):
+        # a pending prefetch of this client would read a file that is being rewritten
+        self.drop_prefetch(client)
+
+        tensors = []
+        skeleton = pack_state(state, tensors)
+        entries, offset = [], 0
+        for t in tensors:
+            nbytes = t.numel() * t.element_size()
+            entries.append((offset, t.dtype, tuple(t.shape)))
+            offset += (nbytes + ALIGN - 1) // ALIGN * ALIGN
+        nbytes = max(offset, ALIGN)
+
+        path = self.path(client)
+        mode = 'r+' if client in self.layouts and self.layouts[client][2] == nbytes else 'w+'
+        mm = np.memmap(path, dtype=np.uint8, mode=mode, shape=(nbytes,))
+        for t, dst in zip(tensors, self._views(mm, entries)):
+            dst.copy_(t.detach())
+        del mm
+
+        self.layouts[client] = (skeleton, entries, nbytes)
+
+    def _views(self, mm, entries):
+        views = []
+        for offset, dtype, shape in entries:
+            np_dtype = numpy_dtype(dtype)
+            count = int(np.prod(shape)) if len(shape) > 0 else 1
+            buf = mm[offset: offset + count * np_dtype.itemsize].view(np_dtype).reshape(shape)
+            views.append(torch.from_numpy(buf))
+        return views
+
+    def _read(self, client, copy):
+        skeleton, entries, nbytes = self.layouts[client]
+        mm = np.memmap(self.path(client), dtype=np.uint8, mode='r+', shape=(nbytes,))
+        tensors = self._views(mm, entries)
+        if copy:
+            tensors = [t.pin_memory() if self.pin_memory else t.clone() for t in tensors]
+        return unpack_state(skeleton, tensors)
+
+    def load(self, client):
+        """ State of a client; tensors are read from the mapping unless prefetched. """
+        future = self.prefetched.pop(client, None)
+        if future is not None:
+            return future.result()
+        return self._read(client, copy=False)
+
+    def prefetch(self, client):
+        if client not in self.layouts or client in self.prefetched:
+            return
+        self.prefetched[client] = self.executor.submit(self._read, client, True)
+
+    def drop_prefetch(self, client):
+        future = self.prefetched.pop(client, None)
+        if future is not None:
+            future.result()
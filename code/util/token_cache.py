@@ -0,0 +1,144 @@
+# --------------------------------------------------------
+# Precomputed dVAE visual tokens for Fed-BEiT pre-training
+# Author: Rui Yan
+# --------------------------------------------------------
+
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from .misc import is_main_process
+
+
+def view_seed(seed, image_id, num_views, view):
+    """ Seed that replays the augmentation of one cached view of an image. """
+    return (int(seed) * 1000003 + int(image_id) * num_views + int(view)) % (2 ** 32)
+
+
+def token_cache_paths(args):
+    cache_dir = args.token_cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(args.data_path, 'cache')
+    tag = 'central' if args.split_type == 'central' else f'{args.n_clients}_clients_{args.split_type}'
+    prefix = os.path.join(cache_dir, 'tokens_%s_%s_v%d' % (tag, args.discrete_vae_type, args.token_cache_views))
+    return prefix + '.u16', prefix + '.json'
+
+
+def token_cache_meta(args, num_images):
+    """ Everything the cached tokens depend on; a cache with other values is rebuilt. """
+    return {
+        'num_images': int(num_images),
+        'num_views': args.token_cache_views,
+        'seed': args.token_cache_seed,
+        'data_set': args.data_set,
+        'input_size': args.input_size,
+        'second_input_size': args.second_input_size,
+        'train_interpolation': args.train_interpolation,
+        'second_interpolation': args.second_interpolation,
+        'discrete_vae_type': args.discrete_vae_type,
+        'discrete_vae_weight_path': args.discrete_vae_weight_path,
+    }
+
+
+class TokenCache(object):
+    """ Visual tokens of num_views fixed augmented views of every training image.
+
+    Tokens are stored as uint16 in a (num_images, num_views, num_tokens) array file
+    indexed by label-index image id. View k of image n is produced by running the
+    BEiT common_transform under view_seed(seed, n, num_views, k), so the dataset can
+    replay the exact crop, flip and color jitter of the cached tokens and only needs
+    the patch branch; the mask is still drawn at random every time.
+    """
+    def __init__(self, array_path, meta):
+        self.array_path = array_path
+        self.num_views = meta['num_views']
+        self.seed = meta['seed']
+        self.shape = (meta['num_images'], meta['num_views'], meta['num_tokens'])
+        self.tokens = None
+
+    def __repr__(self):
+        return "TokenCache(path=%s, shape=%s)" % (self.array_path, str(self.shape))
+
+    def view_seed(self, image_id, view):
+        return view_seed(self.seed, image_id, self.num_views, view)
+
+    def __getitem__(self, key):
+        image_id, view = key
+        if self.tokens is None:
+            self.tokens = np.memmap(self.array_path, dtype=np.uint16, mode='r', shape=self.shape)
+        return self.tokens[image_id, view]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tokens'] = None
+        return state
+
+
+def build_token_cache(args, d_vae, dataset_views, device):
+    """ Tokenize every (image, view) of dataset_views with d_vae into the cache files. """
+    array_path, meta_path = token_cache_paths(args)
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    meta = token_cache_meta(args, dataset_views.num_images)
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset_views, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.num_workers, pin_memory=args.pin_mem, drop_last=False)
+
+    start_time = time.time()
+    tmp_path = array_path + '.tmp%d' % os.getpid()
+    tokens = None
+    with torch.no_grad():
+        for image_ids, views, images in data_loader:
+            images = images.to(device, non_blocking=True)
+            input_ids = d_vae.get_codebook_indices(images).flatten(1).cpu().numpy()
+            if tokens is None:
+                meta['num_tokens'] = input_ids.shape[1]
+                tokens = np.memmap(tmp_path, dtype=np.uint16, mode='w+',
+                                   shape=(meta['num_images'], meta['num_views'], meta['num_tokens']))
+            tokens[image_ids.numpy(), views.numpy()] = input_ids.astype(np.uint16)
+    assert tokens is not None, "no image to tokenize"
+    tokens.flush()
+    del tokens
+
+    # the meta file marks a complete cache, write it last
+    os.replace(tmp_path, array_path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    print("Token cache: %d views of %d images in %.1fs -> %s" % (
+        len(dataset_views), len(dataset_views.image_ids), time.time() - start_time, array_path))
+
+
+def prepare_token_cache(args, d_vae, dataset_views, device):
+    """ Build the token cache of the current split on the main process if it is missing or stale. """
+    array_path, meta_path = token_cache_paths(args)
+    if is_main_process():
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta.pop('num_tokens', None)
+        if meta != token_cache_meta(args, dataset_views.num_images):
+            build_token_cache(args, d_vae, dataset_views, device)
+    if args.distributed:
+        torch.distributed.barrier()
+    return load_token_cache(args)
+
+
+_token_caches = {}
+
+
+def load_token_cache(args):
+    """ Token cache of the current split, or None unless --token_cache is set. """
+    if not args.token_cache:
+        return None
+    array_path, meta_path = token_cache_paths(args)
+    if array_path not in _token_caches:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        _token_caches[array_path] = TokenCache(array_path, meta)
+    return _token_caches[array_path]
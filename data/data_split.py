@@ -6,11 +6,12 @@ import os
 import csv
 import glob
 from collections import Counter
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-def non_iid_split_dirichlet(y_train, n_clients, n_classes, beta=0.4):
+def non_iid_split_dirichlet(y_train, n_clients, n_classes, beta=0.4, min_require_size=10, max_retries=1000):
     '''
     Utility function for data splitting
     Inputs:
@@ -18,106 +19,227 @@ def non_iid_split_dirichlet(y_train, n_clients, n_classes, beta=0.4):
         n_clients: the number of clients in each split
         n_classes: the number of classes in the dataset
         beta: the degree of non-IID based on Dirichlet dist. Smaller beta -> higher heterogeneity
+        min_require_size: redraw the split until every client has at least this many images
+        max_retries: number of redraws before giving up with a ValueError
+    Output:
+        net_dataidx_map: client -> int64 array of image indices
+    
+    The random draws are the ones of the list-based version (seed 2022), so the
+    clients get the same images in the same order. Only the per-client sizes are
+    tracked while drawing; the index arrays are filled once at the end.
     '''
-    min_size = 0
-    min_require_size = 10
-
+    y_train = np.asarray(y_train)
     N = y_train.shape[0]
+    if N < min_require_size * n_clients:
+        raise ValueError("%d images cannot give %d clients %d images each" % (N, n_clients, min_require_size))
     np.random.seed(2022)
-    net_dataidx_map = {}
     
-    while min_size < min_require_size:
-        idx_batch = [[] for _ in range(n_clients)]
+    # images of class k (ascending index, as np.where) are order[starts[k]:starts[k + 1]];
+    # labels outside 0..n_classes-1 go to a last bucket that is never split
+    keys = np.where((y_train == np.floor(y_train)) & (y_train >= 0) & (y_train < n_classes), y_train, n_classes)
+    keys = keys.astype(np.uint16 if n_classes < 2 ** 16 else np.int64)
+    order = np.argsort(keys, kind='stable')  # radix sort for 16-bit keys
+    starts = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=n_classes + 1))))
+    
+    for _ in range(max_retries):
+        sizes = np.zeros(n_clients, dtype=np.int64)
+        class_idx, class_bounds = [], []
         for k in range(n_classes):
-            idx_k = np.where(y_train == k)[0]
+            idx_k = order[starts[k]: starts[k + 1]].copy()
             np.random.shuffle(idx_k)
             proportions = np.random.dirichlet(np.repeat(beta, n_clients))
-            proportions = np.array([p * (len(idx_j) < N / n_clients) for p, idx_j in zip(proportions, idx_batch)])
+            proportions = proportions * (sizes < N / n_clients)
             proportions = proportions / proportions.sum()
-            proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-            idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-            min_size = min([len(idx_j) for idx_j in idx_batch])
-
+            bounds = np.concatenate(([0], (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1], [len(idx_k)]))
+            # np.split semantics: a split point below the previous one gives an empty part
+            bounds = np.maximum.accumulate(np.clip(bounds, 0, len(idx_k)))
+            sizes += np.diff(bounds)
+            class_idx.append(idx_k)
+            class_bounds.append(bounds)
+        if sizes.min() >= min_require_size:
+            break
+    else:
+        raise ValueError("no split with %d images per client after %d draws (beta=%s)" % (
+            min_require_size, max_retries, beta))
+    
+    # client j gets its part of every class, in class order
+    net_dataidx_map = {}
     for j in range(n_clients):
-        np.random.shuffle(idx_batch[j])
-        net_dataidx_map[j] = idx_batch[j]
+        idx_j = np.empty(sizes[j], dtype=np.int64)
+        offset = 0
+        for idx_k, bounds in zip(class_idx, class_bounds):
+            part = idx_k[bounds[j]: bounds[j + 1]]
+            idx_j[offset: offset + len(part)] = part
+            offset += len(part)
+        np.random.shuffle(idx_j)
+        net_dataidx_map[j] = idx_j
+    
+    return net_dataidx_map
+
 
+def read_label_index(data_path):
+    '''
+    Label index of labels.csv, built once
+    Output:
+        names: sorted image filenames ===> 1-D str array
+        labels: label of names[i] ===> 1-D float array
+    '''
+    labels = {line.strip().split(',')[0]: float(line.strip().split(',')[1]) for line in
+              open(os.path.join(data_path, 'labels.csv')) if line.strip()}
+    names = np.array(list(labels.keys()))
+    order = np.argsort(names)
+    return names[order], np.array(list(labels.values()), dtype=np.float64)[order]
+
+
+def lookup(names, query):
+    '''
+    Positions in the sorted names array of the unique query filenames found in it
+    '''
+    if len(query) == 0:
+        return np.zeros(0, dtype=np.int64)
+    query = np.unique(np.array(query))
+    pos = np.searchsorted(names, query)
+    found = pos < len(names)
+    found[found] = names[pos[found]] == query[found]
+    return pos[found]
+
+
+def label_histogram(codes, idx, n_values):
+    '''
+    Number of images of idx per label code (codes from np.unique(labels, return_inverse=True))
+    '''
+    return np.bincount(codes[idx], minlength=n_values)
+
+
+def write_manifest(manifest_path, table_fname, table_label, clients, client_fnames):
+    '''
+    Binary split manifest read by code/util/label_index.py instead of the client csv files
+    Inputs:
+        table_fname, table_label: filename table (e.g. all of labels.csv) and its labels
+        clients: client csv names (client_1.csv, ...)
+        client_fnames: filenames of each client
+    The manifest holds the sorted utf-8 filename table (names) with its labels, and
+    the ids of client c as ids[offsets[c]:offsets[c+1]] (sorted, clients sorted by name).
+    '''
+    encode = lambda fnames: np.array([str(fname).encode('utf-8') for fname in fnames], dtype=bytes)
+    order = sorted(range(len(clients)), key=lambda c: clients[c])
+    names, first = np.unique(encode(table_fname), return_index=True)
+    labels = np.asarray(table_label, dtype=np.float64)[first]
+    client_ids = [np.unique(np.searchsorted(names, encode(client_fnames[c]))) for c in order]
+    offsets = np.zeros(len(clients) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in client_ids])
+    ids = np.concatenate(client_ids).astype(np.int64) if client_ids else np.zeros(0, dtype=np.int64)
+    np.savez(manifest_path, names=names, labels=labels, clients=np.array([clients[c] for c in order]),
+             offsets=offsets, ids=ids)
+
+
+def write_split(split_path, image_fname, image_label, n_clients, n_classes, beta, table=None):
+    '''
+    Draw one Dirichlet split and write split_path/client_{k}.csv and the manifest split_path.npz
+    (table: filename table and labels of the manifest, the split images by default)
+    Output:
+        net_dataidx_map: client -> int64 array of image indices
+    '''
+    os.makedirs(split_path, exist_ok=True)
+    net_dataidx_map = non_iid_split_dirichlet(image_label, n_clients, n_classes, beta)
+    clients, client_fnames = [], []
+    for k in range(n_clients):
+        client_split = [image_fname[x] for x in net_dataidx_map[k]]
+        client_path = split_path + f'/client_{k+1}.csv'
+        with open(client_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\n')
+            writer.writerow(client_split)
+        clients.append(f'client_{k+1}.csv')
+        client_fnames.append(client_split)
+    
+    # written after the csv files, so the loaders do not take it for stale
+    table_fname, table_label = table if table is not None else (image_fname, image_label)
+    write_manifest(split_path + '.npz', table_fname, table_label, clients, client_fnames)
     return net_dataidx_map
 
 
-def split_generator(image_fname, image_label, save_path, n_clients, n_classes, beta_list):
+def _write_split(job):
+    return write_split(*job)
+
+
+def write_splits(save_path, image_fname, image_label, n_clients, n_classes, beta_list, num_workers=0, table=None):
+    '''
+    write_split of every beta into save_path/split_{i+1}, in num_workers processes
+    (each split is seeded on its own, so the files do not depend on num_workers)
+    '''
+    jobs = [(save_path + f'/split_{i+1}', image_fname, image_label, n_clients, n_classes, beta, table)
+            for i, beta in enumerate(beta_list)]
+    if num_workers > 0 and len(jobs) > 1:
+        with Pool(min(num_workers, len(jobs))) as pool:
+            return pool.map(_write_split, jobs)
+    return [_write_split(job) for job in jobs]
+
+
+def split_generator(image_fname, image_label, save_path, n_clients, n_classes, beta_list, num_workers=0, table=None):
     '''
     Simulate data splits (more general function)
     Inputs: 
         image_fname: image filenames ===> list
         image_label: label of each image (corresponding with image_fname) ===> 1-D array
-        save_path: please specify path for saving split files
+        save_path: please specify path for saving split files (split_{i}/ and split_{i}.npz)
         n_clients: number of clients
         n_classes: number of classes
         beta_list:  please specify beta for each split
+        num_workers: number of processes generating the splits (0: sequential)
+        table: (filenames, labels) of the manifest filename table; it must hold the test images too,
+               default: labels.csv next to save_path (data_path/{n_clients}_clients), else the split images
     '''
-    for i, beta in enumerate(beta_list):
-        split_path = save_path + f'/split_{i+1}'
-        if not os.path.exists(split_path):
-            os.makedirs(split_path)
-            
-        net_dataidx_map = non_iid_split_dirichlet(image_label, n_clients, n_classes, beta)
-        
-        for k in range(n_clients):
-            client_split = [image_fname[x] for x in net_dataidx_map[k]]
-            client_path = split_path + f'/client_{k+1}.csv'
-            with open(client_path, 'w') as f:
-                writer = csv.writer(f, delimiter='\n')
-                writer.writerow(client_split)
+    if table is None:
+        labels_path = os.path.join(os.path.dirname(os.path.normpath(save_path)), 'labels.csv')
+        if os.path.exists(labels_path):
+            names, labels = read_label_index(os.path.dirname(labels_path))
+            table = (list(names), labels)
+    write_splits(save_path, image_fname, image_label, n_clients, n_classes, beta_list, num_workers=num_workers,
+                 table=table)
                 
 
-def data_split(data_path, n_clients, n_classes, beta_list=[100, 1, 0.5]):
+def data_split(data_path, n_clients, n_classes, beta_list=[100, 1, 0.5], num_workers=0):
     '''
     Simulate data splits and save to data_path/{n_clients}_clients 
+    (client csv files in split_{i}/ and their binary manifest split_{i}.npz)
     Use this function if the data was converted to the unified format
     Inputs: 
         data_path is the path where the data is stored
         n_clients is the number of simulated clients
         n_classes is the number of classes in the dataset
         beta_list is the list of betas for different splits (with different non-iid degrees)
+        num_workers is the number of processes generating the splits (0: sequential)
     '''
     train_paths = os.path.join(data_path, 'central', 'train.csv')
-    train_paths = list({line.strip().split(',')[0] for line in open(train_paths)})
+    train_paths = {line.strip().split(',')[0] for line in open(train_paths)}
     
     labels = {line.strip().split(',')[0]: float(line.strip().split(',')[1]) for line in
               open(os.path.join(data_path, 'labels.csv'))}
     
     train_labels = {fname:label for fname, label in labels.items() if fname in train_paths}
+    train_fnames = np.array(list(train_labels.keys()))
+    train_values = np.array(list(train_labels.values()))
+    values, codes = np.unique(train_values, return_inverse=True)
     
-    for split_id, beta in enumerate(beta_list):
+    splits = write_splits(data_path + f'/{n_clients}_clients', train_fnames, train_values,
+                          n_clients, n_classes, beta_list, num_workers=num_workers,
+                          table=(list(labels.keys()), list(labels.values())))
+    for split_id, net_dataidx_map in enumerate(splits):
         print(f'\n-------split_{split_id+1}-------')
-        
-        split_path = data_path+f'/{n_clients}_clients'+f'/split_{split_id+1}'
-        if not os.path.exists(split_path):
-            os.makedirs(split_path)
-        
-        net_dataidx_map = non_iid_split_dirichlet(np.array(list(train_labels.values())), n_clients, n_classes, beta)
-        
         for cid, c_label_idx in net_dataidx_map.items():
-            client_split = np.array(list(train_labels.keys()))[c_label_idx]
-            client_path = split_path + f'/client_{cid+1}.csv'
-            
-            print('client_id: ', cid, Counter(np.array(list(train_labels.values()))[c_label_idx]))
-            with open(client_path, 'w') as f:
-                writer = csv.writer(f, delimiter='\n')
-                writer.writerow(client_split)            
+            counts = label_histogram(codes, c_label_idx, len(values))
+            print('client_id: ', cid, Counter({float(values[i]): int(counts[i]) for i in np.flatnonzero(counts)}))
 
     
 def view_split(data_path, n_clients=5, save_plot=False):
     '''
     Visualize data splits saved in data_path/{n_clients}_clients: 
     '''
-        
-    labels = {line.strip().split(',')[0]: float(line.strip().split(',')[1]) for line in
-              open(os.path.join(data_path, 'labels.csv'))}
+    names, labels = read_label_index(data_path)
+    values, codes = np.unique(labels, return_inverse=True)
 
     clients_path = f'{data_path}/{n_clients}_clients'
-    split_folders = os.listdir(clients_path)
+    split_folders = [f for f in os.listdir(clients_path) if os.path.isdir(os.path.join(clients_path, f))]
 
     out={}
     for split_id in split_folders:
@@ -125,8 +247,9 @@ def view_split(data_path, n_clients=5, save_plot=False):
         client_files = glob.glob(f"{clients_path}/{split_id}/*.csv")
         for cur_clint_path in client_files:
             client = os.path.basename(cur_clint_path)
-            img_paths = list({line.strip().split(',')[0] for line in open(cur_clint_path)})
-            dist[client] = Counter([label for fname, label in labels.items() if fname in img_paths])
+            img_paths = [line.strip().split(',')[0] for line in open(cur_clint_path)]
+            counts = label_histogram(codes, lookup(names, img_paths), len(values))
+            dist[client] = Counter({float(values[i]): int(counts[i]) for i in np.flatnonzero(counts)})
         out[split_id] = dist
     
     if save_plot:
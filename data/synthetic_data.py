@@ -0,0 +1,100 @@
+# --------------------------------------------------------
+# Synthetic federated dataset in the layout of data/README.md
+# (train/, test/, labels.csv, train.csv, test.csv, central/, {n}_clients/split_k/)
+# for performance work without the Retina / COVID-FL images
+# --------------------------------------------------------
+
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+from data_split import write_splits
+
+
+def synthetic_image(rng, label, n_classes, image_size):
+    """ Smooth random RGB image (0..255) whose brightness depends on the label. """
+    low = rng.rand(max(1, image_size // 16), max(1, image_size // 16), 3) * 255
+    img = np.array(Image.fromarray(np.uint8(low)).resize((image_size, image_size), Image.BICUBIC),
+                   dtype=np.float32)
+    # a class-dependent offset gives fine-tuning something to learn
+    img = 0.7 * img + 0.3 * 255 * (label + 0.5) / n_classes
+    return np.clip(img, 0, 255)
+
+
+def write_image(path, img, image_format):
+    if image_format == 'npy':
+        # float HxWx3 array in 0..255, like the Retina .npy files
+        np.save(path, img.astype(np.float32))
+    else:
+        Image.fromarray(np.uint8(img)).save(path)
+
+
+def write_csv(path, names):
+    with open(path, 'w') as f:
+        f.writelines('%s\n' % name for name in names)
+
+
+def make_synthetic_dataset(data_path, num_train=500, num_test=100, image_size=256, image_format='npy',
+                           n_clients=5, n_classes=2, beta_list=(100, 1, 0.5), seed=0, num_workers=0):
+    """ Write a synthetic dataset to data_path and return the names of the split folders.
+
+    Images are named {phase}_{i}.{npy,png,jpg}; client_k.csv of split_i holds the
+    training images drawn for client k by non_iid_split_dirichlet with
+    beta_list[i - 1] (every client needs at least 10 images), in num_workers processes;
+    split_i.npz is its binary manifest.
+    """
+    assert image_format in ('npy', 'png', 'jpg'), "image_format must be 'npy', 'png' or 'jpg'"
+    assert num_train >= 10 * n_clients, "non_iid_split_dirichlet needs at least 10 images per client"
+    rng = np.random.RandomState(seed)
+
+    labels = {}
+    for phase, num_images in (('train', num_train), ('test', num_test)):
+        os.makedirs(os.path.join(data_path, phase), exist_ok=True)
+        names = ['%s_%06d.%s' % (phase, i, image_format) for i in range(num_images)]
+        phase_labels = rng.randint(0, n_classes, size=num_images)
+        for name, label in zip(names, phase_labels):
+            write_image(os.path.join(data_path, phase, name),
+                        synthetic_image(rng, label, n_classes, image_size), image_format)
+        write_csv(os.path.join(data_path, '%s.csv' % phase), names)
+        labels[phase] = (names, phase_labels)
+
+    with open(os.path.join(data_path, 'labels.csv'), 'w') as f:
+        for names, phase_labels in labels.values():
+            f.writelines('%s,%d\n' % (name, label) for name, label in zip(names, phase_labels))
+
+    train_names, train_labels = labels['train']
+    all_names = labels['train'][0] + labels['test'][0]
+    all_labels = np.concatenate([labels['train'][1], labels['test'][1]])
+    os.makedirs(os.path.join(data_path, 'central'), exist_ok=True)
+    write_csv(os.path.join(data_path, 'central', 'train.csv'), train_names)
+
+    write_splits(os.path.join(data_path, '%d_clients' % n_clients), train_names, train_labels,
+                 n_clients, n_classes, beta_list, num_workers=num_workers, table=(all_names, all_labels))
+    split_types = ['split_%d' % (i + 1) for i in range(len(beta_list))]
+    return split_types
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Write a synthetic federated dataset', add_help=False)
+    parser.add_argument('--data_path', required=True, type=str)
+    parser.add_argument('--num_train', default=500, type=int)
+    parser.add_argument('--num_test', default=100, type=int)
+    parser.add_argument('--image_size', default=256, type=int)
+    parser.add_argument('--image_format', default='npy', choices=['npy', 'png', 'jpg'], type=str,
+                        help='npy: float arrays as Retina (--data_set Retina); png, jpg: RGB images (--data_set COVIDfl)')
+    parser.add_argument('--n_clients', default=5, type=int)
+    parser.add_argument('--n_classes', default=2, type=int)
+    parser.add_argument('--beta_list', default=[100, 1, 0.5], type=float, nargs='+',
+                        help='Dirichlet beta of split_1, split_2, ... (smaller is more skewed)')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_workers', default=0, type=int, help='processes generating the splits')
+    opts = parser.parse_args()
+
+    split_types = make_synthetic_dataset(
+        opts.data_path, num_train=opts.num_train, num_test=opts.num_test, image_size=opts.image_size,
+        image_format=opts.image_format, n_clients=opts.n_clients, n_classes=opts.n_classes,
+        beta_list=opts.beta_list, seed=opts.seed, num_workers=opts.num_workers)
+    print("Synthetic dataset: %d train / %d test images, %d clients, splits %s -> %s" % (
+        opts.num_train, opts.num_test, opts.n_clients, ', '.join(split_types), opts.data_path))